@@ -13,4 +13,9 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 's3project.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Gives each worker's event loop one S3 client, closed when the worker shuts down
+from uploads.aio import lifespan  # noqa: E402 (needs the apps loaded)
+
+application = lifespan(django_application)
@@ -14,6 +14,7 @@ from dotenv import load_dotenv
 import os
 from pathlib import Path
 import django_on_heroku
+import dj_database_url
 
 load_dotenv()
 
@@ -30,7 +31,8 @@ SECRET_KEY = os.getenv('DJANGO_SECRET_KEY')
 SITE_NAME="Veru Data"
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+# Off unless DEBUG=True is set, e.g. in a local .env
+DEBUG = os.getenv('DEBUG', 'False') == 'True'
 
 ALLOWED_HOSTS = [
     '.veru.io'
@@ -52,6 +54,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -60,6 +63,14 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Opt-in request profiling: timings, query and S3 call counts per view on /profiling/ and in
+# Server-Timing headers. PROFILING_SAMPLE_RATE is the fraction of requests measured.
+PROFILING_ENABLED = os.getenv('PROFILING_ENABLED', 'False') == 'True'
+PROFILING_SAMPLE_RATE = float(os.getenv('PROFILING_SAMPLE_RATE', '1.0'))
+PROFILING_BUFFER_SIZE = 10000  # most recent requests kept per process
+if PROFILING_ENABLED:
+    MIDDLEWARE.insert(0, 'uploads.profiling.ProfilingMiddleware')
+
 ROOT_URLCONF = 's3project.urls'
 
 TEMPLATES = [
@@ -84,12 +95,52 @@ WSGI_APPLICATION = 's3project.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.0/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# Gunicorn worker count, used to size the connection pool. Heroku sets WEB_CONCURRENCY.
+WEB_CONCURRENCY = int(os.getenv('WEB_CONCURRENCY', 2))
+# Threads in the `runworker` process, which also need a connection each
+JOBS_CONCURRENCY = int(os.getenv('JOBS_CONCURRENCY', 4))
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+
+if DATABASE_URL:
+    # Under the uvicorn workers each request runs its sync code on a thread of its own, and
+    # Django's persistent connections are per thread, so a connection kept past its request
+    # would be left open on a thread that may never run again. Connections are closed after
+    # each request unless DB_CONN_MAX_AGE says otherwise; DB_POOL reuses them instead.
+    DATABASES = {
+        'default': dj_database_url.parse(
+            DATABASE_URL,
+            conn_max_age=int(os.getenv('DB_CONN_MAX_AGE', 0)),
+            conn_health_checks=True,
+            ssl_require=os.getenv('DB_SSL_REQUIRE', 'True') == 'True',
+        )
+    }
+
+    # Optionally use a psycopg connection pool in each process instead. Its threads (request
+    # threads, the audit log writer, the job threads of `runworker`) share up to DB_POOL_SIZE
+    # connections, waiting up to 10s for one, so the database must allow
+    # WEB_CONCURRENCY * DB_POOL_SIZE connections per web dyno.
+    if os.getenv('DB_POOL', 'False') == 'True':
+        DATABASES['default']['CONN_MAX_AGE'] = 0  # the pool manages connection lifetime
+        DATABASES['default']['OPTIONS']['pool'] = {
+            'min_size': 1,
+            'max_size': int(os.getenv('DB_POOL_SIZE', JOBS_CONCURRENCY + 1)),
+            'timeout': 10,
+        }
+else:
+    # SQLite for local development. WAL lets readers carry on while the job
+    # worker writes, and IMMEDIATE transactions avoid lock-upgrade deadlocks.
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            'OPTIONS': {
+                'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;',
+                'transaction_mode': 'IMMEDIATE',
+                'timeout': 20,
+            },
+        }
     }
-}
 
 
 # Password validation
@@ -127,6 +178,12 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/4.0/howto/static-files/
 
 STATIC_URL = 'static/'
+STATIC_ROOT = BASE_DIR / 'staticfiles'
+# Static files are served by WhiteNoise. collectstatic stores them under names with a hash of
+# their contents, next to gzip and Brotli copies, and WhiteNoise serves hashed names with a
+# far-future "immutable" Cache-Control: a changed file gets a new name, so browsers never
+# need to ask again. WhiteNoise picks the compressed copy the browser accepts.
+# Pages only link the hashed names with DEBUG off; with it on, files are found and served as-is.
 
 # Log-in URL
 
@@ -134,6 +191,61 @@ LOGIN_URL = '/login/'
 LOGIN_REDIRECT_URL = '/'
 
 
+# Holds download URLs, membership sets and rendered page fragments. Local memory is per
+# process; CACHE_DIR switches to a file cache shared by the dyno's processes, and REDIS_URL
+# (e.g. from Heroku Key-Value Store) to a cache shared by every dyno.
+REDIS_URL = os.getenv('REDIS_URL')
+CACHE_DIR = os.getenv('CACHE_DIR')
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'uploads',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+if REDIS_URL:
+    CACHES['default'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+    }
+elif CACHE_DIR:
+    CACHES['default'] = {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': CACHE_DIR,
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    }
+
+# Whether every process serving requests uses the same cache. Rendered fragments and
+# membership sets are invalidated through the cache, so they're only cached when it is:
+# with local memory, other workers would keep serving what they cached before a change.
+# A CACHE_DIR cache is only shared within a dyno; set SHARED_CACHE=False with more than one.
+SHARED_CACHE = os.getenv('SHARED_CACHE', str(bool(REDIS_URL or CACHE_DIR))) == 'True'
+
+# Seconds a user's set of project memberships is cached for access checks (with SHARED_CACHE)
+MEMBERSHIP_CACHE_TIMEOUT = 60
+
+# Rendered project cards, file lists and project details are reused until the project
+# changes (see uploads.fragments), or for at most this many seconds
+FRAGMENT_CACHE_TIMEOUT = 3600
+
+# Files listed per page on a project, and the most a client can ask for with ?page_size=
+FILE_LIST_PAGE_SIZE = 50
+FILE_LIST_MAX_PAGE_SIZE = 500
+
+# Most projects /search/ returns for a query, and the files on each page of results
+SEARCH_RESULTS_LIMIT = 50
+SEARCH_MAX_PAGE_SIZE = 500
+# Suggestions returned by the project member picker
+USER_SEARCH_LIMIT = 20
+
+# Invitations listed per page on /invitations/
+INVITATION_LIST_PAGE_SIZE = 50
+# Invitations that expired unaccepted more than this many days ago are deleted by
+# `manage.py purge_invitations` (until then they can be renewed), this many rows per DELETE
+INVITATION_RETENTION_DAYS = 30
+INVITATION_PURGE_BATCH_SIZE = 1000
+
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
 
@@ -141,21 +253,113 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 STORAGES = {
     "default": {
-        "BACKEND": "storages.backends.s3boto3.S3Boto3Storage",
+        "BACKEND": "uploads.storage.TunedS3Storage",
     },
     "staticfiles": {
-        "BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage",
+        "BACKEND": "whitenoise.storage.CompressedManifestStaticFilesStorage",
     },
 }
 
+# Keep hot objects on local disk (or tmpfs), revalidated against S3 by ETag on each read.
+# Downloads are then served by the app from the cache instead of redirecting to S3.
+S3_READ_CACHE_DIR = os.getenv('S3_READ_CACHE_DIR')
+if S3_READ_CACHE_DIR:
+    STORAGES["default"] = {
+        "BACKEND": "uploads.storage.CachingS3Storage",
+        "OPTIONS": {
+            "cache_dir": S3_READ_CACHE_DIR,
+            "cache_max_size": int(os.getenv('S3_READ_CACHE_MAX_SIZE', 1024 ** 3)),
+            "cache_max_object_size": int(os.getenv('S3_READ_CACHE_MAX_OBJECT_SIZE', 100 * 1024 ** 2)),
+        },
+    }
+
 # AWS Settings
 AWS_ACCESS_KEY_ID = os.getenv('AWS_ACCESS_KEY_ID')
 AWS_SECRET_ACCESS_KEY = os.getenv('AWS_SECRET_ACCESS_KEY')
 AWS_STORAGE_BUCKET_NAME = os.getenv('AWS_STORAGE_BUCKET_NAME')
-AWS_QUERYSTRING_AUTH = False
+AWS_QUERYSTRING_AUTH = True
 AWS_DEFAULT_ACL = None
 
 AWS_S3_REGION_NAME = os.getenv('AWS_S3_REGION_NAME')
+# Signed download URLs are cached until DOWNLOAD_URL_CACHE_MARGIN seconds before they expire
+DOWNLOAD_URL_EXPIRES = 3600
+DOWNLOAD_URL_CACHE_MARGIN = 300
+# Background jobs, run by `manage.py runworker` (the `worker` process in the Procfile)
+JOBS_POLL_INTERVAL = 2  # seconds between polls of an empty queue
+JOBS_MAX_ATTEMPTS = 3
+JOBS_RETRY_BACKOFF = 30  # seconds before the first retry, doubled after each failure
+JOBS_HEARTBEAT_INTERVAL = 30
+JOBS_STALE_AFTER = 300  # running jobs without a heartbeat for this long are requeued
+# Run jobs on a thread in the web process instead, when no worker is running (development)
+JOBS_RUN_IN_THREAD = os.getenv('JOBS_RUN_IN_THREAD', 'False') == 'True'
+
+# Audit log of views, uploads, downloads and deletes (see uploads.audit). Events are queued in
+# memory and inserted in batches by a background thread in each web process.
+AUDIT_LOG_QUEUE_SIZE = 10000  # events held at most; beyond that requests wait for room
+AUDIT_LOG_QUEUE_TIMEOUT = 1  # seconds a request waits for room before writing its event itself
+AUDIT_LOG_BATCH_SIZE = 500
+AUDIT_LOG_FLUSH_INTERVAL = 1  # seconds a partial batch waits for more events
+AUDIT_LOG_SHUTDOWN_TIMEOUT = 10  # seconds allowed for writing queued events at exit
+AUDIT_LOG_RETRY_DELAY = 1  # seconds before retrying a batch the database refused, doubled each time
+AUDIT_LOG_MAX_RETRY_DELAY = 60
+# Off, there's no writer thread and each event is saved as it's recorded (tests)
+AUDIT_LOG_BACKGROUND = os.getenv('AUDIT_LOG_BACKGROUND', 'True') == 'True'
+AUDIT_LOG_PAGE_SIZE = 100  # events per page on /audit/
+
+# Deleting a project removes its S3 objects in batches of 1000 keys on this many threads
+S3_DELETE_CONCURRENCY = 8
+S3_DELETE_RETRIES = 3
+# Project ZIP downloads read ZIP_WORKERS objects ahead, buffering up to ZIP_READ_AHEAD chunks each
+ZIP_CHUNK_SIZE = 1024 * 1024
+ZIP_WORKERS = 4
+ZIP_READ_AHEAD = 4
+# The storage's S3 client, shared by every thread in the process (see uploads.storage.TunedS3Storage).
+# The pool should cover the threads that can use it at once: request threads, S3_DELETE_CONCURRENCY,
+# ZIP_WORKERS and S3_TRANSFER_CONCURRENCY per transfer.
+S3_MAX_POOL_CONNECTIONS = int(os.getenv('S3_MAX_POOL_CONNECTIONS', 50))
+S3_RETRY_MODE = 'adaptive'  # backs off client-side when S3 throttles (503 SlowDown)
+S3_MAX_ATTEMPTS = 5  # including the first
+# Uploads and downloads through the storage over the threshold use ranged/multipart transfers
+S3_MULTIPART_THRESHOLD = 16 * 1024 ** 2
+S3_MULTIPART_CHUNKSIZE = 16 * 1024 ** 2
+S3_TRANSFER_CONCURRENCY = 10  # parts in flight per transfer
+# Connections the async S3 client may open. A uvicorn worker's requests share one client,
+# so this caps the S3 requests its async views have in flight at once.
+ASYNC_S3_MAX_POOL_CONNECTIONS = 50
+ASYNC_S3_UPLOAD_CONCURRENCY = 4  # multipart parts in flight per upload
+# Point at a local S3 stand-in (moto server, MinIO) during development
+AWS_S3_ENDPOINT_URL = os.getenv('AWS_S3_ENDPOINT_URL')
+
+# Direct-to-S3 uploads
+# The bucket needs a CORS rule allowing POST from the site's origin
+DIRECT_UPLOADS_ENABLED = os.getenv('DIRECT_UPLOADS_ENABLED', 'True') == 'True'
+DIRECT_UPLOAD_EXPIRES = 3600  # seconds a presigned POST stays valid
+DIRECT_UPLOAD_MAX_SIZE = 5 * 1024 ** 3  # 5 GB, the S3 single-request limit
+
+# Store uploads once under blobs/<sha256>, shared by every file with the same content.
+# Multipart uploads keep their per-project keys.
+CONTENT_ADDRESSED_STORAGE = os.getenv('CONTENT_ADDRESSED_STORAGE', 'False') == 'True'
+
+# Files larger than the threshold are sent as resumable, parallel multipart uploads
+MULTIPART_UPLOAD_THRESHOLD = 100 * 1024 ** 2
+MULTIPART_UPLOAD_PART_SIZE = 64 * 1024 ** 2  # S3 needs at least 5 MB per part
+MULTIPART_UPLOAD_CONCURRENCY = 4  # parts in flight per browser
+MULTIPART_UPLOAD_STALE_HOURS = 24  # abort_stale_uploads discards older uploads
+# Form uploads through the app are streamed to S3 in parts of this size, at most two held in memory
+STREAMING_UPLOAD_PART_SIZE = 8 * 1024 ** 2
+# Django's default handlers, hashing each file as it arrives rather than reading it back afterwards
+FILE_UPLOAD_HANDLERS = [
+    'uploads.upload_handlers.HashingMemoryFileUploadHandler',
+    'uploads.upload_handlers.HashingTemporaryFileUploadHandler',
+]
+
+# Storage quotas, for projects and users without limits of their own (None means unlimited).
+# Usage counters drift if rows are removed behind the app's back; `manage.py recount_storage` fixes them.
+PROJECT_MAX_BYTES = None
+PROJECT_MAX_FILES = None
+USER_MAX_BYTES = None
+USER_MAX_FILES = None
 
 # Heroku settings
-django_on_heroku.settings(locals())
\ No newline at end of file
+# DATABASES is configured above, from DATABASE_URL, and static files (WhiteNoise) too
+django_on_heroku.settings(locals(), databases=False, staticfiles=False)
\ No newline at end of file
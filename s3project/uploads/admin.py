@@ -1,4 +1,5 @@
 from django.contrib import admin
-from .models import UploadedFile
+from .models import UploadedFile, UserQuota
 
 admin.site.register(UploadedFile)
+admin.site.register(UserQuota)
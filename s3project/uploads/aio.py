@@ -0,0 +1,208 @@
+"""
+Async S3 access for the ASGI views, through aiobotocore.
+
+A uvicorn worker runs one event loop for its whole life. When the ASGI lifespan
+starts (see lifespan() and s3project/asgi.py), that loop gets a client that every
+request on it shares, with one connection pool: it's opened on first use and
+closed on lifespan shutdown. Loops that end with the request instead, like
+runserver's and async_to_sync's (as in tests), would outlive nothing a cached
+client holds, so there each call opens its own client with `async with`. The
+session is shared, so the S3 service model is only loaded once per process.
+Credentials and endpoint come from the default storage, so it talks to the same bucket.
+"""
+import asyncio
+from contextlib import AsyncExitStack, asynccontextmanager
+
+from aiobotocore.config import AioConfig
+from aiobotocore.session import get_session
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+from .profiling import instrument
+
+session = get_session()
+
+
+def create_client():
+    return session.create_client(
+        's3',
+        region_name=default_storage.region_name,
+        endpoint_url=default_storage.endpoint_url,
+        aws_access_key_id=default_storage.access_key,
+        aws_secret_access_key=default_storage.secret_key,
+        config=AioConfig(max_pool_connections=settings.ASYNC_S3_MAX_POOL_CONNECTIONS),
+    )
+
+
+class LoopClient:
+    """The client shared by every request on one long-lived event loop, opened on first use"""
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.stack = AsyncExitStack()
+        self.s3 = None
+
+    async def get(self):
+        async with self.lock:
+            if self.s3 is None:
+                self.s3 = instrument(await self.stack.enter_async_context(create_client()))
+        return self.s3
+
+    async def close(self):
+        self.s3 = None
+        await self.stack.aclose()
+
+
+# Event loops that started an ASGI lifespan, and so outlive their requests
+loop_clients = {}
+
+
+@asynccontextmanager
+async def client():
+    shared = loop_clients.get(asyncio.get_running_loop())
+    if shared is not None:
+        yield await shared.get()
+        return
+    async with create_client() as s3:
+        yield instrument(s3)
+
+
+def lifespan(application):
+    """
+    Wrap an ASGI application to handle lifespan messages, which Django doesn't:
+    startup marks the loop as long-lived, so it gets a shared client, and shutdown
+    closes that client. Everything else goes to the application.
+    """
+    async def app(scope, receive, send):
+        if scope['type'] != 'lifespan':
+            return await application(scope, receive, send)
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                loop_clients[asyncio.get_running_loop()] = LoopClient()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                shared = loop_clients.pop(asyncio.get_running_loop(), None)
+                if shared is not None:
+                    await shared.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    return app
+
+
+async def get_object(key, chunk_size=1024 * 1024):
+    """
+    Starts a GET, returning the response and an async generator over its body in
+    chunks. A client of its own stays open until the body has been read or the
+    generator is closed.
+    """
+    stack = AsyncExitStack()
+    s3 = await stack.enter_async_context(client())
+    try:
+        response = await s3.get_object(Bucket=default_storage.bucket_name, Key=key)
+    except BaseException:
+        await stack.aclose()
+        raise
+
+    async def chunks():
+        async with stack:
+            body = response['Body']
+            try:
+                async for chunk in body.iter_chunks(chunk_size):
+                    yield chunk
+            finally:
+                body.close()
+
+    return response, chunks()
+
+
+async def iter_file(handle, chunk_size=1024 * 1024):
+    """Read an open local file in chunks on a worker thread, closing it at the end"""
+    try:
+        while chunk := await asyncio.to_thread(handle.read, chunk_size):
+            yield chunk
+    finally:
+        await asyncio.to_thread(handle.close)
+
+
+async def upload_file(key, file, content_type=None, part_size=None):
+    """
+    Upload a Django File. Small files are sent with one PUT; larger ones as a
+    multipart upload with a few parts in flight. Reads happen off the event loop.
+    """
+    bucket = default_storage.bucket_name
+    part_size = part_size or settings.MULTIPART_UPLOAD_PART_SIZE
+    extra = {'ContentType': content_type} if content_type else {}
+
+    file.seek(0)
+    async with client() as s3:
+        if file.size <= part_size:
+            body = await asyncio.to_thread(file.read)
+            await s3.put_object(Bucket=bucket, Key=key, Body=body, **extra)
+            return
+
+        upload_id = (await s3.create_multipart_upload(Bucket=bucket, Key=key, **extra))['UploadId']
+        slots = asyncio.Semaphore(settings.ASYNC_S3_UPLOAD_CONCURRENCY)
+
+        async def send(number, body):
+            try:
+                response = await s3.upload_part(
+                    Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=body
+                )
+                return {'PartNumber': number, 'ETag': response['ETag']}
+            finally:
+                slots.release()
+
+        try:
+            tasks = []
+            number = 1
+            while True:
+                # Wait for a free slot before reading, so at most that many parts are in memory
+                await slots.acquire()
+                body = await asyncio.to_thread(file.read, part_size)
+                if not body:
+                    slots.release()
+                    break
+                tasks.append(asyncio.create_task(send(number, body)))
+                number += 1
+
+            parts = await asyncio.gather(*tasks)
+            await s3.complete_multipart_upload(
+                Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={'Parts': parts}
+            )
+        except BaseException:
+            await s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+            raise
+
+
+async def iterate_in_thread(iterator):
+    """
+    Consume a blocking iterator from async code, fetching each item on a worker
+    thread so the event loop stays free
+    """
+    done = object()
+    try:
+        while (item := await asyncio.to_thread(next, iterator, done)) is not done:
+            yield item
+    finally:
+        close = getattr(iterator, 'close', None)
+        if close:
+            await asyncio.to_thread(close)
+
+
+def iterate_on_loop(aiterable, loop):
+    """
+    Consume an async iterator from a worker thread, awaiting each item on `loop`,
+    the event loop it belongs to. The inverse of iterate_in_thread().
+    """
+    aiterator = aiter(aiterable)
+
+    async def next_item():
+        return await anext(aiterator)
+
+    while True:
+        try:
+            yield asyncio.run_coroutine_threadsafe(next_item(), loop).result()
+        except StopAsyncIteration:
+            return
@@ -1,6 +1,16 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.db.backends.signals import connection_created
 
 
 class UploadsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'uploads'
+
+    def ready(self):
+        # Register background jobs and signal handlers
+        from . import signals, tasks  # noqa: F401
+
+        if settings.PROFILING_ENABLED:
+            from .profiling import add_query_wrapper
+            connection_created.connect(add_query_wrapper)
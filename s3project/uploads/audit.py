@@ -0,0 +1,179 @@
+"""
+The audit log: who viewed, uploaded, downloaded or deleted what, and who was turned away.
+
+Views record events with record() (arecord() in async views), which only puts
+an AuditEvent on an in-process queue. A writer thread takes events off it and
+inserts them with bulk_create, up to AUDIT_LOG_BATCH_SIZE at a time, waiting up
+to AUDIT_LOG_FLUSH_INTERVAL for a batch to fill. Requests don't wait on an INSERT.
+
+The queue holds at most AUDIT_LOG_QUEUE_SIZE events. When the writer falls that
+far behind, record() waits up to AUDIT_LOG_QUEUE_TIMEOUT for room, and failing
+that writes its event itself, so recording slows down rather than losing events.
+A batch the database refuses is kept and retried with backoff, up to
+AUDIT_LOG_MAX_RETRY_DELAY apart, while new events back up behind it. Queued
+events are written when the process exits normally (e.g. a gunicorn worker
+stopping on SIGTERM), within AUDIT_LOG_SHUTDOWN_TIMEOUT seconds.
+
+With AUDIT_LOG_BACKGROUND off (as in tests) there's no thread: each event is
+saved as it's recorded.
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, DataError, IntegrityError, close_old_connections, connection
+
+from .models import AuditEvent
+
+logger = logging.getLogger(__name__)
+
+# Put on the queue to stop the writer once what's ahead of it is written
+STOP = object()
+
+events = queue.Queue(maxsize=settings.AUDIT_LOG_QUEUE_SIZE)
+writer = None
+writer_lock = threading.Lock()
+
+
+def event(action, user=None, project=None, file=None, request=None):
+    """An unsaved AuditEvent, stamped now"""
+    if user is not None and not user.is_authenticated:
+        user = None
+    if file is not None and project is None:
+        project = file.project
+    instance = AuditEvent(action=action, user=user, project=project)
+    if file is not None:
+        instance.file_id = file.id
+        instance.filename = file.filename[:255]
+    if request is not None:
+        instance.ip_address = request.META.get('REMOTE_ADDR') or None
+    return instance
+
+
+def record(action, user=None, project=None, file=None, request=None):
+    """Queue an event for the writer thread"""
+    put(event(action, user, project, file, request))
+
+
+async def arecord(action, user=None, project=None, file=None, request=None):
+    """record() for async views: only waits for room in the queue on a thread"""
+    instance = event(action, user, project, file, request)
+    if not settings.AUDIT_LOG_BACKGROUND:
+        await instance.asave()
+        return
+    ensure_writer()
+    try:
+        events.put_nowait(instance)
+    except queue.Full:
+        await sync_to_async(put, thread_sensitive=False)(instance)
+
+
+def put(instance):
+    if not settings.AUDIT_LOG_BACKGROUND:
+        instance.save()
+        return
+    ensure_writer()
+    try:
+        events.put(instance, timeout=settings.AUDIT_LOG_QUEUE_TIMEOUT)
+    except queue.Full:
+        logger.warning("Audit log queue full, writing an event synchronously")
+        instance.save()
+
+
+def writer_running():
+    # In a forked process (e.g. a gunicorn worker) the parent's thread isn't alive
+    return writer is not None and writer.is_alive()
+
+
+def ensure_writer():
+    """Start the writer thread, once per process"""
+    global writer
+    if writer_running():
+        return
+    with writer_lock:
+        if writer_running():
+            return
+        writer = threading.Thread(target=run_writer, name='audit-writer', daemon=True)
+        writer.start()
+        atexit.register(shutdown)
+
+
+def next_batch():
+    """
+    Wait for an event, then take up to AUDIT_LOG_BATCH_SIZE, waiting at most
+    AUDIT_LOG_FLUSH_INTERVAL for more. A batch ends with STOP if it's been queued.
+    """
+    batch = [events.get()]
+    deadline = time.monotonic() + settings.AUDIT_LOG_FLUSH_INTERVAL
+    while len(batch) < settings.AUDIT_LOG_BATCH_SIZE and batch[-1] is not STOP:
+        try:
+            batch.append(events.get(timeout=max(0, deadline - time.monotonic())))
+        except queue.Empty:
+            break
+    return batch
+
+
+def run_writer():
+    try:
+        while True:
+            batch = next_batch()
+            try:
+                close_old_connections()
+                write([instance for instance in batch if instance is not STOP])
+            finally:
+                for _ in batch:
+                    events.task_done()
+            if batch[-1] is STOP:
+                return
+    finally:
+        connection.close()
+
+
+def write(batch):
+    """Insert a batch, retrying with backoff until the database takes it"""
+    delay = settings.AUDIT_LOG_RETRY_DELAY
+    while batch:
+        try:
+            AuditEvent.objects.bulk_create(batch)
+            return
+        except (DataError, IntegrityError):
+            if len(batch) > 1:
+                # Something in the batch can never be written; write the events one at a time
+                for instance in batch:
+                    write([instance])
+                return
+            # Kept in the error log at least, with everything the row would have held
+            fields = {field.attname: getattr(batch[0], field.attname) for field in AuditEvent._meta.concrete_fields}
+            logger.exception("Could not write audit event %s", fields)
+            return
+        except DatabaseError:
+            # e.g. the connection dropped, or the database is down or locked
+            logger.exception("Could not write %s audit event(s); retrying in %ss", len(batch), delay)
+            connection.close()
+            time.sleep(delay)
+            delay = min(2 * delay, settings.AUDIT_LOG_MAX_RETRY_DELAY)
+
+
+def flush():
+    """Wait until every queued event has been written"""
+    if writer_running():
+        events.join()
+
+
+def shutdown():
+    """Write the queued events and stop the writer, at process exit"""
+    atexit.unregister(shutdown)
+    if not writer_running():
+        return
+    timeout = settings.AUDIT_LOG_SHUTDOWN_TIMEOUT
+    try:
+        events.put(STOP, timeout=timeout)
+    except queue.Full:
+        pass
+    writer.join(timeout)
+    if writer.is_alive():
+        logger.error("Audit log writer didn't finish in time; about %s event(s) lost", events.qsize())
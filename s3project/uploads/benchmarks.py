@@ -0,0 +1,295 @@
+"""
+Micro-benchmarks run with `manage.py benchmark <name>`.
+
+Each benchmark takes the command's stdout and the parsed options and prints its
+own results. Anything that talks to S3 uses the configured storage, so point
+AWS_S3_ENDPOINT_URL at a local stand-in (moto server, MinIO) rather than a real bucket.
+"""
+import asyncio
+import random
+import statistics
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from importlib import import_module
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, connection, transaction
+from storages.backends.s3boto3 import S3Boto3Storage
+
+from . import downloads, search
+from .models import Project, ProjectMembership, UploadedFile
+from .storage import TunedS3Storage
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def bench_download_urls(stdout, options):
+    """
+    Signing throughput and cache hit rate of the download URL service.
+    The local-memory cache holds 10,000 entries, so keep --count below that
+    unless CACHES points at a bigger cache.
+    """
+    count = options['count'] or 250
+    page_size = 50
+    project = Project(id=0)
+    files = []
+    for i in range(count):
+        file = UploadedFile(id=i, project=project)
+        file.file.name = f"projects/0/benchmark-{i}.bin"
+        files.append(file)
+    pages = [files[i:i + page_size] for i in range(0, count, page_size)]
+
+    cache.delete_many([downloads.cache_key(file.file.name) for file in files])
+    downloads.stats.clear()
+
+    _, unbatched = timed(lambda: [downloads.sign_download_url(file.file.name) for file in files])
+    _, cold = timed(lambda: [downloads.get_download_urls(page) for page in pages])
+    _, warm = timed(lambda: [downloads.get_download_urls(page) for page in pages])
+
+    hits, misses = downloads.stats['hits'], downloads.stats['misses']
+    stdout.write(f"{count} files in pages of {page_size}")
+    stdout.write(f"  sign every row:   {count / unbatched:>10,.0f} urls/s")
+    stdout.write(f"  cold cache:       {count / cold:>10,.0f} urls/s")
+    stdout.write(f"  warm cache:       {count / warm:>10,.0f} urls/s")
+    stdout.write(f"  cache hit rate:   {hits / (hits + misses):>10.1%}")
+
+
+def bench_db_connections(stdout, options):
+    """
+    Per-request database connection overhead with the current DATABASES settings.
+    Run it before and after changing CONN_MAX_AGE or DB_POOL to compare.
+    """
+    count = options['count'] or 200
+
+    def request_cycle():
+        # What Django does around each request: reuse or close, then query
+        close_old_connections()
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        close_old_connections()
+
+    def fresh_cycle():
+        connection.close()
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+
+    request_cycle()
+    _, configured = timed(lambda: [request_cycle() for _ in range(count)])
+    _, fresh = timed(lambda: [fresh_cycle() for _ in range(count)])
+    connection.close()
+
+    settings_dict = connection.settings_dict
+    stdout.write(f"{connection.vendor}, CONN_MAX_AGE={settings_dict['CONN_MAX_AGE']}, "
+                 f"pool={'pool' in settings_dict['OPTIONS']}, {count} requests")
+    stdout.write(f"  new connection per request: {1000 * fresh / count:>8.2f} ms/request")
+    stdout.write(f"  configured settings:        {1000 * configured / count:>8.2f} ms/request")
+
+
+@contextmanager
+def benchmark_fixture(size):
+    """
+    A throwaway user, project and stored file for load tests, plus a logged-in
+    session cookie. They're committed, as the server under test reads them, and
+    deleted again on exit.
+    """
+    user = User.objects.create_user(f"benchmark-{uuid.uuid4().hex[:12]}", 'benchmark@example.com')
+    session = import_module(settings.SESSION_ENGINE).SessionStore()
+    name = None
+    try:
+        project = Project.objects.create(name='Benchmark', created_by=user)
+        ProjectMembership.objects.create(project=project, user=user, added_by=user)
+        name = default_storage.save(f"{project.get_s3_folder_name()}benchmark-{size}.bin", ContentFile(b'x' * size))
+        file = UploadedFile(user=user, project=project, size=size)
+        file.file.name = name
+        file.save()
+
+        session[SESSION_KEY] = str(user.pk)
+        session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.save()
+        yield file, f"{settings.SESSION_COOKIE_NAME}={session.session_key}"
+    finally:
+        if name is not None:
+            default_storage.delete(name)
+        session.delete()
+        # Takes the project, membership and file rows with it
+        user.delete()
+
+
+async def slow_get(host, port, path, cookie, read_size, delay):
+    """GET a URL over a raw socket, reading the response slowly like a poor connection"""
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(
+        f"GET {path} HTTP/1.0\r\nHost: {host}\r\nCookie: {cookie}\r\n\r\n".encode()
+    )
+    await writer.drain()
+    received = 0
+    while chunk := await reader.read(read_size):
+        received += len(chunk)
+        await asyncio.sleep(delay)
+    writer.close()
+    return time.perf_counter() - start, received
+
+
+def bench_slow_clients(stdout, options):
+    """
+    Throughput of concurrent slow clients downloading through the proxy endpoint
+    of a running deployment. Start each deployment against the same database and
+    S3 stand-in, then point --url at it, e.g.
+
+        gunicorn --chdir s3project -w 2 s3project.wsgi
+        gunicorn --chdir s3project -w 2 -k uvicorn_worker.UvicornWorker s3project.asgi
+        manage.py benchmark slow_clients --url http://127.0.0.1:8000
+    """
+    if not options['url']:
+        stdout.write("--url of a running server is required.")
+        return
+
+    count = options['count'] or 20
+    size = 4 * 1024 * 1024
+    url = urlsplit(options['url'])
+
+    async def run(path, cookie):
+        # Each client reads about 2.5 MB/s
+        return await asyncio.gather(*[
+            slow_get(url.hostname, url.port or 80, path, cookie, 256 * 1024, 0.1)
+            for _ in range(count)
+        ])
+
+    with benchmark_fixture(size) as (file, cookie):
+        results, elapsed = timed(asyncio.run, run(f"/files/{file.id}/proxy/", cookie))
+    latencies = sorted(latency for latency, _ in results)
+    complete = sum(1 for _, received in results if received >= size)
+
+    stdout.write(f"{count} concurrent slow clients, {size // 1024 ** 2} MB each, against {options['url']}")
+    stdout.write(f"  complete downloads: {complete}/{count}")
+    stdout.write(f"  wall time:          {elapsed:>8.2f} s")
+    stdout.write(f"  throughput:         {count / elapsed:>8.2f} downloads/s")
+    stdout.write(f"  latency p50 / max:  {statistics.median(latencies):>8.2f} s / {latencies[-1]:.2f} s")
+
+
+SEARCH_WORDS = [
+    'annual', 'report', 'budget', 'invoice', 'contract', 'draft', 'final', 'meeting', 'notes', 'design',
+    'survey', 'photo', 'scan', 'backup', 'export', 'summary', 'proposal', 'review', 'schedule', 'minutes',
+]
+
+
+def bench_search(stdout, options):
+    """
+    Search latency over a large number of files, e.g. --count 1000000.
+    Files are spread over 100 projects and queries are restricted to 10 of them,
+    as for a typical member. Everything is added in a transaction that's rolled
+    back at the end, so nothing is left behind in the configured database.
+    """
+    with transaction.atomic():
+        run_search_benchmark(stdout, options['count'] or 100_000)
+        transaction.set_rollback(True)
+
+
+def run_search_benchmark(stdout, count):
+    user = User.objects.create_user(f"benchmark-{uuid.uuid4().hex[:12]}", 'benchmark@example.com')
+    projects = Project.objects.bulk_create([
+        Project(name=f"Search benchmark {i}", created_by=user,
+                description=f"{SEARCH_WORDS[i % 20]} documents for team {i}")
+        for i in range(100)
+    ])
+
+    rng = random.Random(0)
+    batch = []
+    for i in range(count):
+        name = f"{rng.choice(SEARCH_WORDS)}-{rng.choice(SEARCH_WORDS)}-{i}.{rng.choice(['pdf', 'docx', 'jpg'])}"
+        file = UploadedFile(user=user, project=projects[i % 100], size=rng.randrange(1, 10 ** 7))
+        file.file.name = f"{projects[i % 100].get_s3_folder_name()}{name}"
+        batch.append(file)
+        if len(batch) == 10_000:
+            UploadedFile.objects.bulk_create(batch)
+            batch = []
+    UploadedFile.objects.bulk_create(batch)
+    if connection.vendor == 'postgresql':
+        # Planner statistics for the new rows; they're rolled back with them
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE uploads_project, uploads_uploadedfile')
+
+    project_ids = {project.id for project in projects[:10]}
+    queries = ['report', 'invoice-draft', 'sum', 'meeting-notes-1', '424242', 'no such file']
+
+    stdout.write(f"{connection.vendor}, {count:,} files, search restricted to 10 of 100 projects")
+    for query in queries:
+        search.search_files(query, project_ids, limit=settings.SEARCH_RESULTS_LIMIT)
+        latencies = sorted(
+            timed(lambda: search.search_files(query, project_ids, limit=settings.SEARCH_RESULTS_LIMIT))[1]
+            for _ in range(20)
+        )
+        stdout.write(f"  files {query!r:<18} p50 {1000 * statistics.median(latencies):>8.2f} ms"
+                     f"   p95 {1000 * latencies[18]:>8.2f} ms")
+
+    for query in ['report', 'team 4']:
+        latencies = sorted(timed(lambda: list(search.search_projects(query, project_ids)))[1] for _ in range(20))
+        stdout.write(f"  projects {query!r:<15} p50 {1000 * statistics.median(latencies):>8.2f} ms"
+                     f"   p95 {1000 * latencies[18]:>8.2f} ms")
+
+
+def transfer_round(storage, prefix, count, size, threads):
+    """Save then read back `count` objects of `size` bytes on a fresh pool of threads, like a job does"""
+    content = b'x' * size
+    names = [f"{prefix}{i}.bin" for i in range(count)]
+
+    def save(name):
+        storage.save(name, ContentFile(content))
+
+    def read(name):
+        with storage.open(name) as f:
+            return len(f.read())
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        _, upload = timed(lambda: list(executor.map(save, names)))
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        _, download = timed(lambda: list(executor.map(read, names)))
+    return count * size / upload, count * size / download
+
+
+def bench_s3_transfers(stdout, options):
+    """
+    Upload and download throughput of the stock S3Boto3Storage against TunedS3Storage
+    with the current S3_* settings: many small objects from a pool of threads, then
+    single large objects. Each storage gets a fresh instance, as a new process would.
+    """
+    count = options['count'] or 200
+    threads = 16
+    mb = 1024 ** 2
+    rounds = [
+        ('small', count, 256 * 1024, threads),
+        ('large', 2, 64 * mb, 1),
+    ]
+
+    for label, storage_class in (('S3Boto3Storage', S3Boto3Storage), ('TunedS3Storage', TunedS3Storage)):
+        storage = storage_class()
+        prefix = f"benchmark/transfers/{storage_class.__name__}/"
+        stdout.write(label)
+        for name, objects, size, workers in rounds:
+            upload, download = transfer_round(storage, f"{prefix}{name}-", objects, size, workers)
+            stdout.write(f"  {objects} x {size / mb:g} MB on {workers} thread(s): "
+                         f"upload {upload / mb:>7.1f} MB/s, download {download / mb:>7.1f} MB/s")
+        storage.bucket.objects.filter(Prefix=prefix).delete()
+
+
+BENCHMARKS = {
+    'download_urls': bench_download_urls,
+    'db_connections': bench_db_connections,
+    'slow_clients': bench_slow_clients,
+    'search': bench_search,
+    's3_transfers': bench_s3_transfers,
+}
@@ -0,0 +1,180 @@
+"""
+Content-addressed storage.
+
+With CONTENT_ADDRESSED_STORAGE on, uploads are stored once under blobs/<sha256>
+and UploadedFile rows point at a reference-counted Blob. Identical content
+uploaded to several projects, or uploaded twice, is stored and transferred once.
+"""
+import hashlib
+import re
+from collections import Counter
+
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, F
+
+from .models import Blob, Project, UploadedFile, get_blob_key
+from .s3 import copy_object, delete_objects, head_object
+
+SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+def is_sha256(value):
+    return bool(value and SHA256_RE.match(value))
+
+
+def hash_file(file, chunk_size=1024 * 1024):
+    """
+    Returns the SHA-256 of a Django File, reading it in chunks and rewinding it
+    """
+    digest = hashlib.sha256()
+    for chunk in file.chunks(chunk_size):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def file_sha256(file):
+    """
+    The SHA-256 of an uploaded file, as the upload handler computed it while the
+    file arrived, or else by reading the file back
+    """
+    return getattr(file, 'sha256', None) or hash_file(file)
+
+
+def lock_blob(sha256, size):
+    """
+    The row for this content, locked until the transaction ends, created
+    unreferenced if there isn't one. Call inside transaction.atomic().
+    """
+    blob = Blob.objects.select_for_update().filter(sha256=sha256).first()
+    if blob is None:
+        try:
+            with transaction.atomic():
+                blob = Blob.objects.create(sha256=sha256, size=size, ref_count=0)
+        except IntegrityError:
+            # Another upload of the same content created it first
+            blob = Blob.objects.select_for_update().get(sha256=sha256)
+    return blob
+
+
+def take_reference(blob):
+    Blob.objects.filter(id=blob.id).update(ref_count=F('ref_count') + 1)
+    blob.refresh_from_db()
+    return blob
+
+
+def add_reference(sha256):
+    """
+    Take another reference to a stored blob, e.g. one of the caller's own files
+    has. Returns None if nothing references it any more, as its object may be
+    purged: the content has to be stored again.
+    """
+    with transaction.atomic():
+        blob = Blob.objects.select_for_update().filter(sha256=sha256, ref_count__gt=0).first()
+        return take_reference(blob) if blob else None
+
+
+def store_file(file, sha256=None):
+    """
+    Store an uploaded Django File as a blob, skipping the transfer when its
+    content is already stored. Returns the referenced Blob.
+
+    The content is transferred before any row is locked, so no transaction stays
+    open for the length of an upload. The key is the content's hash, so storing
+    it twice is harmless, and an object left behind by an upload that fails after
+    the transfer is an orphan for reconcile_storage to remove. The row is then
+    locked just to take the reference. Until then an unreferenced blob may be
+    purged, so its object is checked again under the lock, and stored again if a
+    purge got there first.
+    """
+    sha256 = sha256 or file_sha256(file)
+    key = get_blob_key(sha256)
+    while True:
+        if not Blob.objects.filter(sha256=sha256, ref_count__gt=0).exists() and not default_storage.exists(key):
+            name = default_storage.save(key, file)
+            if name != key:
+                # Stored by a concurrent upload, and this storage doesn't overwrite
+                default_storage.delete(name)
+        with transaction.atomic():
+            blob = lock_blob(sha256, file.size)
+            if blob.ref_count > 0 or default_storage.exists(key):
+                return take_reference(blob)
+
+
+def store_object(key, sha256, size):
+    """
+    Like store_file() for content the browser uploaded to `key` and the server
+    has verified: it's copied into place if the blob isn't stored yet, and the
+    uploaded object is deleted once the reference is committed.
+    """
+    with transaction.atomic():
+        blob = lock_blob(sha256, size)
+        if blob.ref_count == 0 and head_object(blob.key) is None:
+            copy_object(key, blob.key)
+        take_reference(blob)
+        transaction.on_commit(lambda: delete_objects([key]))
+    return blob
+
+
+def is_referenced_by(user, sha256):
+    """Whether one of the user's own projects already has a file with this content"""
+    return UploadedFile.objects.filter(
+        blob__sha256=sha256, project__in=Project.objects.for_user(user)
+    ).exists()
+
+
+def release_blobs(counts):
+    """
+    Drop references given as {blob_id: count}. Blobs nobody references any more
+    are purged once the transaction that released them commits.
+    Call this after the UploadedFile rows themselves are deleted.
+    """
+    blob_ids = sorted(counts)
+    for i in range(0, len(blob_ids), 1000):
+        with transaction.atomic():
+            # Locked in id order so concurrent releases can't deadlock
+            for blob in Blob.objects.select_for_update().filter(id__in=blob_ids[i:i + 1000]).order_by('id'):
+                blob.ref_count = max(0, blob.ref_count - counts[blob.id])
+                blob.save(update_fields=['ref_count'])
+    transaction.on_commit(lambda: purge_blobs(blob_ids))
+
+
+def purge_blobs(blob_ids):
+    """
+    Delete the unreferenced blobs among blob_ids from S3 and then from the
+    database, in batches.
+
+    Only rows with no references are locked while their objects are deleted: an
+    upload of the same content waits for the purge and then stores it again,
+    and a blob an upload has already locked is skipped, as it's being reused.
+    Rows whose object couldn't be deleted are kept, unreferenced, for a retry.
+    """
+    skip_locked = connection.features.has_select_for_update_skip_locked
+    for i in range(0, len(blob_ids), 1000):
+        with transaction.atomic():
+            unused = list(
+                Blob.objects.select_for_update(skip_locked=skip_locked)
+                .filter(id__in=blob_ids[i:i + 1000], ref_count=0)
+            )
+            if unused:
+                failed = set(delete_objects([blob.key for blob in unused]))
+                Blob.objects.filter(id__in=[b.id for b in unused if b.key not in failed]).delete()
+
+
+def count_references(files):
+    """Returns {blob_id: number of files} for a queryset of UploadedFiles"""
+    rows = files.filter(blob__isnull=False).values('blob').annotate(n=Count('id'))
+    return Counter({row['blob']: row['n'] for row in rows})
+
+
+def delete_uploaded_file(file):
+    """Delete a file's row and its storage, respecting shared blobs"""
+    if file.blob_id is None:
+        file.file.delete(save=False)
+        file.delete()
+        return
+
+    blob_id = file.blob_id
+    file.delete()
+    release_blobs({blob_id: 1})
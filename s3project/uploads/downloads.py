@@ -0,0 +1,86 @@
+import hashlib
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.urls import reverse
+from django.utils.http import content_disposition_header
+
+from .s3 import get_s3_client, get_bucket_name
+
+# Process-local counters, reported by `manage.py benchmark download_urls`
+stats = Counter()
+
+
+def cache_key(name, filename=None):
+    # Storage names can contain characters memcached doesn't allow in keys
+    return 'download-url:' + hashlib.sha256(f"{name}|{filename or ''}".encode()).hexdigest()
+
+
+def sign_download_url(name, expires_in=None, filename=None):
+    """
+    Presign a GET for an object. Content-addressed objects are named by hash,
+    so filename sets the name the browser saves the download under.
+    """
+    # Non-S3 storages (e.g. in tests) have no signing; fall back to their own URL
+    if not hasattr(default_storage, 'bucket_name'):
+        return default_storage.url(name)
+
+    params = {'Bucket': get_bucket_name(), 'Key': name}
+    if filename:
+        params['ResponseContentDisposition'] = content_disposition_header(True, filename)
+    return get_s3_client().generate_presigned_url(
+        'get_object',
+        Params=params,
+        ExpiresIn=expires_in or settings.DOWNLOAD_URL_EXPIRES,
+    )
+
+
+def download_filename(file):
+    return file.filename if file.blob_id else None
+
+
+def get_download_urls(files):
+    """
+    Returns {file id: presigned GET URL} for a page of files.
+
+    URLs are memoized in the cache until shortly before they expire, and the
+    whole page is looked up and stored with one get_many/set_many round-trip.
+    """
+    keys = {file.id: cache_key(file.file.name, download_filename(file)) for file in files}
+    cached = cache.get_many(keys.values())
+
+    urls = {}
+    missing = {}
+    for file in files:
+        url = cached.get(keys[file.id])
+        if url is None:
+            url = sign_download_url(file.file.name, filename=download_filename(file))
+            missing[keys[file.id]] = url
+        urls[file.id] = url
+
+    stats['hits'] += len(files) - len(missing)
+    stats['misses'] += len(missing)
+
+    if missing:
+        cache.set_many(missing, timeout=settings.DOWNLOAD_URL_EXPIRES - settings.DOWNLOAD_URL_CACHE_MARGIN)
+    return urls
+
+
+def get_download_url(file):
+    return get_download_urls([file])[file.id]
+
+
+def attach_download_urls(files):
+    """
+    Sets file.download_url on each file so templates don't sign per row.
+    With a caching storage, files are downloaded through the app instead.
+    """
+    if getattr(default_storage, 'is_caching', False):
+        urls = {file.id: reverse('proxy_file', args=[file.id]) for file in files}
+    else:
+        urls = get_download_urls(files)
+    for file in files:
+        file.download_url = urls[file.id]
+    return files
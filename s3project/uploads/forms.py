@@ -1,7 +1,17 @@
+import asyncio
+import os
+
+from asgiref.sync import sync_to_async
 from django import forms
+from django.conf import settings
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import User
+from . import aio
 from .models import Invitation, UploadedFile, Project, ProjectMembership
+from .blobs import file_sha256, store_file
+from .members import parse_csv, parse_identifiers, resolve_users
+from .s3 import generate_upload_key
+from .upload_handlers import S3StreamedFile
 
 
 class InvitationForm(forms.ModelForm):
@@ -14,7 +24,15 @@ class InvitationForm(forms.ModelForm):
         # Check if a user with this email already exists
         if User.objects.filter(email=email).exists():
             raise forms.ValidationError("A user with this email already exists.")
+        # An invitation that expired unaccepted doesn't block a new one to the address;
+        # create_invitation replaces it
+        if Invitation.objects.with_status().filter(email=email).exclude(status=Invitation.Status.EXPIRED).exists():
+            raise forms.ValidationError("An invitation for this email already exists.")
         return email
+
+    def validate_unique(self):
+        # Invitation.email's unique check is done by clean_email, which lets expired invitations through
+        pass
     
 class AcceptInvitationForm(UserCreationForm):
     invitation_token = forms.UUIDField(widget=forms.HiddenInput())
@@ -61,31 +79,54 @@ class AcceptInvitationForm(UserCreationForm):
 class ProjectForm(forms.ModelForm):
     class Meta:
         model = Project
-        fields = ['name', 'description']
+        fields = ['name', 'description', 'max_bytes', 'max_files']
         widgets = {
             'description': forms.Textarea(attrs={'rows': 4}),
         }
 
 class ProjectMembershipForm(forms.Form):
+    # Filled in by the picker on the page, which searches users as you type
     users = forms.ModelMultipleChoiceField(
-        queryset=User.objects.filter(is_active=True).order_by('username'),
-        widget=forms.CheckboxSelectMultiple,
+        queryset=User.objects.filter(is_active=True),
+        widget=forms.MultipleHiddenInput,
         required=False,
-        label="Select users to add to this project"
+    )
+    emails = forms.CharField(
+        widget=forms.Textarea(attrs={'rows': 4}),
+        required=False,
+        label="Emails or usernames",
+        help_text="Separated by commas or new lines, e.g. pasted from a spreadsheet",
+    )
+    csv_file = forms.FileField(
+        required=False,
+        label="Or import a CSV file",
+        help_text="A CSV with an email or username column, named in its header row",
     )
 
-    def __init__(self, *args, **kwargs):
-        project = kwargs.pop('project', None)
-        super().__init__(*args, **kwargs)
+    CSV_MAX_SIZE = 1024 * 1024
+
+    def clean_csv_file(self):
+        csv_file = self.cleaned_data.get('csv_file')
+        if csv_file and csv_file.size > self.CSV_MAX_SIZE:
+            raise forms.ValidationError("The CSV file can be at most 1 MB.")
+        return csv_file
 
-        if project:
-            # Exclude users already in the project
-            existing_members = project.projectmembership_set.values_list('user_id', flat=True)
-            self.fields['users'].queryset = User.objects.filter(
-                is_active = True
-            ).exclude(
-                id__in=existing_members
-            ).order_by('username')
+    def clean(self):
+        cleaned_data = super().clean()
+        identifiers = parse_identifiers(cleaned_data.get('emails') or '')
+        csv_file = cleaned_data.get('csv_file')
+        if csv_file:
+            try:
+                identifiers += parse_csv(csv_file.read().decode('utf-8-sig'))
+            except UnicodeDecodeError:
+                self.add_error('csv_file', "The CSV file must be UTF-8 text.")
+            except ValueError as e:
+                self.add_error('csv_file', str(e))
+
+        # Every pasted and imported user is looked up in one query
+        imported, self.unmatched = resolve_users(identifiers)
+        cleaned_data['user_ids'] = {user.id for user in cleaned_data.get('users') or []} | {user.id for user in imported}
+        return cleaned_data
 
 class FileUploadForm(forms.ModelForm):
     class Meta:
@@ -103,6 +144,54 @@ class FileUploadForm(forms.ModelForm):
             instance.user = self.user
         if self.project:
             instance.project = self.project
+        upload = self.cleaned_data['file']
+        # Metadata comes from the upload itself, so it costs no request to S3
+        instance.size = upload.size
+        instance.content_type = upload.content_type or ''
+        if isinstance(upload, S3StreamedFile):
+            # Already stored by the upload handler while the request was parsed
+            instance.file = upload.key
+            instance.checksum = upload.sha256
+        elif settings.CONTENT_ADDRESSED_STORAGE:
+            # Store the content once under blobs/<sha256> instead of under the project
+            instance.blob = store_file(upload)
+            instance.original_filename = os.path.basename(upload.name)
+            instance.file = instance.blob.key
+            instance.checksum = instance.blob.sha256
+        else:
+            instance.checksum = file_sha256(upload)
         if commit:
             instance.save()
+        return instance
+
+    async def asave(self):
+        """
+        Like save(), for async views: the S3 transfer goes through the shared
+        async client instead of blocking a thread
+        """
+        instance = super().save(commit=False)
+        instance.user = self.user
+        instance.project = self.project
+        upload = self.cleaned_data['file']
+        instance.size = upload.size
+        instance.content_type = upload.content_type or ''
+        if isinstance(upload, S3StreamedFile):
+            instance.file = upload.key
+            instance.checksum = upload.sha256
+            await instance.asave()
+            return instance
+
+        instance.checksum = sha256 = await asyncio.to_thread(file_sha256, upload)
+
+        if settings.CONTENT_ADDRESSED_STORAGE:
+            # On a thread, as the transfer to S3 blocks
+            instance.blob = await sync_to_async(store_file)(upload, sha256)
+            instance.original_filename = os.path.basename(upload.name)
+            instance.file = instance.blob.key
+        else:
+            key = generate_upload_key(self.project, upload.name)
+            await aio.upload_file(key, upload, content_type=upload.content_type)
+            instance.file = key
+
+        await instance.asave()
         return instance
\ No newline at end of file
@@ -0,0 +1,133 @@
+"""
+Cached HTML fragments for the dashboard, project list and project pages.
+
+Every project has a version number in the cache, bumped by the receivers in
+signals.py once a change to the project, one of its files or one of its
+memberships is committed. Fragments are cached under keys that include the
+versions they were rendered from, so a change makes the project's old fragments
+unreachable and they simply expire; nothing has to find and delete them.
+Versions start from the clock rather than from 1, so a version evicted from the
+cache never comes back pointing at fragments rendered from older data.
+
+Fragments are only cached with SHARED_CACHE on: a version bumped in one
+process's local memory would go unseen by the others, which would keep serving
+their old fragments. Otherwise every fragment is rendered for each request.
+
+Fragments with presigned download URLs in them are kept for at most
+DOWNLOAD_URL_CACHE_MARGIN seconds, the least time a cached URL has left.
+Hit and miss counts are kept in the Django cache and shown at /cache/fragments/.
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from .models import Project
+
+STATS = ('hits', 'misses')
+
+
+def version_key(project_id):
+    return f"project-version:{project_id}"
+
+
+def get_versions(project_ids):
+    """Returns {project id: version}, starting a version for projects without one"""
+    keys = {project_id: version_key(project_id) for project_id in project_ids}
+    found = cache.get_many(keys.values())
+    versions = {}
+    for project_id, key in keys.items():
+        version = found.get(key)
+        if version is None:
+            version = time.time_ns()
+            if not cache.add(key, version, timeout=None):
+                version = cache.get(key, version)
+        versions[project_id] = version
+    return versions
+
+
+def bump_version(project_id):
+    try:
+        cache.incr(version_key(project_id))
+    except ValueError:
+        # No version yet, so nothing has been cached for the project
+        pass
+
+
+def fragment_key(name, *parts):
+    # Cursors and the like can be long, or contain characters memcached doesn't allow in keys
+    digest = hashlib.sha256('|'.join(str(part) for part in parts).encode()).hexdigest()
+    return f"fragment:{name}:{digest}"
+
+
+def url_timeout():
+    """How long a fragment with download URLs in it may be cached"""
+    return min(settings.FRAGMENT_CACHE_TIMEOUT, settings.DOWNLOAD_URL_CACHE_MARGIN)
+
+
+def get_fragments(keys, render, timeout=None):
+    """
+    Returns {item: HTML} for {item: cache key}, with one get_many/set_many round trip.
+    render(items) renders the items that aren't cached, as {item: HTML}.
+    """
+    if not settings.SHARED_CACHE:
+        return {item: mark_safe(html) for item, html in render(list(keys)).items()}
+
+    cached = cache.get_many(keys.values())
+    missing = [item for item, key in keys.items() if key not in cached]
+    rendered = render(missing) if missing else {}
+    if rendered:
+        cache.set_many(
+            {keys[item]: html for item, html in rendered.items()},
+            settings.FRAGMENT_CACHE_TIMEOUT if timeout is None else timeout,
+        )
+    record(hits=len(keys) - len(missing), misses=len(missing))
+
+    fragments = {}
+    for item, key in keys.items():
+        html = cached[key] if key in cached else rendered.get(item)
+        if html is not None:
+            fragments[item] = mark_safe(html)
+    return fragments
+
+
+def get_fragment(key, render, timeout=None):
+    """The HTML cached under key, or render()'s, cached"""
+    return get_fragments({key: key}, lambda missing: {key: render()}, timeout)[key]
+
+
+def project_cards(project_ids, template):
+    """The project cards rendered with template, in the order of project_ids"""
+    versions = get_versions(project_ids)
+    keys = {project_id: fragment_key(template, project_id, versions[project_id]) for project_id in project_ids}
+
+    def render(missing):
+        projects = Project.objects.filter(id__in=missing).with_counts()
+        return {project.id: render_to_string(template, {'project': project}) for project in projects}
+
+    cards = get_fragments(keys, render)
+    # A project deleted since its id was read has no card
+    return [cards[project_id] for project_id in project_ids if project_id in cards]
+
+
+def record(hits=0, misses=0):
+    for stat, count in (('hits', hits), ('misses', misses)):
+        if not count:
+            continue
+        key = f"fragment-cache:{stat}"
+        try:
+            cache.incr(key, count)
+        except ValueError:
+            cache.add(key, 0, timeout=None)
+            cache.incr(key, count)
+
+
+def stats():
+    values = cache.get_many([f"fragment-cache:{stat}" for stat in STATS])
+    stats = {stat: values.get(f"fragment-cache:{stat}", 0) for stat in STATS}
+    reads = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / reads if reads else 0.0
+    return stats
@@ -0,0 +1,38 @@
+"""
+Clearing out invitations that expired without being accepted.
+
+Left alone they pile up, and since Invitation.email is unique, each one blocks
+a new invitation to the same address. purge_expired() deletes them once they
+are INVITATION_RETENTION_DAYS past expiry, oldest first, as a series of small
+DELETEs by primary key. Each commits on its own, so rows are only locked for
+one batch at a time and the table stays writable while a large backlog drains.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Invitation
+
+
+def stale_invitations(retention_days=None):
+    """Unaccepted invitations that expired more than retention_days ago"""
+    if retention_days is None:
+        retention_days = settings.INVITATION_RETENTION_DAYS
+    cutoff = timezone.now() - timedelta(days=retention_days)
+    return Invitation.objects.filter(is_accepted=False, expires_at__lt=cutoff)
+
+
+def purge_expired(retention_days=None, batch_size=None, on_progress=None):
+    """Delete stale invitations in batches. Returns the number deleted."""
+    batch_size = batch_size or settings.INVITATION_PURGE_BATCH_SIZE
+    # Walks the expires_at index; each batch is what's left at the front of it
+    stale = stale_invitations(retention_days).order_by('expires_at').values_list('id', flat=True)
+    purged = 0
+    while batch := list(stale[:batch_size]):
+        # Nothing references invitations, so this is a single DELETE ... WHERE id IN (...)
+        Invitation.objects.filter(id__in=batch).delete()
+        purged += len(batch)
+        if on_progress:
+            on_progress(purged)
+    return purged
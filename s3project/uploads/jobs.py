@@ -0,0 +1,147 @@
+"""
+Background jobs.
+
+Functions registered with @job can be queued with enqueue(). Jobs are rows in the
+Job table; `manage.py runworker` claims and runs them, retrying failures with
+exponential backoff. No broker is needed, so it runs as a plain Heroku worker dyno.
+"""
+import logging
+import threading
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+registry = {}
+
+
+def job(name):
+    """Register a function as a background job. It's called as fn(job, **payload)."""
+    def decorator(fn):
+        registry[name] = fn
+        return fn
+    return decorator
+
+
+def enqueue(name, user=None, max_attempts=None, **payload):
+    """
+    Queue a job for the worker. With JOBS_RUN_IN_THREAD (handy in development)
+    it's run on a thread of the current process instead, once the transaction commits.
+    """
+    if name not in registry:
+        raise KeyError(f"Unknown job: {name}")
+
+    instance = Job.objects.create(
+        name=name,
+        payload=payload,
+        created_by=user,
+        max_attempts=max_attempts or settings.JOBS_MAX_ATTEMPTS,
+    )
+    if settings.JOBS_RUN_IN_THREAD:
+        transaction.on_commit(lambda: start(instance.id))
+    return instance
+
+
+def start(job_id):
+    thread = threading.Thread(target=run_in_thread, args=(job_id,), daemon=True)
+    thread.start()
+    return thread
+
+
+def run_in_thread(job_id):
+    close_old_connections()
+    try:
+        instance = claim('thread', job_id=job_id)
+        if instance is not None:
+            run(instance)
+    finally:
+        connection.close()
+
+
+def claim(worker_name, job_id=None):
+    """
+    Atomically take the next runnable job (or a specific one) and mark it running.
+    Returns None when there's nothing to do.
+
+    On databases with SELECT ... FOR UPDATE SKIP LOCKED (Postgres), concurrent workers
+    skip each other's rows instead of blocking. SQLite has no row locks, but it
+    serializes writes, so there a conditional UPDATE decides which worker wins.
+    """
+    queued = Job.objects.filter(status=Job.Status.QUEUED, run_after__lte=timezone.now())
+    if job_id is not None:
+        queued = queued.filter(id=job_id)
+    queued = queued.order_by('run_after', 'id')
+
+    claimed = {
+        'status': Job.Status.RUNNING,
+        'locked_by': worker_name,
+        'started_at': timezone.now(),
+        'heartbeat_at': timezone.now(),
+        'finished_at': None,
+    }
+
+    with transaction.atomic():
+        if connection.features.has_select_for_update_skip_locked:
+            instance = queued.select_for_update(skip_locked=True).first()
+            if instance is None:
+                return None
+            Job.objects.filter(id=instance.id).update(**claimed)
+        else:
+            for instance in queued[:10]:
+                if Job.objects.filter(id=instance.id, status=Job.Status.QUEUED).update(**claimed):
+                    break
+            else:
+                return None
+
+    instance.refresh_from_db()
+    return instance
+
+
+def run(instance):
+    """Run a claimed job, then mark it done, failed or queued for another attempt"""
+    instance.attempts += 1
+    Job.objects.filter(id=instance.id).update(attempts=instance.attempts)
+
+    try:
+        registry[instance.name](instance, **instance.payload)
+    except Exception:
+        logger.exception("Job %s (%s) failed on attempt %s", instance.id, instance.name, instance.attempts)
+        instance.error = traceback.format_exc()
+        if instance.attempts < instance.max_attempts:
+            backoff = settings.JOBS_RETRY_BACKOFF * 2 ** (instance.attempts - 1)
+            instance.status = Job.Status.QUEUED
+            instance.run_after = timezone.now() + timedelta(seconds=backoff)
+        else:
+            instance.status = Job.Status.FAILED
+    else:
+        instance.status = Job.Status.DONE
+        instance.error = ''
+
+    instance.locked_by = ''
+    instance.finished_at = timezone.now()
+    instance.save(update_fields=['status', 'error', 'run_after', 'locked_by', 'finished_at'])
+
+
+def heartbeat(worker_prefix):
+    """Mark every job held by this worker process as still alive"""
+    return Job.objects.filter(
+        status=Job.Status.RUNNING, locked_by__startswith=worker_prefix
+    ).update(heartbeat_at=timezone.now())
+
+
+def requeue_stale(max_age=None):
+    """
+    Put back jobs whose worker stopped sending heartbeats, e.g. a dyno killed
+    past its shutdown grace period
+    """
+    cutoff = timezone.now() - timedelta(seconds=max_age or settings.JOBS_STALE_AFTER)
+    return Job.objects.filter(status=Job.Status.RUNNING, heartbeat_at__lt=cutoff).update(
+        status=Job.Status.QUEUED,
+        locked_by='',
+    )
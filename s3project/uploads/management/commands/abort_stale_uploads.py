@@ -0,0 +1,40 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from uploads.s3 import abort_multipart_upload, iter_multipart_uploads
+
+
+class Command(BaseCommand):
+    help = "Abort multipart uploads under projects/ that were started too long ago"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--hours',
+            type=int,
+            default=settings.MULTIPART_UPLOAD_STALE_HOURS,
+            help="Abort uploads initiated more than this many hours ago",
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help="Only list the uploads that would be aborted",
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(hours=options['hours'])
+        aborted = 0
+
+        for upload in iter_multipart_uploads('projects/'):
+            if upload['Initiated'] >= cutoff:
+                continue
+
+            self.stdout.write(f"{upload['Key']} (started {upload['Initiated']:%Y-%m-%d %H:%M})")
+            if not options['dry_run']:
+                abort_multipart_upload(upload['Key'], upload['UploadId'])
+            aborted += 1
+
+        verb = "Would abort" if options['dry_run'] else "Aborted"
+        self.stdout.write(self.style.SUCCESS(f"{verb} {aborted} stale upload(s)."))
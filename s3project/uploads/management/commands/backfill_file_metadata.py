@@ -0,0 +1,62 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from uploads.fragments import bump_version
+from uploads.models import UploadedFile
+from uploads.s3 import get_object_metadata, head_object
+
+
+class Command(BaseCommand):
+    help = "Fill in size, content type and checksum for files uploaded before they were recorded"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help="Rows read and updated at a time",
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=10,
+            help="HEAD requests in flight (keep within S3_MAX_POOL_CONNECTIONS)",
+        )
+
+    def handle(self, *args, **options):
+        pending = UploadedFile.objects.filter(size__isnull=True).select_related('blob').order_by('id')
+        updated = missing = 0
+        last_id = 0
+
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            while True:
+                # Keyset batches, so rows left unfilled (missing objects) aren't read again
+                files = list(pending.filter(id__gt=last_id)[:options['batch_size']])
+                if not files:
+                    break
+                last_id = files[-1].id
+
+                heads = executor.map(lambda file: head_object(file.file.name, checksum=True), files)
+                filled = []
+                for file, head in zip(files, heads):
+                    if head is None:
+                        self.stderr.write(f"Missing object for file {file.id}: {file.file.name}")
+                        missing += 1
+                        continue
+                    for field, value in get_object_metadata(head).items():
+                        setattr(file, field, value)
+                    if file.blob:
+                        file.checksum = file.blob.sha256
+                    filled.append(file)
+
+                UploadedFile.objects.bulk_update(filled, ['size', 'content_type', 'checksum'])
+                # bulk_update() sends no post_save; pages show the sizes
+                for project_id in {file.project_id for file in filled}:
+                    bump_version(project_id)
+                updated += len(filled)
+                self.stdout.write(f"Updated {updated} file(s)...")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Backfilled {updated} file(s); {missing} had no object in storage."
+        ))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from uploads.benchmarks import BENCHMARKS
+
+
+class Command(BaseCommand):
+    help = "Run one of the uploads app's performance benchmarks"
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', choices=sorted(BENCHMARKS))
+        parser.add_argument(
+            '--count',
+            type=int,
+            default=None,
+            help="How many items (files, requests, rows) the benchmark works through",
+        )
+        parser.add_argument(
+            '--url',
+            help="Base URL of a running server, for load tests",
+        )
+
+    def handle(self, *args, **options):
+        BENCHMARKS[options['name']](self.stdout, options)
@@ -0,0 +1,50 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from uploads.invitations import purge_expired, stale_invitations
+from uploads.jobs import enqueue
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete invitations that expired without being accepted, in small batches. "
+        "Meant to run periodically, e.g. daily from a scheduler."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=settings.INVITATION_RETENTION_DAYS,
+            help="Only delete invitations that expired more than this many days ago",
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=settings.INVITATION_PURGE_BATCH_SIZE,
+            help="Rows deleted per statement",
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help="Only count the invitations that would be deleted",
+        )
+        parser.add_argument(
+            '--enqueue',
+            action='store_true',
+            help="Queue the purge as a background job instead of running it here",
+        )
+
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            count = stale_invitations(options['days']).count()
+            self.stdout.write(self.style.SUCCESS(f"Would delete {count} expired invitation(s)."))
+            return
+
+        if options['enqueue']:
+            job = enqueue('purge_invitations', retention_days=options['days'])
+            self.stdout.write(self.style.SUCCESS(f"Queued job {job.id}."))
+            return
+
+        purged = purge_expired(options['days'], options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Deleted {purged} expired invitation(s)."))
@@ -0,0 +1,74 @@
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+from django.utils import timezone
+
+from uploads.reconcile import BLOBS_PREFIX, PROJECTS_PREFIX, project_prefixes, reconcile_prefix
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the objects under projects/ and blobs/ with the database, and report "
+        "(or with --repair, delete) objects without rows and rows without objects"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--repair',
+            action='store_true',
+            help="Delete orphaned objects from S3 and rows whose object is missing",
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help="Reconcile this many project folders at once (default: one pass over projects/)",
+        )
+        parser.add_argument(
+            '--min-age',
+            type=int,
+            default=24,
+            help="Ignore objects and rows from the last this many hours, as their upload may be in progress",
+        )
+        parser.add_argument(
+            '--skip-blobs',
+            action='store_true',
+            help="Don't reconcile content-addressed blobs",
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(hours=options['min_age'])
+        lock = threading.Lock()
+        totals = Counter()
+
+        def report(kind, key):
+            with lock:
+                self.stdout.write(f"{kind}: {key}")
+
+        def reconcile(prefix):
+            close_old_connections()
+            try:
+                return reconcile_prefix(prefix, cutoff, repair=options['repair'], report=report)
+            finally:
+                connection.close()
+
+        if options['workers'] > 1:
+            # Each project folder is a separate, smaller merge, run on its own thread
+            with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+                for stats in executor.map(reconcile, project_prefixes()):
+                    totals.update(stats)
+        else:
+            totals.update(reconcile_prefix(PROJECTS_PREFIX, cutoff, repair=options['repair'], report=report))
+
+        if not options['skip_blobs']:
+            totals.update(reconcile_prefix(BLOBS_PREFIX, cutoff, repair=options['repair'], report=report))
+
+        verb = "Repaired" if options['repair'] else "Found"
+        self.stdout.write(self.style.SUCCESS(
+            f"Checked {totals['checked']} key(s). {verb} {totals['orphaned_objects']} orphaned object(s) "
+            f"and {totals['missing_objects']} missing object(s); skipped {totals['recent']} recent key(s)."
+        ))
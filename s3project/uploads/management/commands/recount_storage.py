@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from uploads.jobs import enqueue
+from uploads.quotas import recount_usage
+
+
+class Command(BaseCommand):
+    help = (
+        "Correct drift in the project and user storage counters that quotas are checked "
+        "against. Meant to run periodically, e.g. daily from a scheduler."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--enqueue',
+            action='store_true',
+            help="Queue the recount as a background job instead of running it here",
+        )
+
+    def handle(self, *args, **options):
+        if options['enqueue']:
+            job = enqueue('recount_storage')
+            self.stdout.write(self.style.SUCCESS(f"Queued job {job.id}."))
+            return
+
+        recount_usage()
+        self.stdout.write(self.style.SUCCESS("Storage counters recounted."))
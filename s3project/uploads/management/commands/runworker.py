@@ -0,0 +1,84 @@
+import os
+import signal
+import socket
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+
+from uploads import jobs
+
+
+class Command(BaseCommand):
+    help = "Run background jobs from the database queue"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=settings.JOBS_CONCURRENCY,
+            help="Number of jobs to run at the same time",
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=settings.JOBS_POLL_INTERVAL,
+            help="Seconds to wait before checking again when the queue is empty",
+        )
+        parser.add_argument(
+            '--burst',
+            action='store_true',
+            help="Exit once the queue is empty instead of waiting for more jobs",
+        )
+
+    def handle(self, *args, **options):
+        self.stopping = threading.Event()
+        self.burst = options['burst']
+        self.poll_interval = options['poll_interval']
+        self.prefix = f"{socket.gethostname()}:{os.getpid()}:"
+
+        # Heroku sends SIGTERM on restarts; finish the running jobs, then exit
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        threads = [
+            threading.Thread(target=self.work, args=(f"{self.prefix}{i}",), daemon=True)
+            for i in range(options['concurrency'])
+        ]
+        for thread in threads:
+            thread.start()
+        self.stdout.write(f"Worker {self.prefix} started with {len(threads)} thread(s).")
+
+        # The main thread keeps running jobs alive and recovers ones whose worker died
+        while any(thread.is_alive() for thread in threads):
+            jobs.heartbeat(self.prefix)
+            requeued = jobs.requeue_stale()
+            if requeued:
+                self.stdout.write(f"Requeued {requeued} stale job(s).")
+            close_old_connections()
+            for thread in threads:
+                thread.join(timeout=settings.JOBS_HEARTBEAT_INTERVAL / len(threads))
+
+        self.stdout.write("Worker stopped.")
+
+    def stop(self, signum, frame):
+        self.stdout.write("Shutting down after the running jobs finish...")
+        self.stopping.set()
+
+    def work(self, worker_name):
+        try:
+            while not self.stopping.is_set():
+                close_old_connections()
+                job = jobs.claim(worker_name)
+                if job is None:
+                    if self.burst:
+                        return
+                    self.stopping.wait(self.poll_interval)
+                    continue
+
+                self.stdout.write(f"[{worker_name}] Running job {job.id} ({job.name}), attempt {job.attempts + 1}")
+                jobs.run(job)
+                self.stdout.write(f"[{worker_name}] Job {job.id} {job.get_status_display().lower()}")
+        finally:
+            connection.close()
@@ -0,0 +1,126 @@
+"""
+Adding and removing project members in bulk.
+
+Adds are a single bulk_create(ignore_conflicts=True), so users who are already
+members are skipped by the database rather than checked one by one. bulk_create()
+doesn't send post_save, so add_members() invalidates the cached memberships of the
+users and bumps the project's fragment version itself; deletes still go through
+the post_delete receivers in signals.py.
+
+The user picker searches usernames and emails by prefix with istartswith, backed by
+the indexes from migration 0011_user_prefix_indexes.
+"""
+import csv
+import io
+import re
+from functools import partial
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.functions import Lower
+
+from .fragments import bump_version
+from .models import ProjectMembership
+from .permissions import invalidate_memberships
+
+
+def add_members(project, user_ids, added_by):
+    """Make the users members of the project. Returns how many weren't members already."""
+    user_ids = set(user_ids)
+    existing = set(
+        ProjectMembership.objects.filter(project=project, user_id__in=user_ids).values_list('user_id', flat=True)
+    )
+    new_ids = user_ids - existing
+    ProjectMembership.objects.bulk_create(
+        [ProjectMembership(project=project, user_id=user_id, added_by=added_by) for user_id in new_ids],
+        ignore_conflicts=True,
+    )
+    # bulk_create() sends no post_save, so do what the receivers in signals.py would
+    invalidate_memberships(*new_ids)
+    if new_ids:
+        transaction.on_commit(partial(bump_version, project.id))
+    return len(new_ids)
+
+
+def remove_members(project, user_ids):
+    """Remove the users from the project, except its creator. Returns how many were removed."""
+    removed, _ = ProjectMembership.objects.filter(
+        project=project, user_id__in=user_ids,
+    ).exclude(user_id=project.created_by_id).delete()
+    return removed
+
+
+EMAIL_RE = re.compile(r'[^\s<>,;"]+@[^\s<>,;"]+')
+
+# Header cells naming the column a CSV import reads, most preferred first
+IDENTIFIER_COLUMNS = ('email', 'e-mail', 'username', 'user')
+
+
+def parse_identifier(entry):
+    """An entry's email if it has one ("Jane Doe <jane@example.com>"), otherwise the entry as a whole"""
+    email = EMAIL_RE.search(entry)
+    return (email.group() if email else entry.strip().strip('"')).lower()
+
+
+def parse_identifiers(text):
+    """
+    Lowercased emails or usernames pasted one per line or separated by commas or
+    semicolons. Entries are never split on spaces, so a name ("Admin User") is
+    looked up as one identifier that matches nobody, not as users admin and user.
+    """
+    return [identifier for identifier in map(parse_identifier, re.split(r'[,;\r\n]+', text)) if identifier]
+
+
+def parse_csv(text):
+    """
+    Lowercased emails or usernames from a CSV's email or username column, found
+    by its header row; no other column is read. Each row gives its email if the
+    CSV has both. Raises ValueError if there's no such column.
+    """
+    rows = csv.reader(io.StringIO(text))
+    header = [cell.strip().lower() for cell in next(rows, [])]
+    columns = sorted(
+        (index for index, cell in enumerate(header) if cell in IDENTIFIER_COLUMNS),
+        key=lambda index: IDENTIFIER_COLUMNS.index(header[index]),
+    )
+    if not columns:
+        raise ValueError("The CSV file needs an email or username column.")
+
+    identifiers = []
+    for row in rows:
+        cells = (parse_identifier(row[index]) for index in columns if index < len(row))
+        identifier = next((cell for cell in cells if cell), None)
+        if identifier:
+            identifiers.append(identifier)
+    return identifiers
+
+
+def resolve_users(identifiers):
+    """
+    Active users matching the emails or usernames (case-insensitively), in one query.
+    Returns (users, identifiers that matched nobody).
+    """
+    identifiers = list(dict.fromkeys(identifiers))
+    if not identifiers:
+        return [], []
+    users = list(
+        User.objects.filter(is_active=True)
+        .annotate(email_lower=Lower('email'), username_lower=Lower('username'))
+        .filter(Q(email_lower__in=identifiers) | Q(username_lower__in=identifiers))
+    )
+    found = {user.email_lower for user in users} | {user.username_lower for user in users}
+    return users, [identifier for identifier in identifiers if identifier not in found]
+
+
+def search_users(query, exclude_project=None, limit=None):
+    """Active users whose username or email starts with the query, for the member picker"""
+    users = User.objects.filter(
+        Q(username__istartswith=query) | Q(email__istartswith=query), is_active=True,
+    )
+    if exclude_project is not None:
+        users = users.exclude(
+            id__in=ProjectMembership.objects.filter(project=exclude_project).values('user_id')
+        )
+    return users.order_by('username')[:limit or settings.USER_SEARCH_LIMIT]
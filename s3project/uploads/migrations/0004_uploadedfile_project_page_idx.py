@@ -0,0 +1,19 @@
+# Generated by Django 5.2.1 on 2026-10-18 12:10
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uploads', '0003_remove_uploadedfile_title'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='uploadedfile',
+            index=models.Index(fields=['project', '-uploaded_at', '-id'], name='uploads_file_project_page_idx'),
+        ),
+    ]
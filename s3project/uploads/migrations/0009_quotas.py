@@ -0,0 +1,68 @@
+# Generated by Django 5.2.1 on 2026-10-18 12:27
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def count_usage(apps, schema_editor):
+    Project = apps.get_model('uploads', 'Project')
+    UploadedFile = apps.get_model('uploads', 'UploadedFile')
+    UserQuota = apps.get_model('uploads', 'UserQuota')
+
+    users = UploadedFile.objects.order_by().values_list('user_id', flat=True).distinct()
+    UserQuota.objects.bulk_create([UserQuota(user_id=user_id) for user_id in users])
+
+    for model, files in (
+        (Project, UploadedFile.objects.filter(project=OuterRef('pk')).order_by().values('project')),
+        (UserQuota, UploadedFile.objects.filter(user=OuterRef('user')).order_by().values('user')),
+    ):
+        model.objects.update(
+            used_bytes=Coalesce(Subquery(files.annotate(total=Sum('size')).values('total')), 0),
+            used_files=Coalesce(Subquery(files.annotate(total=Count('id')).values('total')), 0),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uploads', '0008_uploadedfile_metadata'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='max_bytes',
+            field=models.BigIntegerField(blank=True, help_text='Storage limit in bytes', null=True),
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='max_files',
+            field=models.IntegerField(blank=True, help_text='Limit on the number of files', null=True),
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='used_bytes',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='project',
+            name='used_files',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='UserQuota',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('max_bytes', models.BigIntegerField(blank=True, help_text='Storage limit in bytes', null=True)),
+                ('max_files', models.IntegerField(blank=True, help_text='Limit on the number of files', null=True)),
+                ('used_bytes', models.BigIntegerField(default=0)),
+                ('used_files', models.IntegerField(default=0)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='quota', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.RunPython(count_usage, migrations.RunPython.noop),
+    ]
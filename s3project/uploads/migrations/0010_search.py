@@ -0,0 +1,71 @@
+from django.db import migrations
+
+# Expression indexes for uploads.search. The expressions there must stay identical.
+POSTGRES_FORWARD = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS uploads_file_name_trgm_idx ON uploads_uploadedfile "
+    "USING gin ((lower(COALESCE(NULLIF(original_filename, ''), regexp_replace(file, '^.*/', '')))) gin_trgm_ops)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS uploads_project_search_idx ON uploads_project "
+    "USING gin ((to_tsvector('simple', name || ' ' || description)))",
+]
+POSTGRES_BACKWARD = [
+    "DROP INDEX CONCURRENTLY IF EXISTS uploads_file_name_trgm_idx",
+    "DROP INDEX CONCURRENTLY IF EXISTS uploads_project_search_idx",
+]
+
+# SQLite: FTS5 tables kept in sync by triggers, with the file or project id as rowid so the
+# triggers update them without scanning. The file name is original_filename, or whatever
+# follows the last / of the key.
+FILE_NAME = (
+    "COALESCE(NULLIF({row}.original_filename, ''), "
+    "replace({row}.file, rtrim({row}.file, replace({row}.file, '/', '')), ''))"
+)
+PROJECT_TEXT = "{row}.name || ' ' || {row}.description"
+
+
+def sqlite_index(table, source, text, columns):
+    """Statements creating a trigram FTS5 table over `source`, its triggers, and its initial rows"""
+    insert = f"INSERT INTO {table} (rowid, text) VALUES (new.id, {text.format(row='new')})"
+    delete = f"DELETE FROM {table} WHERE rowid = old.id"
+    return [
+        f"CREATE VIRTUAL TABLE {table} USING fts5(text, tokenize='trigram')",
+        f"CREATE TRIGGER {table}_insert AFTER INSERT ON {source} BEGIN {insert}; END",
+        f"CREATE TRIGGER {table}_update AFTER UPDATE OF {columns} ON {source} BEGIN {delete}; {insert}; END",
+        f"CREATE TRIGGER {table}_delete AFTER DELETE ON {source} BEGIN {delete}; END",
+        f"INSERT INTO {table} (rowid, text) SELECT id, {text.format(row=source)} FROM {source}",
+    ]
+
+
+SQLITE_FORWARD = (
+    sqlite_index('uploads_search_file', 'uploads_uploadedfile', FILE_NAME, 'file, original_filename')
+    + sqlite_index('uploads_search_project', 'uploads_project', PROJECT_TEXT, 'name, description')
+)
+SQLITE_BACKWARD = [
+    f"DROP {kind} IF EXISTS {table}{suffix}"
+    for table in ('uploads_search_file', 'uploads_search_project')
+    for kind, suffix in (('TRIGGER', '_insert'), ('TRIGGER', '_update'), ('TRIGGER', '_delete'), ('TABLE', ''))
+]
+
+
+def run_for_vendor(postgres, sqlite):
+    def run(apps, schema_editor):
+        statements = {'postgresql': postgres, 'sqlite': sqlite}.get(schema_editor.connection.vendor, [])
+        for sql in statements:
+            schema_editor.execute(sql, params=None)
+    return run
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY can't run in a transaction, and doesn't block writes
+    atomic = False
+
+    dependencies = [
+        ('uploads', '0009_quotas'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run_for_vendor(POSTGRES_FORWARD, SQLITE_FORWARD),
+            run_for_vendor(POSTGRES_BACKWARD, SQLITE_BACKWARD),
+        ),
+    ]
@@ -0,0 +1,49 @@
+from django.db import migrations
+
+# Prefix indexes for the member picker's istartswith lookups (uploads.members.search_users).
+# Postgres: Django compiles istartswith to UPPER("col"::text) LIKE UPPER(...), so the index is
+# on that exact expression, with text_pattern_ops so LIKE 'abc%' can use it.
+POSTGRES_FORWARD = [
+    f"CREATE INDEX CONCURRENTLY IF NOT EXISTS uploads_user_{column}_prefix_idx ON auth_user "
+    f"((UPPER({column}::text)) text_pattern_ops)"
+    for column in ('username', 'email')
+]
+POSTGRES_BACKWARD = [
+    f"DROP INDEX CONCURRENTLY IF EXISTS uploads_user_{column}_prefix_idx"
+    for column in ('username', 'email')
+]
+
+# SQLite: its LIKE is case-insensitive already, and only uses an index with NOCASE collation
+SQLITE_FORWARD = [
+    f"CREATE INDEX IF NOT EXISTS uploads_user_{column}_prefix_idx ON auth_user ({column} COLLATE NOCASE)"
+    for column in ('username', 'email')
+]
+SQLITE_BACKWARD = [
+    f"DROP INDEX IF EXISTS uploads_user_{column}_prefix_idx"
+    for column in ('username', 'email')
+]
+
+
+def run_for_vendor(postgres, sqlite):
+    def run(apps, schema_editor):
+        statements = {'postgresql': postgres, 'sqlite': sqlite}.get(schema_editor.connection.vendor, [])
+        for sql in statements:
+            schema_editor.execute(sql, params=None)
+    return run
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY can't run in a transaction, and doesn't block writes
+    atomic = False
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('uploads', '0010_search'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run_for_vendor(POSTGRES_FORWARD, SQLITE_FORWARD),
+            run_for_vendor(POSTGRES_BACKWARD, SQLITE_BACKWARD),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.1 on 2026-10-18 12:54
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uploads', '0012_invitation_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuditEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('action', models.CharField(choices=[('view', 'View'), ('upload', 'Upload'), ('download', 'Download'), ('delete', 'Delete'), ('denied', 'Access denied')], max_length=20)),
+                ('file_id', models.BigIntegerField(null=True)),
+                ('filename', models.CharField(blank=True, max_length=255)),
+                ('ip_address', models.GenericIPAddressField(null=True)),
+                ('project', models.ForeignKey(db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='uploads.project')),
+                ('user', models.ForeignKey(db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['-created_at', '-id'], name='uploads_audit_page_idx'), models.Index(fields=['user', '-created_at', '-id'], name='uploads_audit_user_idx'), models.Index(fields=['project', '-created_at', '-id'], name='uploads_audit_project_idx'), models.Index(fields=['action', '-created_at', '-id'], name='uploads_audit_action_idx')],
+            },
+        ),
+    ]
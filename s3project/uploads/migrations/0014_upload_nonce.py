@@ -0,0 +1,45 @@
+# Generated by Django 5.2.1 on 2026-10-18 13:33
+
+from importlib import import_module
+
+import uploads.models
+from django.db import migrations, models
+
+search = import_module('uploads.migrations.0010_search')
+
+# Both field changes make SQLite rebuild uploads_uploadedfile, which drops the search index's
+# triggers on it (see uploads.search), so they're created again afterwards, either way.
+SQLITE_TRIGGERS = [
+    sql for sql in search.sqlite_index(
+        'uploads_search_file', 'uploads_uploadedfile', search.FILE_NAME, 'file, original_filename'
+    )
+    if sql.startswith('CREATE TRIGGER')
+]
+
+
+def recreate_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        for sql in SQLITE_TRIGGERS:
+            schema_editor.execute(sql, params=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('uploads', '0013_audit_event'),
+    ]
+
+    operations = [
+        migrations.RunPython(migrations.RunPython.noop, recreate_triggers),
+        migrations.AddField(
+            model_name='uploadedfile',
+            name='upload_nonce',
+            field=models.CharField(blank=True, editable=False, max_length=32, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='uploadedfile',
+            name='file',
+            field=models.FileField(max_length=255, upload_to=uploads.models.get_project_upload_path),
+        ),
+        migrations.RunPython(recreate_triggers, migrations.RunPython.noop),
+    ]
@@ -1,15 +1,50 @@
 import uuid
 import os
 from django.db import models
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import User
 from django.utils import timezone
 from datetime import timedelta
 
+class ProjectQuerySet(models.QuerySet):
+    def with_counts(self):
+        """
+        Annotate member and file counts and fetch the creator in the same query
+        """
+        members = ProjectMembership.objects.filter(
+            project=models.OuterRef('pk')
+        ).order_by().values('project').annotate(total=models.Count('pk')).values('total')
+        files = UploadedFile.objects.filter(
+            project=models.OuterRef('pk')
+        ).order_by().values('project')
+
+        return self.select_related('created_by').annotate(
+            num_members=Coalesce(models.Subquery(members), 0),
+            num_files=Coalesce(models.Subquery(files.annotate(total=models.Count('pk')).values('total')), 0),
+            total_bytes=Coalesce(models.Subquery(files.annotate(total=models.Sum('size')).values('total')), 0),
+        )
+
+    def for_user(self, user):
+        """Projects a user can see: all of them for superusers, otherwise their memberships"""
+        if user.is_superuser:
+            return self.all()
+        return self.filter(
+            id__in=ProjectMembership.objects.filter(user=user).values('project_id')
+        )
+
 class Project(models.Model):
     name = models.CharField(max_length=255)
     description = models.TextField(blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     created_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='created_projects')
+    # Storage quota; blank falls back to PROJECT_MAX_BYTES / PROJECT_MAX_FILES
+    max_bytes = models.BigIntegerField(null=True, blank=True, help_text="Storage limit in bytes")
+    max_files = models.IntegerField(null=True, blank=True, help_text="Limit on the number of files")
+    # Running totals, kept by uploads.quotas and corrected by `manage.py recount_storage`
+    used_bytes = models.BigIntegerField(default=0)
+    used_files = models.IntegerField(default=0)
+
+    objects = ProjectQuerySet.as_manager()
 
     def __str__(self):
         return self.name
@@ -23,8 +58,24 @@ class Project(models.Model):
     
     @property
     def member_count(self):
+        # Use the count annotated by with_counts() when available
+        if hasattr(self, 'num_members'):
+            return self.num_members
         return self.projectmembership_set.count()
 
+    @property
+    def file_count(self):
+        if hasattr(self, 'num_files'):
+            return self.num_files
+        return self.files.count()
+
+    @property
+    def total_size(self):
+        """Bytes stored in the project, from one aggregate over the recorded file sizes"""
+        if hasattr(self, 'total_bytes'):
+            return self.total_bytes
+        return self.files.aggregate(total=models.Sum('size'))['total'] or 0
+
 class ProjectMembership(models.Model):
     project = models.ForeignKey(Project, on_delete=models.CASCADE)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -37,7 +88,33 @@ class ProjectMembership(models.Model):
     def __str__(self):
         return f"{self.user.username} in {self.project.name}"
 
+class InvitationQuerySet(models.QuerySet):
+    def with_status(self):
+        """Annotate each invitation's Invitation.Status as `status`, worked out by the database"""
+        return self.annotate(status=models.Case(
+            models.When(is_accepted=True, then=models.Value(Invitation.Status.ACCEPTED)),
+            models.When(expires_at__lt=timezone.now(), then=models.Value(Invitation.Status.EXPIRED)),
+            default=models.Value(Invitation.Status.PENDING),
+            output_field=models.CharField(),
+        ))
+
+    def with_status_of(self, status):
+        """
+        Invitations in one Invitation.Status, filtered on the columns rather than the
+        annotation so that the expires_at index can be used
+        """
+        if status == Invitation.Status.ACCEPTED:
+            return self.filter(is_accepted=True)
+        if status == Invitation.Status.EXPIRED:
+            return self.filter(is_accepted=False, expires_at__lt=timezone.now())
+        return self.filter(is_accepted=False, expires_at__gte=timezone.now())
+
 class Invitation(models.Model):
+    class Status(models.TextChoices):
+        PENDING = 'pending', 'Pending'
+        EXPIRED = 'expired', 'Expired'
+        ACCEPTED = 'accepted', 'Accepted'
+
     email = models.EmailField(unique=True)
     token = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
     invited_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_invitations')
@@ -46,6 +123,16 @@ class Invitation(models.Model):
     is_accepted = models.BooleanField(default=False)
     accepted_at = models.DateTimeField(null=True, blank=True)
 
+    objects = InvitationQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Status filters and the purge of expired invitations
+            models.Index(fields=['expires_at'], name='uploads_invitation_expiry_idx'),
+            # Backs the (created_at, id) keyset pagination of the invitation list
+            models.Index(fields=['-created_at', '-id'], name='uploads_invitation_page_idx'),
+        ]
+
     def __str__(self):
         return f"Invitation for {self.email}"
     
@@ -63,30 +150,179 @@ class Invitation(models.Model):
     def is_valid(self):
         return not self.is_accepted and not self.is_expired
 
+class UserQuota(models.Model):
+    """
+    A user's storage across all their projects, and their own limits.
+    Blank limits fall back to USER_MAX_BYTES / USER_MAX_FILES.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='quota')
+    max_bytes = models.BigIntegerField(null=True, blank=True, help_text="Storage limit in bytes")
+    max_files = models.IntegerField(null=True, blank=True, help_text="Limit on the number of files")
+    used_bytes = models.BigIntegerField(default=0)
+    used_files = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"Quota for {self.user.username}"
+
 def get_project_upload_path(instance, filename):
     """
-    Generate upload path for files based on project
+    Generate upload path for files based on project. Each upload gets its own
+    random folder, so two files with the same name never share (and overwrite) a key.
+    """
+    return f"projects/{instance.project.id}/{uuid.uuid4().hex}/{filename}"
+
+class Blob(models.Model):
     """
-    return f"projects/{instance.project.id}/{filename}"
+    A content-addressed S3 object stored once under blobs/<sha256> and shared by
+    every UploadedFile with the same content. ref_count tracks how many files use it;
+    the object is deleted when the last one goes.
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    size = models.BigIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.sha256
+
+    @property
+    def key(self):
+        return get_blob_key(self.sha256)
+
+def get_blob_key(sha256):
+    return f"blobs/{sha256}"
 
 class UploadedFile(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='files')
     project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name='files')
-    file = models.FileField(upload_to=get_project_upload_path)
+    file = models.FileField(upload_to=get_project_upload_path, max_length=255)
+    # Set for content-addressed files, whose key is the blob's rather than the filename
+    blob = models.ForeignKey(Blob, on_delete=models.PROTECT, null=True, blank=True, related_name='files')
+    original_filename = models.CharField(max_length=255, blank=True)
+    # Recorded at upload time (null/blank for older files until `manage.py backfill_file_metadata`)
+    size = models.BigIntegerField(null=True, blank=True)
+    content_type = models.CharField(max_length=255, blank=True)
+    checksum = models.CharField(max_length=64, blank=True)  # hex SHA-256, blank when unknown
     uploaded_at = models.DateTimeField(auto_now_add=True)
+    # The single-use nonce of the direct upload token that recorded the file, so it can't record another
+    upload_nonce = models.CharField(max_length=32, null=True, blank=True, unique=True, editable=False)
 
     def __str__(self):
-        return self.file.name.split('/')[-1] if self.file else 'No file'
+        return self.filename if self.file else 'No file'
 
     @property
     def filename(self):
         """Return just the filename without the path"""
+        if self.original_filename:
+            return self.original_filename
         return self.file.name.split('/')[-1] if self.file else ''
 
     class Meta:
         # Add ordering to show newest files first
         ordering = ['-uploaded_at']
+        # Backs the (uploaded_at, id) keyset pagination of a project's files
+        indexes = [
+            models.Index(fields=['project', '-uploaded_at', '-id'], name='uploads_file_project_page_idx'),
+            models.Index(fields=['project', 'size'], name='uploads_file_project_size_idx'),
+            models.Index(fields=['checksum'], name='uploads_file_checksum_idx'),
+        ]
         # Add permission for viewing only own files
         permissions = [
             ("view_own_files", "Can view only their own files"),
         ]
+
+class Job(models.Model):
+    """
+    A unit of background work, e.g. deleting a project's files from S3
+    """
+    class Status(models.TextChoices):
+        QUEUED = 'queued', 'Queued'
+        RUNNING = 'running', 'Running'
+        DONE = 'done', 'Done'
+        FAILED = 'failed', 'Failed'
+
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=20, choices=Status.choices, default=Status.QUEUED)
+    progress = models.PositiveIntegerField(default=0)
+    total = models.PositiveIntegerField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    # Queued jobs aren't picked up before this time; retries push it back
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=255, blank=True)
+    # Refreshed by the worker while it runs the job, so dead workers can be detected
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='jobs')
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        # Backs the worker's "next runnable job" query
+        indexes = [
+            models.Index(fields=['status', 'run_after'], name='uploads_job_runnable_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} ({self.get_status_display()})"
+
+    def set_progress(self, progress, total=None):
+        """Record progress without touching the rest of the row"""
+        self.progress = progress
+        fields = {'progress': progress}
+        if total is not None:
+            self.total = total
+            fields['total'] = total
+        Job.objects.filter(id=self.id).update(**fields)
+
+    @property
+    def percent_complete(self):
+        if not self.total:
+            return 100 if self.status == self.Status.DONE else 0
+        return min(100, int(100 * self.progress / self.total))
+
+    @property
+    def is_finished(self):
+        return self.status in (self.Status.DONE, self.Status.FAILED)
+
+class AuditEvent(models.Model):
+    """
+    A record of a user viewing, uploading, downloading or deleting something, written
+    in batches by uploads.audit. Events outlive what they refer to: users and projects
+    are referenced without database constraints, and files only by ID and name.
+    """
+    class Action(models.TextChoices):
+        VIEW = 'view', 'View'
+        UPLOAD = 'upload', 'Upload'
+        DOWNLOAD = 'download', 'Download'
+        DELETE = 'delete', 'Delete'
+        DENIED = 'denied', 'Access denied'
+
+    # When it happened, not when the batch was written
+    created_at = models.DateTimeField(default=timezone.now)
+    action = models.CharField(max_length=20, choices=Action.choices)
+    user = models.ForeignKey(
+        User, on_delete=models.DO_NOTHING, db_constraint=False, db_index=False, null=True, related_name='+'
+    )
+    project = models.ForeignKey(
+        Project, on_delete=models.DO_NOTHING, db_constraint=False, db_index=False, null=True, related_name='+'
+    )
+    file_id = models.BigIntegerField(null=True)
+    filename = models.CharField(max_length=255, blank=True)
+    ip_address = models.GenericIPAddressField(null=True)
+
+    class Meta:
+        # Each backs the (created_at, id) keyset pagination of the audit log, unfiltered
+        # or filtered by one column. The foreign keys' own indexes would only slow inserts.
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='uploads_audit_page_idx'),
+            models.Index(fields=['user', '-created_at', '-id'], name='uploads_audit_user_idx'),
+            models.Index(fields=['project', '-created_at', '-id'], name='uploads_audit_project_idx'),
+            models.Index(fields=['action', '-created_at', '-id'], name='uploads_audit_action_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.get_action_display()} by user {self.user_id} at {self.created_at}"
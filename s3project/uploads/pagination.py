@@ -0,0 +1,63 @@
+import base64
+from datetime import datetime
+
+from django.db.models import Q
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def encode_cursor(timestamp, row_id):
+    """
+    Encode a (timestamp, id) position as an opaque cursor
+    """
+    raw = f"{timestamp.isoformat()}|{row_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        timestamp, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except (ValueError, UnicodeError):
+        raise InvalidCursor(cursor)
+
+
+def paginate(queryset, field, cursor=None, page_size=50):
+    """
+    Keyset pagination, newest first by a timestamp field.
+
+    Instead of OFFSET, each page continues strictly after the last (field, id)
+    seen, so deep pages cost the same as the first one. Returns the page and the
+    cursor for the next page, or None on the last page.
+    """
+    queryset = queryset.order_by(f'-{field}', '-id')
+
+    if cursor:
+        timestamp, row_id = decode_cursor(cursor)
+        queryset = queryset.filter(
+            Q(**{f'{field}__lt': timestamp}) | Q(**{field: timestamp, 'id__lt': row_id})
+        )
+
+    # Fetch one extra row to find out whether there's another page
+    rows = list(queryset[:page_size + 1])
+    if len(rows) <= page_size:
+        return rows, None
+    last = rows[page_size - 1]
+    return rows[:page_size], encode_cursor(getattr(last, field), last.id)
+
+
+def paginate_files(queryset, cursor=None, page_size=50):
+    """Files, newest upload first"""
+    return paginate(queryset, 'uploaded_at', cursor, page_size)
+
+
+def paginate_invitations(queryset, cursor=None, page_size=50):
+    """Invitations, newest first"""
+    return paginate(queryset, 'created_at', cursor, page_size)
+
+
+def paginate_audit_events(queryset, cursor=None, page_size=100):
+    """Audit events, most recent first"""
+    return paginate(queryset, 'created_at', cursor, page_size)
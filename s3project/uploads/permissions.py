@@ -0,0 +1,38 @@
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import ProjectMembership
+
+
+def membership_cache_key(user_id):
+    return f"member-projects:{user_id}"
+
+
+def get_member_project_ids(user):
+    """
+    Returns the set of project IDs a user belongs to.
+
+    The set is memoized on the user object, which lives for one request, so access
+    checks are set lookups after the first one. With SHARED_CACHE it's also kept in
+    the Django cache for MEMBERSHIP_CACHE_TIMEOUT seconds; a process-local cache
+    would miss the invalidations done by other workers, so then it's one query
+    per request.
+    """
+    if hasattr(user, '_member_project_ids'):
+        return user._member_project_ids
+
+    key = membership_cache_key(user.id)
+    project_ids = cache.get(key) if settings.SHARED_CACHE else None
+    if project_ids is None:
+        project_ids = set(
+            ProjectMembership.objects.filter(user=user).values_list('project_id', flat=True)
+        )
+        if settings.SHARED_CACHE:
+            cache.set(key, project_ids, settings.MEMBERSHIP_CACHE_TIMEOUT)
+
+    user._member_project_ids = project_ids
+    return project_ids
+
+
+def invalidate_memberships(*user_ids):
+    cache.delete_many([membership_cache_key(user_id) for user_id in user_ids])
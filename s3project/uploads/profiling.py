@@ -0,0 +1,182 @@
+"""
+Opt-in request profiling (PROFILING_ENABLED).
+
+ProfilingMiddleware samples PROFILING_SAMPLE_RATE of requests and records wall
+time, database queries, S3 calls and response size for each into a ring buffer
+of the last PROFILING_BUFFER_SIZE requests, summarized per URL name on the
+superuser-only /profiling/ page. Sampled responses also carry a Server-Timing
+header, which browser dev tools show next to the request.
+
+Queries are timed by a wrapper on every database connection and S3 calls by
+boto3 event hooks on the clients; both only do work while a sampled request is
+in progress. The buffer is per process, so each worker reports on its own requests.
+"""
+import random
+import time
+from collections import defaultdict, deque
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+# The profile of the request being handled, if it's sampled
+current = ContextVar('profile', default=None)
+records = deque(maxlen=settings.PROFILING_BUFFER_SIZE)
+
+
+class Profile:
+    __slots__ = ('start', 'queries', 'query_time', 's3_calls', 's3_time')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.query_time = 0.0
+        self.s3_calls = 0
+        self.s3_time = 0.0
+
+
+def record_query(execute, sql, params, many, context):
+    """Database execute wrapper, installed on each connection as it's created"""
+    profile = current.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile.queries += 1
+        profile.query_time += time.perf_counter() - start
+
+
+def add_query_wrapper(sender, connection, **kwargs):
+    connection.execute_wrappers.append(record_query)
+
+
+def before_s3_call(context, **kwargs):
+    if current.get() is not None:
+        context['profiling_start'] = time.perf_counter()
+
+
+def after_s3_call(context, **kwargs):
+    profile = current.get()
+    start = context.get('profiling_start')
+    if profile is not None and start is not None:
+        profile.s3_calls += 1
+        profile.s3_time += time.perf_counter() - start
+
+
+def instrument(client):
+    """Time the S3 calls a boto3 (or aiobotocore) client makes. Safe to call repeatedly."""
+    if not settings.PROFILING_ENABLED or getattr(client.meta, 'profiled', False):
+        return client
+    client.meta.events.register('before-call.s3', before_s3_call)
+    client.meta.events.register('after-call.s3', after_s3_call)
+    client.meta.events.register('after-call-error.s3', after_s3_call)
+    client.meta.profiled = True
+    return client
+
+
+class ProfilingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = settings.PROFILING_SAMPLE_RATE
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if random.random() >= self.sample_rate:
+            return self.get_response(request)
+
+        token = current.set(Profile())
+        try:
+            self.instrument_storage()
+            response = self.get_response(request)
+            self.finish(request, response, current.get())
+        finally:
+            current.reset(token)
+        return response
+
+    async def __acall__(self, request):
+        if random.random() >= self.sample_rate:
+            return await self.get_response(request)
+
+        token = current.set(Profile())
+        try:
+            # The request's sync code, storage calls included, shares one thread-sensitive
+            # executor thread; instrument that thread's client rather than the event loop's
+            await sync_to_async(self.instrument_storage)()
+            response = await self.get_response(request)
+            self.finish(request, response, current.get())
+        finally:
+            current.reset(token)
+        return response
+
+    def instrument_storage(self):
+        # The storage keeps a client per thread; instrument this thread's
+        connection = getattr(default_storage, 'connection', None)
+        if connection is not None:
+            instrument(connection.meta.client)
+
+    def finish(self, request, response, profile):
+        duration = time.perf_counter() - profile.start
+        if response.streaming:
+            # Only what's known up front; the body is produced after the view returns
+            size = int(response['Content-Length']) if response.has_header('Content-Length') else None
+        else:
+            size = len(response.content)
+
+        match = request.resolver_match
+        records.append({
+            'view': match.view_name if match else 'unresolved',
+            'status': response.status_code,
+            'duration': duration,
+            'queries': profile.queries,
+            'query_time': profile.query_time,
+            's3_calls': profile.s3_calls,
+            's3_time': profile.s3_time,
+            'size': size,
+        })
+
+        response['Server-Timing'] = ', '.join([
+            f'app;dur={1000 * duration:.1f}',
+            f'db;dur={1000 * profile.query_time:.1f};desc="{profile.queries} queries"',
+            f's3;dur={1000 * profile.s3_time:.1f};desc="{profile.s3_calls} calls"',
+        ])
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a sorted list"""
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def summarize():
+    """Per-URL-name statistics over the buffered requests, slowest p95 first"""
+    by_view = defaultdict(list)
+    for record in list(records):
+        by_view[record['view']].append(record)
+
+    rows = []
+    for view, requests in by_view.items():
+        durations = sorted(1000 * r['duration'] for r in requests)
+        sizes = [r['size'] for r in requests if r['size'] is not None]
+        count = len(requests)
+        rows.append({
+            'view': view,
+            'count': count,
+            'p50': percentile(durations, 0.50),
+            'p95': percentile(durations, 0.95),
+            'p99': percentile(durations, 0.99),
+            'queries': sum(r['queries'] for r in requests) / count,
+            'query_time': 1000 * sum(r['query_time'] for r in requests) / count,
+            's3_calls': sum(r['s3_calls'] for r in requests) / count,
+            's3_time': 1000 * sum(r['s3_time'] for r in requests) / count,
+            'size': sum(sizes) / len(sizes) if sizes else None,
+        })
+    return sorted(rows, key=lambda row: row['p95'], reverse=True)
@@ -0,0 +1,133 @@
+"""
+Per-project and per-user storage quotas.
+
+Usage is kept in denormalized counters (Project.used_bytes/used_files and the
+same on UserQuota) so checking a quota is a single row read rather than a sum
+over the project's files. Uploads reserve their size with a conditional UPDATE,
+which only succeeds if the file fits, so concurrent uploads can't overshoot
+together. Deletes release it again. recount_usage() corrects any drift, e.g.
+after reconcile_storage removes rows.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+from .models import Project, UploadedFile, UserQuota
+
+# The Content-Length of a form upload includes the multipart framing around the file
+FORM_OVERHEAD = 16 * 1024
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def has_room(field, default, amount):
+    """
+    Q for rows where `used_<field>` can grow by `amount` without passing `max_<field>`,
+    or `default` for rows without their own limit (None means unlimited)
+    """
+    used, limit = f'used_{field}', f'max_{field}'
+    own = Q(**{f'{limit}__isnull': False, f'{used}__lte': F(limit) - amount})
+    if default is None:
+        return own | Q(**{f'{limit}__isnull': True})
+    return own | Q(**{f'{limit}__isnull': True, f'{used}__lte': default - amount})
+
+
+def fits(used, limit, default, amount):
+    """has_room() for values already read: `limit`, or else `default`, None meaning unlimited"""
+    limit = limit if limit is not None else default
+    return limit is None or used + amount <= limit
+
+
+def quota_targets(project_id, user_id):
+    """(queryset, default byte limit, default file limit, name) for each quota an upload counts against"""
+    return [
+        (Project.objects.filter(id=project_id), settings.PROJECT_MAX_BYTES, settings.PROJECT_MAX_FILES, "the project's"),
+        (UserQuota.objects.filter(user_id=user_id), settings.USER_MAX_BYTES, settings.USER_MAX_FILES, "your"),
+    ]
+
+
+def usage(rows):
+    """
+    (used_bytes, max_bytes, used_files, max_files) for a quota. Users get their
+    UserQuota row on their first reservation; until then they've used nothing.
+    """
+    return rows.values_list('used_bytes', 'max_bytes', 'used_files', 'max_files').first() or (0, None, 0, None)
+
+
+def check_quota(project, user, size, files=1):
+    """
+    Raise QuotaExceeded if `files` more files of `size` bytes wouldn't fit right now.
+    For turning uploads away before their content is transferred; reserve() decides.
+    """
+    for rows, default_bytes, default_files, owner in quota_targets(project.id, user.id):
+        used_bytes, max_bytes, used_files, max_files = usage(rows)
+        if not fits(used_bytes, max_bytes, default_bytes, size) or not fits(used_files, max_files, default_files, files):
+            raise QuotaExceeded(f"This upload would exceed {owner} storage quota.")
+
+
+def remaining_bytes(project, user):
+    """Bytes that can still be uploaded to the project by the user, or None if unlimited"""
+    remaining = []
+    for rows, max_bytes, _, _ in quota_targets(project.id, user.id):
+        used, limit, _, _ = usage(rows)
+        limit = limit if limit is not None else max_bytes
+        if limit is not None:
+            remaining.append(max(0, limit - used))
+    return min(remaining) if remaining else None
+
+
+def reserve(project, user, size, files=1):
+    """
+    Count an upload against the project's and the user's quotas, atomically.
+    Raises QuotaExceeded, changing nothing, if it doesn't fit in either.
+    """
+    with transaction.atomic():
+        # The user's first upload creates their row; checks read a missing one as unused
+        UserQuota.objects.get_or_create(user_id=user.id)
+        for rows, max_bytes, max_files, owner in quota_targets(project.id, user.id):
+            updated = rows.filter(
+                has_room('bytes', max_bytes, size), has_room('files', max_files, files)
+            ).update(used_bytes=F('used_bytes') + size, used_files=F('used_files') + files)
+            if not updated:
+                raise QuotaExceeded(f"This upload would exceed {owner} storage quota.")
+
+
+def release(project_id, user_id, size, files=1):
+    """Give back what a deleted file used"""
+    changes = {'used_bytes': F('used_bytes') - size, 'used_files': F('used_files') - files}
+    with transaction.atomic():
+        Project.objects.filter(id=project_id).update(**changes)
+        UserQuota.objects.filter(user_id=user_id).update(**changes)
+
+
+def release_project(project):
+    """Give back the users' usage for a project that's about to be deleted"""
+    usage = UploadedFile.objects.filter(project=project).order_by().values('user').annotate(
+        size=Coalesce(Sum('size'), 0), files=Count('id'),
+    )
+    with transaction.atomic():
+        for row in usage:
+            UserQuota.objects.filter(user_id=row['user']).update(
+                used_bytes=F('used_bytes') - row['size'], used_files=F('used_files') - row['files'],
+            )
+
+
+def recount_usage():
+    """Recompute every project's and user's counters from the files, one UPDATE each"""
+    users = UploadedFile.objects.order_by().values_list('user_id', flat=True).distinct()
+    UserQuota.objects.bulk_create(
+        [UserQuota(user_id=user_id) for user_id in users.exclude(user__quota__isnull=False)],
+        ignore_conflicts=True,
+    )
+
+    for model, files in (
+        (Project, UploadedFile.objects.filter(project=OuterRef('pk')).order_by().values('project')),
+        (UserQuota, UploadedFile.objects.filter(user=OuterRef('user')).order_by().values('user')),
+    ):
+        model.objects.update(
+            used_bytes=Coalesce(Subquery(files.annotate(total=Sum('size')).values('total')), 0),
+            used_files=Coalesce(Subquery(files.annotate(total=Count('id')).values('total')), 0),
+        )
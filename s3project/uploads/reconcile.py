@@ -0,0 +1,146 @@
+"""
+Reconciling S3 objects with the database, for `manage.py reconcile_storage`.
+
+The object listing and the database rows are both streamed sorted by key and
+merge-joined, so memory use doesn't grow with the number of objects. Keys are
+compared by byte order, which is the order ListObjectsV2 returns them in, so
+Postgres sorts them with the "C" collation.
+"""
+from collections import Counter
+
+from django.db import connection
+from django.db.models.functions import Collate
+
+from .models import Blob, Project, UploadedFile, get_blob_key
+from .s3 import head_object, iter_common_prefixes, iter_objects
+from .tasks import delete_batch
+
+BLOBS_PREFIX = 'blobs/'
+PROJECTS_PREFIX = 'projects/'
+BATCH_SIZE = 1000
+
+
+def ordered_by_bytes(queryset, field):
+    if connection.vendor == 'postgresql':
+        return queryset.order_by(Collate(field, 'C'))
+    # SQLite compares text with memcmp(), which is byte order already
+    return queryset.order_by(field)
+
+
+def iter_file_rows(prefix):
+    """Yields (key, file id, uploaded at) for UploadedFile rows stored under a prefix"""
+    files = UploadedFile.objects.filter(file__startswith=prefix)
+    rows = ordered_by_bytes(files, 'file').values_list('file', 'id', 'uploaded_at')
+    return rows.iterator(chunk_size=BATCH_SIZE)
+
+
+def iter_blob_rows():
+    """Yields (key, blob id, created at) for Blob rows; keys sort the same as their hashes"""
+    blobs = ordered_by_bytes(Blob.objects.all(), 'sha256').values_list('sha256', 'id', 'created_at')
+    for sha256, blob_id, created_at in blobs.iterator(chunk_size=BATCH_SIZE):
+        yield get_blob_key(sha256), blob_id, created_at
+
+
+def merge_join(objects, rows):
+    """
+    Joins S3 objects with (key, ...) rows, both sorted by key.
+    Yields (key, object or None, [rows]) for every key on either side.
+    """
+    objects = iter(objects)
+    rows = iter(rows)
+    obj = next(objects, None)
+    row = next(rows, None)
+
+    while obj is not None or row is not None:
+        if row is None or (obj is not None and obj['Key'] < row[0]):
+            yield obj['Key'], obj, []
+            obj = next(objects, None)
+            continue
+
+        key = row[0]
+        matched = []
+        while row is not None and row[0] == key:
+            matched.append(row)
+            row = next(rows, None)
+
+        if obj is not None and obj['Key'] == key:
+            yield key, obj, matched
+            obj = next(objects, None)
+        else:
+            yield key, None, matched
+
+
+def reconcile_prefix(prefix, cutoff, repair=False, report=None):
+    """
+    Compare the objects under a prefix with their rows, and return a Counter of
+    what was found.
+
+    Objects without a row are orphans, and rows without an object are missing,
+    unless modified or created after `cutoff` (an upload may still be
+    completing). With repair, orphans are deleted from S3 and missing rows from
+    the database, in batches; a missing row is only deleted if HEAD confirms its
+    object is still not there, as it may have arrived since the listing.
+    `report(kind, key)` is called for each problem.
+    """
+    is_blobs = prefix.startswith(BLOBS_PREFIX)
+    rows = iter_blob_rows() if is_blobs else iter_file_rows(prefix)
+    stats = Counter()
+    orphans = []
+    missing = []
+
+    def delete_missing():
+        ids = [row_id for key, row_ids in missing if head_object(key) is None for row_id in row_ids]
+        if is_blobs:
+            # The files pointing at a lost blob have lost their content too
+            UploadedFile.objects.filter(blob_id__in=ids).delete()
+            Blob.objects.filter(id__in=ids).delete()
+        else:
+            UploadedFile.objects.filter(id__in=ids).delete()
+        missing.clear()
+
+    for key, obj, matched in merge_join(iter_objects(prefix), rows):
+        stats['checked'] += 1
+        if obj is not None and matched:
+            continue
+
+        if obj is not None:
+            if obj['LastModified'] > cutoff:
+                stats['recent'] += 1
+                continue
+            stats['orphaned_objects'] += 1
+            if report:
+                report('orphaned object', key)
+            if repair:
+                orphans.append(key)
+                if len(orphans) >= BATCH_SIZE:
+                    delete_batch(orphans)
+                    orphans = []
+        else:
+            ids = [row_id for _, row_id, created_at in matched if created_at <= cutoff]
+            if not ids:
+                stats['recent'] += 1
+                continue
+            stats['missing_objects'] += 1
+            if report:
+                report('missing object', key)
+            if repair:
+                missing.append((key, ids))
+                if len(missing) >= BATCH_SIZE:
+                    delete_missing()
+
+    if orphans:
+        delete_batch(orphans)
+    if missing:
+        delete_missing()
+    return stats
+
+
+def project_prefixes():
+    """
+    The project folders to reconcile one by one: those in the bucket, plus those of
+    projects in the database (whose objects may all be missing)
+    """
+    prefixes = set(iter_common_prefixes(PROJECTS_PREFIX))
+    for project_id in Project.objects.values_list('id', flat=True).iterator(chunk_size=BATCH_SIZE):
+        prefixes.add(f"{PROJECTS_PREFIX}{project_id}/")
+    return sorted(prefixes)
@@ -0,0 +1,235 @@
+import base64
+import hashlib
+
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+from .profiling import instrument
+
+
+def get_s3_client():
+    """
+    Return the boto3 S3 client the default storage backend shares between threads.
+    Object keys are the same as the storage names because AWS_LOCATION is unset.
+    """
+    return instrument(default_storage.client)
+
+
+def get_bucket_name():
+    return default_storage.bucket_name
+
+
+def generate_upload_key(project, filename):
+    """
+    Build the storage key for a new file in a project, exactly as
+    FileField would when saving through FileUploadForm.
+    """
+    from .models import UploadedFile
+
+    instance = UploadedFile(project=project)
+    return UploadedFile._meta.get_field('file').generate_filename(instance, filename)
+
+
+def create_presigned_post(key, content_type=None, max_size=None, expires_in=None, sha256=None):
+    """
+    Returns a presigned POST (url + form fields) allowing the browser to upload
+    a single object straight to the bucket under the given key.
+    With sha256, S3 rejects the upload unless the content matches it.
+    """
+    fields = {}
+    conditions = [
+        ['content-length-range', 1, settings.DIRECT_UPLOAD_MAX_SIZE if max_size is None else max_size],
+    ]
+    if content_type:
+        fields['Content-Type'] = content_type
+        conditions.append({'Content-Type': content_type})
+    if sha256:
+        checksum = base64.b64encode(bytes.fromhex(sha256)).decode()
+        fields['x-amz-checksum-sha256'] = checksum
+        conditions.append({'x-amz-checksum-sha256': checksum})
+
+    return get_s3_client().generate_presigned_post(
+        Bucket=get_bucket_name(),
+        Key=key,
+        Fields=fields,
+        Conditions=conditions,
+        ExpiresIn=expires_in or settings.DIRECT_UPLOAD_EXPIRES,
+    )
+
+
+def get_object(key):
+    return get_s3_client().get_object(Bucket=get_bucket_name(), Key=key)
+
+
+def head_object(key, checksum=False):
+    """
+    Returns the HEAD response for an object, or None if it doesn't exist.
+    With checksum, it includes any checksum S3 stored at upload time.
+    """
+    params = {'Bucket': get_bucket_name(), 'Key': key}
+    if checksum:
+        params['ChecksumMode'] = 'ENABLED'
+    try:
+        return get_s3_client().head_object(**params)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+
+
+def get_object_metadata(head):
+    """
+    Returns the UploadedFile size, content_type and checksum fields for a HEAD response.
+    The checksum is only known if S3 stored a SHA-256 of the whole object.
+    """
+    checksum = head.get('ChecksumSHA256')
+    # Multipart uploads report a checksum of checksums ("...-N"), which isn't the content hash
+    if checksum and '-' not in checksum:
+        checksum = base64.b64decode(checksum).hex()
+    else:
+        checksum = ''
+    return {
+        'size': head['ContentLength'],
+        'content_type': head.get('ContentType', ''),
+        'checksum': checksum,
+    }
+
+
+def create_multipart_upload(key, content_type=None):
+    """
+    Starts an S3 multipart upload and returns its UploadId
+    """
+    params = {'Bucket': get_bucket_name(), 'Key': key}
+    if content_type:
+        params['ContentType'] = content_type
+    return get_s3_client().create_multipart_upload(**params)['UploadId']
+
+
+def presign_upload_part(key, upload_id, part_number, expires_in=None):
+    return get_s3_client().generate_presigned_url(
+        'upload_part',
+        Params={
+            'Bucket': get_bucket_name(),
+            'Key': key,
+            'UploadId': upload_id,
+            'PartNumber': part_number,
+        },
+        ExpiresIn=expires_in or settings.DIRECT_UPLOAD_EXPIRES,
+    )
+
+
+def list_uploaded_parts(key, upload_id):
+    """
+    Returns every part S3 has received so far for a multipart upload
+    """
+    paginator = get_s3_client().get_paginator('list_parts')
+    parts = []
+    for page in paginator.paginate(Bucket=get_bucket_name(), Key=key, UploadId=upload_id):
+        for part in page.get('Parts', []):
+            parts.append({
+                'PartNumber': part['PartNumber'],
+                'ETag': part['ETag'],
+                'Size': part['Size'],
+            })
+    return parts
+
+
+def complete_multipart_upload(key, upload_id, parts):
+    return get_s3_client().complete_multipart_upload(
+        Bucket=get_bucket_name(),
+        Key=key,
+        UploadId=upload_id,
+        MultipartUpload={
+            'Parts': [{'PartNumber': p['PartNumber'], 'ETag': p['ETag']} for p in parts],
+        },
+    )
+
+
+def abort_multipart_upload(key, upload_id):
+    get_s3_client().abort_multipart_upload(Bucket=get_bucket_name(), Key=key, UploadId=upload_id)
+
+
+def iter_multipart_uploads(prefix):
+    """
+    Yields every in-progress multipart upload under a prefix
+    """
+    paginator = get_s3_client().get_paginator('list_multipart_uploads')
+    for page in paginator.paginate(Bucket=get_bucket_name(), Prefix=prefix):
+        yield from page.get('Uploads', [])
+
+
+def iter_object_keys(prefix, page_size=1000):
+    """
+    Yields pages of object keys under a prefix, in key order
+    """
+    paginator = get_s3_client().get_paginator('list_objects_v2')
+    for page in paginator.paginate(
+        Bucket=get_bucket_name(), Prefix=prefix, PaginationConfig={'PageSize': page_size}
+    ):
+        keys = [obj['Key'] for obj in page.get('Contents', [])]
+        if keys:
+            yield keys
+
+
+def iter_objects(prefix, page_size=1000):
+    """
+    Yields every object under a prefix (Key, Size, LastModified, ...), in key order
+    """
+    paginator = get_s3_client().get_paginator('list_objects_v2')
+    for page in paginator.paginate(
+        Bucket=get_bucket_name(), Prefix=prefix, PaginationConfig={'PageSize': page_size}
+    ):
+        yield from page.get('Contents', [])
+
+
+def iter_common_prefixes(prefix):
+    """
+    Yields the "folders" directly under a prefix, e.g. projects/1/ for projects/
+    """
+    paginator = get_s3_client().get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=get_bucket_name(), Prefix=prefix, Delimiter='/'):
+        for common in page.get('CommonPrefixes', []):
+            yield common['Prefix']
+
+
+def delete_objects(keys):
+    """
+    Deletes up to 1000 keys with a single DeleteObjects call.
+    Returns the keys S3 failed to delete.
+    """
+    response = get_s3_client().delete_objects(
+        Bucket=get_bucket_name(),
+        Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True},
+    )
+    return [error['Key'] for error in response.get('Errors', [])]
+
+
+def copy_object(source_key, key):
+    """
+    Copies an object within the bucket, server-side, keeping a SHA-256 checksum.
+    Single request, so objects up to 5 GB.
+    """
+    get_s3_client().copy_object(
+        Bucket=get_bucket_name(),
+        Key=key,
+        CopySource={'Bucket': get_bucket_name(), 'Key': source_key},
+        ChecksumAlgorithm='SHA256',
+    )
+
+
+def get_object_sha256(key):
+    """
+    Returns the hex SHA-256 of an object. Uses the checksum S3 stored at upload
+    time when there is one, otherwise reads the object and hashes it.
+    """
+    head = head_object(key, checksum=True)
+    checksum = get_object_metadata(head)['checksum'] if head else ''
+    if checksum:
+        return checksum
+
+    digest = hashlib.sha256()
+    body = get_s3_client().get_object(Bucket=get_bucket_name(), Key=key)['Body']
+    for chunk in body.iter_chunks(1024 * 1024):
+        digest.update(chunk)
+    return digest.hexdigest()
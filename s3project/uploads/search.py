@@ -0,0 +1,109 @@
+"""
+Search over file names and project names/descriptions.
+
+On Postgres, file names have a trigram GIN index, so substring matches
+(LIKE '%...%') are index scans, and projects have a GIN-indexed tsvector for
+word-prefix matches. Postgres keeps both indexes up to date by itself.
+
+On SQLite, they go into the uploads_search_file and uploads_search_project FTS5
+tables with the trigram tokenizer, keyed by id, and kept in sync by triggers on insert,
+update and delete (so bulk_create() and cascades are covered too). The indexes
+and triggers are created by migration 0010_search. SQLite drops the triggers when
+a migration has to rebuild one of the tables, so such a migration must recreate them.
+"""
+import re
+
+from django.db import connection
+from django.db.models import BooleanField
+from django.db.models.expressions import RawSQL
+
+from .models import Project, UploadedFile
+
+# Must match the expressions indexed by migration 0010_search exactly, or Postgres won't use the indexes
+FILE_NAME_SQL = (
+    "lower(COALESCE(NULLIF(uploads_uploadedfile.original_filename, ''), "
+    "regexp_replace(uploads_uploadedfile.file, '^.*/', '')))"
+)
+PROJECT_DOCUMENT_SQL = (
+    "to_tsvector('simple', uploads_project.name || ' ' || uploads_project.description)"
+)
+
+
+def like_pattern(query):
+    escaped = query.lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"%{escaped}%"
+
+
+def fts_condition(table, query):
+    """
+    (SQL condition, param) matching rows of an FTS table whose text contains the query.
+    Trigram MATCH needs at least three characters; shorter queries fall back to LIKE.
+    """
+    if len(query) >= 3:
+        return f"{table} MATCH %s", '"' + query.replace('"', '""') + '"'
+    return f"{table}.text LIKE %s ESCAPE '\\'", like_pattern(query)
+
+
+def search_files(query, project_ids=None, limit=50, before=None):
+    """
+    The newest `limit` UploadedFiles whose name contains the query, in the given
+    projects (None for all). With `before`, only files with lower ids: the page
+    after the one that ended with that id.
+    """
+    files = UploadedFile.objects.select_related('project', 'user').order_by('-id')
+    if project_ids is not None:
+        files = files.filter(project_id__in=project_ids)
+    if before is not None:
+        files = files.filter(id__lt=before)
+
+    if connection.vendor == 'postgresql':
+        match = RawSQL(f"{FILE_NAME_SQL} LIKE %s", [like_pattern(query)], output_field=BooleanField())
+        return list(files.alias(matches=match).filter(matches=True)[:limit])
+
+    # Walk the matches newest first from the index and stop at the limit, rather than
+    # collecting every match (a common word can match a large share of all files)
+    condition, param = fts_condition('uploads_search_file', query)
+    params = [param]
+    sql = (
+        "SELECT uploads_search_file.rowid FROM uploads_search_file "
+        "JOIN uploads_uploadedfile ON uploads_uploadedfile.id = uploads_search_file.rowid "
+        f"WHERE {condition}"
+    )
+    if project_ids is not None:
+        if not project_ids:
+            return []
+        sql += f" AND uploads_uploadedfile.project_id IN ({', '.join(['%s'] * len(project_ids))})"
+        params.extend(project_ids)
+    if before is not None:
+        sql += " AND uploads_search_file.rowid < %s"
+        params.append(before)
+    sql += " ORDER BY uploads_search_file.rowid DESC LIMIT %s"
+    params.append(limit)
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        ids = [row[0] for row in cursor.fetchall()]
+    return list(files.filter(id__in=ids))
+
+
+def search_projects(query, project_ids=None):
+    """
+    Projects whose name or description has words starting with the query's words
+    (on SQLite, containing the query anywhere)
+    """
+    projects = Project.objects.all()
+    if project_ids is not None:
+        projects = projects.filter(id__in=project_ids)
+
+    if connection.vendor == 'postgresql':
+        words = re.findall(r'\w+', query.lower())
+        if not words:
+            return projects.none()
+        # Each word as a prefix, all required: "ann rep" matches "Annual report"
+        tsquery = ' & '.join(f"{word}:*" for word in words)
+        match = RawSQL(f"{PROJECT_DOCUMENT_SQL} @@ to_tsquery('simple', %s)", [tsquery], output_field=BooleanField())
+    else:
+        condition, param = fts_condition('uploads_search_project', query)
+        sql = f"SELECT rowid FROM uploads_search_project WHERE {condition}"
+        match = RawSQL(f"uploads_project.id IN ({sql})", [param], output_field=BooleanField())
+    return projects.alias(matches=match).filter(matches=True)
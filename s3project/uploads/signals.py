@@ -0,0 +1,27 @@
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .fragments import bump_version
+from .models import Project, ProjectMembership, UploadedFile
+from .permissions import invalidate_memberships
+
+
+@receiver(post_save, sender=ProjectMembership)
+@receiver(post_delete, sender=ProjectMembership)
+def membership_changed(sender, instance, **kwargs):
+    invalidate_memberships(instance.user_id)
+
+
+@receiver(post_save, sender=Project)
+@receiver(post_delete, sender=Project)
+@receiver(post_save, sender=UploadedFile)
+@receiver(post_delete, sender=UploadedFile)
+@receiver(post_save, sender=ProjectMembership)
+@receiver(post_delete, sender=ProjectMembership)
+def project_changed(sender, instance, **kwargs):
+    # After commit, so a page rendered in between can't cache the old rows under the new version
+    project_id = instance.id if sender is Project else instance.project_id
+    transaction.on_commit(partial(bump_version, project_id))
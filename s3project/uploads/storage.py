@@ -0,0 +1,248 @@
+"""
+Storage backends for the uploads app, enabled through the STORAGES setting.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from pathlib import Path
+
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from django.core.cache import cache
+from django.core.files import File
+from storages.backends.s3boto3 import S3Boto3Storage
+from storages.utils import clean_name, setting
+
+
+class TunedS3Storage(S3Boto3Storage):
+    """
+    S3 storage with its client and transfers tuned from settings.
+
+    S3Boto3Storage builds a boto3 session and resource lazily in each thread that
+    touches it, each with a client and its own pool of connections. boto3 resources
+    aren't thread-safe, so the storage's own methods keep using a resource per
+    thread. Clients are, so the `client` property is one client, built on first
+    use, that the thread pools deleting projects, building ZIPs or fetching
+    metadata share (through s3.get_s3_client()), reusing its connections instead
+    of each paying for a session, a client and new TLS handshakes. Its pool is
+    sized by S3_MAX_POOL_CONNECTIONS, which should cover every thread that can use
+    it at once, retries back off adaptively
+    when S3 throttles, and uploads and downloads over S3_MULTIPART_THRESHOLD are
+    transferred in S3_MULTIPART_CHUNKSIZE parts, S3_TRANSFER_CONCURRENCY at a time.
+    """
+
+    def __init__(self, **settings):
+        super().__init__(**settings)
+        self._shared_client = None
+        self._shared_client_lock = threading.Lock()
+        self.client_config = self.client_config.merge(Config(
+            max_pool_connections=self.max_pool_connections,
+            retries={'mode': self.retry_mode, 'total_max_attempts': self.max_attempts},
+            tcp_keepalive=True,
+        ))
+        self.transfer_config = TransferConfig(
+            multipart_threshold=self.multipart_threshold,
+            multipart_chunksize=self.multipart_chunksize,
+            max_concurrency=self.max_concurrency,
+            use_threads=self.use_threads,
+        )
+
+    def get_default_settings(self):
+        return {
+            **super().get_default_settings(),
+            'max_pool_connections': setting('S3_MAX_POOL_CONNECTIONS', 50),
+            'retry_mode': setting('S3_RETRY_MODE', 'adaptive'),
+            'max_attempts': setting('S3_MAX_ATTEMPTS', 5),
+            'multipart_threshold': setting('S3_MULTIPART_THRESHOLD', 16 * 1024 ** 2),
+            'multipart_chunksize': setting('S3_MULTIPART_CHUNKSIZE', 16 * 1024 ** 2),
+            'max_concurrency': setting('S3_TRANSFER_CONCURRENCY', 10),
+        }
+
+    @property
+    def client(self):
+        """A boto3 S3 client shared by every thread, unlike `connection`"""
+        if self._shared_client is None:
+            with self._shared_client_lock:
+                if self._shared_client is None:
+                    self._shared_client = self._create_session().client(
+                        's3',
+                        region_name=self.region_name,
+                        use_ssl=self.use_ssl,
+                        endpoint_url=self.endpoint_url,
+                        config=self.client_config,
+                        verify=self.verify,
+                    )
+        return self._shared_client
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state.pop('_shared_client', None)
+        state.pop('_shared_client_lock', None)
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self._shared_client = None
+        self._shared_client_lock = threading.Lock()
+
+
+class CachingS3Storage(TunedS3Storage):
+    """
+    S3 storage with a local read-through cache for hot objects.
+
+    Objects read through cached_path() (and open() in 'rb' mode) are kept on local
+    disk or tmpfs. Every read revalidates the copy with a conditional HEAD on its ETag,
+    which costs a round trip but no transfer when the object is unchanged. The cache
+    is bounded to cache_max_size bytes, evicting the least recently used objects, and
+    objects over cache_max_object_size bypass it without being downloaded. Hit, miss
+    and eviction counts are kept in the Django cache, so they add up across processes
+    that share one.
+
+        STORAGES = {"default": {
+            "BACKEND": "uploads.storage.CachingS3Storage",
+            "OPTIONS": {"cache_dir": "/tmp/s3-cache", "cache_max_size": 2 * 1024 ** 3},
+        }}
+    """
+    is_caching = True
+    STATS = ('hits', 'misses', 'evictions')
+
+    def __init__(self, cache_dir=None, cache_max_size=None, cache_max_object_size=None, **kwargs):
+        super().__init__(**kwargs)
+        self.cache_dir = Path(cache_dir or Path(tempfile.gettempdir()) / 's3-read-cache')
+        self.cache_max_size = cache_max_size or 1024 ** 3
+        self.cache_max_object_size = cache_max_object_size or self.cache_max_size // 10
+        self._lock = threading.Lock()
+        self._cached_bytes = None
+
+    def _open(self, name, mode='rb'):
+        if mode == 'rb':
+            path = self.cached_path(name)
+            if path is not None:
+                return File(open(path, 'rb'), name)
+        return super()._open(name, mode)
+
+    def entry_path(self, name):
+        digest = hashlib.sha256(name.encode()).hexdigest()
+        return self.cache_dir / digest[:2] / digest
+
+    def cached_path(self, name):
+        """
+        Returns the local path of an up-to-date copy of the object, fetching it
+        on a miss, or None if the object is too big to cache
+        """
+        path = self.entry_path(name)
+        etag_path = path.with_suffix('.etag')
+        params = {'Bucket': self.bucket_name, 'Key': self._normalize_name(clean_name(name))}
+        # A copy left without its ETag (e.g. by a crash between the two writes) is
+        # fetched again, but its size is already counted
+        try:
+            replaced = path.stat().st_size
+        except FileNotFoundError:
+            replaced = None
+        if replaced is not None:
+            try:
+                etag = etag_path.read_text()
+            except FileNotFoundError:
+                pass
+            else:
+                params['IfNoneMatch'] = etag
+
+        # The HEAD revalidates the copy and sizes a new one, so objects too big
+        # to cache are never transferred
+        try:
+            head = self.client.head_object(**params)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('304', 'NotModified'):
+                # Mark as recently used for the LRU eviction
+                os.utime(path)
+                self.record('hits')
+                return path
+            raise
+        if head['ContentLength'] > self.cache_max_object_size:
+            return None
+
+        try:
+            response = self.client.get_object(
+                Bucket=params['Bucket'], Key=params['Key'], IfMatch=head['ETag'],
+            )
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('412', 'PreconditionFailed'):
+                # Replaced since the HEAD; size up the new version
+                return self.cached_path(name)
+            raise
+
+        self.record('misses')
+        body = response['Body']
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file and rename, so readers never see a partial copy
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in body.iter_chunks(1024 * 1024):
+                    f.write(chunk)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        finally:
+            body.close()
+        etag_path.write_text(response['ETag'])
+
+        self.added(response['ContentLength'] - (replaced or 0))
+        return path
+
+    def scan(self):
+        """Returns (mtime, size, path) for every cached object"""
+        entries = []
+        for path in self.cache_dir.glob('*/*'):
+            if path.suffix:
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def added(self, size):
+        with self._lock:
+            if self._cached_bytes is None:
+                self._cached_bytes = sum(size for _, size, _ in self.scan())
+            else:
+                self._cached_bytes += size
+            if self._cached_bytes > self.cache_max_size:
+                self.evict()
+
+    def evict(self):
+        """Delete least recently used objects until the cache fits its size limit"""
+        entries = sorted(self.scan())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.cache_max_size:
+                break
+            for stale in (path, path.with_suffix('.etag')):
+                try:
+                    stale.unlink()
+                except FileNotFoundError:
+                    pass
+            total -= size
+            self.record('evictions')
+        self._cached_bytes = total
+
+    def record(self, stat):
+        key = f"s3-read-cache:{stat}"
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, 0, timeout=None)
+            cache.incr(key)
+
+    def stats(self):
+        values = cache.get_many([f"s3-read-cache:{stat}" for stat in self.STATS])
+        stats = {stat: values.get(f"s3-read-cache:{stat}", 0) for stat in self.STATS}
+        reads = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / reads if reads else 0.0
+        stats['cached_bytes'] = self._cached_bytes
+        return stats
@@ -0,0 +1,95 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.conf import settings
+
+from .blobs import count_references, release_blobs
+from .invitations import purge_expired
+from .jobs import job
+from .models import Project, UploadedFile
+from .quotas import recount_usage, release_project
+from .s3 import delete_objects, iter_object_keys
+
+
+def delete_batch(keys):
+    """
+    Delete one batch of keys, retrying any that S3 reports as failed
+    """
+    for attempt in range(settings.S3_DELETE_RETRIES + 1):
+        keys = delete_objects(keys)
+        if not keys:
+            return
+        time.sleep(2 ** attempt * 0.5)
+    raise RuntimeError(f"Could not delete {len(keys)} objects, e.g. {keys[0]}")
+
+
+def delete_prefix(prefix, on_progress=None):
+    """
+    Delete every object under a prefix with batched DeleteObjects calls.
+
+    Batches of up to 1000 keys run on a bounded thread pool while the listing
+    continues, with at most two batches per thread waiting. Returns the number
+    of objects deleted.
+    """
+    workers = settings.S3_DELETE_CONCURRENCY
+    deleted = 0
+    pending = {}
+
+    def collect(done):
+        nonlocal deleted
+        for future in done:
+            future.result()
+            deleted += pending.pop(future)
+        if on_progress:
+            on_progress(deleted)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for keys in iter_object_keys(prefix):
+            if len(pending) >= workers * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            pending[executor.submit(delete_batch, keys)] = len(keys)
+
+        collect(wait(pending).done)
+
+    return deleted
+
+
+@job('delete_project')
+def delete_project(job, project_id):
+    """Delete a project's S3 folder, then the project and its rows"""
+    project = Project.objects.filter(id=project_id).first()
+    if project is None:
+        return
+
+    # Progress counts objects deleted from the project folder. Content-addressed files
+    # aren't stored there, so only the others make up the expected total.
+    stored_in_folder = UploadedFile.objects.filter(project=project, blob__isnull=True)
+    job.set_progress(0, total=stored_in_folder.count())
+    deleted = delete_prefix(project.get_s3_folder_name(), on_progress=job.set_progress)
+
+    # Only drop the rows once storage is clean, so a failed job can simply be re-run.
+    # Content-addressed files live outside the project folder and may be shared,
+    # so their blobs are released rather than deleted.
+    blob_references = count_references(UploadedFile.objects.filter(project=project))
+    release_project(project)
+    # In batches, as deletes of UploadedFiles send signals, so the ORM loads the rows it deletes
+    files = UploadedFile.objects.filter(project=project)
+    while batch := list(files.values_list('id', flat=True)[:1000]):
+        UploadedFile.objects.filter(id__in=batch).delete()
+    project.delete()
+    release_blobs(blob_references)
+    job.set_progress(deleted, total=deleted)
+
+
+@job('recount_storage')
+def recount_storage(job):
+    """Correct drift in the project and user usage counters"""
+    recount_usage()
+
+
+@job('purge_invitations')
+def purge_invitations(job, retention_days=None):
+    """Delete invitations that expired unaccepted, in batches"""
+    purged = purge_expired(retention_days, on_progress=job.set_progress)
+    job.set_progress(purged, total=purged)
@@ -1,3 +1,1909 @@
-from django.test import TestCase
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import os
+import queue
+import re
+import tempfile
+import threading
+import time
+import zipfile
+from collections import deque
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+import requests
+from asgiref.sync import ThreadSensitiveContext, sync_to_async
+from moto import mock_aws
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.test import Client, RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import OperationalError, connection
+from django.http import HttpResponse
+from django.urls import reverse
+from django.utils import timezone
+
+from . import aio, audit, jobs, profiling, tasks
+from .fragments import project_cards
+from .blobs import delete_uploaded_file, store_file
+from .downloads import get_download_urls, sign_download_url
+from .invitations import purge_expired
+from .members import add_members, parse_csv, parse_identifiers, remove_members, resolve_users
+from .models import AuditEvent, Blob, Invitation, Job, Project, ProjectMembership, UploadedFile, UserQuota, get_blob_key
+from .pagination import InvalidCursor, decode_cursor, encode_cursor, paginate_files
+from .reconcile import BLOBS_PREFIX, PROJECTS_PREFIX, merge_join, reconcile_prefix
+from .quotas import QuotaExceeded, check_quota, release, remaining_bytes, reserve
+from .profiling import ProfilingMiddleware
+from .search import search_files, search_projects
+from .storage import CachingS3Storage
+from .tasks import delete_prefix
+from .s3 import delete_objects, get_object, get_s3_client, head_object, iter_object_keys
+from .upload_handlers import S3StreamingUpload
+from .views import is_project_member, unique_arcname
+
+# Keep tests off the real bucket
+TEST_STORAGES = {
+    "default": {"BACKEND": "django.core.files.storage.InMemoryStorage"},
+    "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+}
+
+# For tests against moto's in-memory S3
+S3_TEST_SETTINGS = {
+    'STORAGES': {"default": {"BACKEND": "uploads.storage.TunedS3Storage"}, "staticfiles": TEST_STORAGES["staticfiles"]},
+    'AWS_STORAGE_BUCKET_NAME': 'test-bucket',
+    'AWS_S3_REGION_NAME': 'us-east-1',
+    'AWS_S3_ENDPOINT_URL': None,
+    'AWS_ACCESS_KEY_ID': 'testing',
+    'AWS_SECRET_ACCESS_KEY': 'testing',
+    'CONTENT_ADDRESSED_STORAGE': False,
+    'AUDIT_LOG_BACKGROUND': False,
+}
+
+
+def create_project(user, name, files=0):
+    project = Project.objects.create(name=name, created_by=user)
+    ProjectMembership.objects.create(project=project, user=user, added_by=user)
+    for i in range(files):
+        file = UploadedFile(user=user, project=project)
+        file.file.name = f"{project.get_s3_folder_name()}file{i}.txt"
+        file.save()
+    return project
+
+
+@override_settings(STORAGES=TEST_STORAGES)
+class ProjectListQueryCountTests(TestCase):
+    """Project pages must not run a query per project"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('member', 'member@example.com', 'password')
+        self.client.force_login(self.user)
+
+    def count_queries(self, url_name):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse(url_name))
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def assertConstantQueries(self, url_name):
+        create_project(self.user, 'First', files=2)
+        baseline = self.count_queries(url_name)
+
+        for i in range(20):
+            create_project(self.user, f"Project {i}", files=3)
+        self.assertEqual(self.count_queries(url_name), baseline)
+
+    def test_dashboard_query_count_is_constant(self):
+        self.assertConstantQueries('dashboard')
+
+    def test_user_projects_query_count_is_constant(self):
+        self.assertConstantQueries('user_projects')
+
+    def test_annotated_counts(self):
+        other = User.objects.create_user('other', 'other@example.com', 'password')
+        project = create_project(self.user, 'Counted', files=3)
+        ProjectMembership.objects.create(project=project, user=other, added_by=self.user)
+
+        annotated = Project.objects.with_counts().get(id=project.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(annotated.member_count, 2)
+            self.assertEqual(annotated.file_count, 3)
+        self.assertEqual(project.member_count, 2)
+        self.assertEqual(project.file_count, 3)
+
+
+@override_settings(STORAGES=TEST_STORAGES, AUDIT_LOG_BACKGROUND=False)
+class FilePaginationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('member', 'member@example.com', 'password')
+        self.client.force_login(self.user)
+        self.project = create_project(self.user, 'Paged', files=5)
+
+    def test_cursor_round_trip(self):
+        timestamp = timezone.now()
+        self.assertEqual(decode_cursor(encode_cursor(timestamp, 42)), (timestamp, 42))
+
+    def test_malformed_cursors(self):
+        encode = lambda raw: base64.urlsafe_b64encode(raw.encode()).decode()
+        for cursor in ['not-a-cursor', '%%%', encode('2025-01-01T00:00:00'), encode('yesterday|1'), encode('2025-01-01T00:00:00|x')]:
+            with self.subTest(cursor=cursor), self.assertRaises(InvalidCursor):
+                decode_cursor(cursor)
+
+    def test_pages_cover_every_file_once(self):
+        # Ties on uploaded_at are broken by id
+        UploadedFile.objects.filter(project=self.project).update(uploaded_at=timezone.now())
+        files = UploadedFile.objects.filter(project=self.project)
+
+        seen, cursor = [], None
+        while True:
+            page, cursor = paginate_files(files, cursor=cursor, page_size=2)
+            seen += [file.id for file in page]
+            if cursor is None:
+                break
+        self.assertEqual(seen, sorted(files.values_list('id', flat=True), reverse=True))
+
+    def test_json_pages(self):
+        url = reverse('project_detail', args=[self.project.id])
+        names, cursor = [], None
+        while True:
+            params = {'format': 'json', 'page_size': 2}
+            if cursor:
+                params['cursor'] = cursor
+            data = self.client.get(url, params).json()
+            names += [file['filename'] for file in data['files']]
+            cursor = data['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(len(names), 5)
+        self.assertEqual(len(set(names)), 5)
+
+    def test_invalid_cursor_is_bad_request(self):
+        url = reverse('project_detail', args=[self.project.id])
+        self.assertEqual(self.client.get(url, {'cursor': 'not-a-cursor'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'cursor': 'not-a-cursor', 'format': 'json'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'page_size': 'lots'}).status_code, 400)
+
+
+@override_settings(STORAGES=TEST_STORAGES, AUDIT_LOG_BACKGROUND=False, SHARED_CACHE=True)
+class MembershipCacheTests(TestCase):
+    """Access checks are answered from a cached set of project IDs"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('member', 'member@example.com', 'password')
+        self.projects = [create_project(self.user, f"Project {i}") for i in range(3)]
+        self.other = Project.objects.create(name='Other', created_by=self.user)
+
+    def fresh_user(self):
+        # A new user object, as each request gets
+        return User.objects.get(id=self.user.id)
+
+    def test_checks_share_one_query_per_request(self):
+        user = self.fresh_user()
+        with self.assertNumQueries(1):
+            for project in self.projects:
+                self.assertTrue(is_project_member(user, project))
+            self.assertFalse(is_project_member(user, self.other))
+
+    def test_later_requests_use_the_cache(self):
+        is_project_member(self.fresh_user(), self.projects[0])
+        user = self.fresh_user()
+        with self.assertNumQueries(0):
+            self.assertTrue(is_project_member(user, self.projects[0]))
+
+    @override_settings(SHARED_CACHE=False)
+    def test_without_a_shared_cache_each_request_queries(self):
+        is_project_member(self.fresh_user(), self.projects[0])
+        user = self.fresh_user()
+        with self.assertNumQueries(1):
+            self.assertTrue(is_project_member(user, self.projects[0]))
+            self.assertTrue(is_project_member(user, self.projects[1]))
+
+    def test_membership_changes_invalidate_the_cache(self):
+        is_project_member(self.fresh_user(), self.other)
+        membership = ProjectMembership.objects.create(project=self.other, user=self.user, added_by=self.user)
+        self.assertTrue(is_project_member(self.fresh_user(), self.other))
+
+        membership.delete()
+        self.assertFalse(is_project_member(self.fresh_user(), self.other))
+
+    def test_project_detail_queries_drop(self):
+        self.client.force_login(self.user)
+        url = reverse('project_detail', args=[self.projects[0].id])
+
+        with CaptureQueriesContext(connection) as cold:
+            self.client.get(url)
+        with CaptureQueriesContext(connection) as warm:
+            self.client.get(url)
+        self.assertLess(len(warm), len(cold))
+
+
+class StaticAssetCachingTests(TestCase):
+    """Collected static files are served under hashed names that browsers cache for good"""
+
+    def setUp(self):
+        static_root = tempfile.TemporaryDirectory()
+        self.addCleanup(static_root.cleanup)
+        storages = {
+            **TEST_STORAGES,
+            "staticfiles": {"BACKEND": "whitenoise.storage.CompressedManifestStaticFilesStorage"},
+        }
+        settings = override_settings(STORAGES=storages, STATIC_ROOT=static_root.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        call_command('collectstatic', interactive=False, verbosity=0)
+
+    def stylesheet_url(self):
+        response = self.client.get(reverse('login'))
+        self.assertEqual(response.status_code, 200)
+        return re.search(r'<link rel="stylesheet" href="([^"]+)"', response.content.decode())[1]
+
+    def test_repeat_page_loads_reuse_cached_assets(self):
+        url = self.stylesheet_url()
+        self.assertRegex(url, r'^/static/css/output\.[0-9a-f]{12}\.css$')
+
+        response = self.client.get(url, headers={'accept-encoding': 'gzip'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        cache_control = response['Cache-Control']
+        self.assertIn('immutable', cache_control)
+        max_age = int(re.search(r'max-age=(\d+)', cache_control)[1])
+        self.assertGreaterEqual(max_age, 365 * 24 * 60 * 60)
+
+        # The next load links the same URL, which the browser has cached and won't request again;
+        # a revalidation, if one is ever made, is answered without the body
+        self.assertEqual(self.stylesheet_url(), url)
+        revalidated = self.client.get(url, headers={'if-none-match': response['ETag']})
+        self.assertEqual(revalidated.status_code, 304)
+        self.assertEqual(b''.join(revalidated.streaming_content), b'')
+
+
+@override_settings(STORAGES=TEST_STORAGES, AUDIT_LOG_BACKGROUND=True)
+class AuditLogTests(TestCase):
+    """Events are queued, written in batches, never dropped, and searchable by superusers"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('member', 'member@example.com', 'password')
+        self.project = create_project(self.user, 'Audited')
+        # A small queue of the test's own, with no writer thread draining it
+        self.queue = queue.Queue(maxsize=3)
+        for patcher in (mock.patch.object(audit, 'events', self.queue), mock.patch.object(audit, 'ensure_writer')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @override_settings(AUDIT_LOG_BATCH_SIZE=2, AUDIT_LOG_FLUSH_INTERVAL=0)
+    def test_events_are_queued_and_written_in_batches(self):
+        for _ in range(3):
+            audit.record(AuditEvent.Action.VIEW, self.user, self.project)
+        self.assertFalse(AuditEvent.objects.exists())
+
+        batches = [audit.next_batch(), audit.next_batch()]
+        self.assertEqual([len(batch) for batch in batches], [2, 1])
+        with self.assertNumQueries(1):
+            audit.write(batches[0])
+        self.assertEqual(AuditEvent.objects.filter(user=self.user, project=self.project).count(), 2)
+
+    def test_batch_ends_at_stop(self):
+        audit.record(AuditEvent.Action.VIEW, self.user, self.project)
+        self.queue.put(audit.STOP)
+        batch = audit.next_batch()
+        self.assertEqual(len(batch), 2)
+        self.assertIs(batch[-1], audit.STOP)
+
+    @override_settings(AUDIT_LOG_QUEUE_TIMEOUT=0.01)
+    def test_full_queue_writes_the_event_itself(self):
+        for _ in range(3):
+            audit.record(AuditEvent.Action.VIEW, self.user, self.project)
+        with self.assertLogs('uploads.audit', 'WARNING'):
+            audit.record(AuditEvent.Action.DOWNLOAD, self.user, self.project)
+
+        self.assertEqual(self.queue.qsize(), 3)
+        self.assertEqual(list(AuditEvent.objects.values_list('action', flat=True)), ['download'])
+
+    @override_settings(AUDIT_LOG_RETRY_DELAY=0)
+    def test_failed_batch_is_retried(self):
+        batch = [audit.event(AuditEvent.Action.DELETE, self.user, self.project)]
+        bulk_create = AuditEvent.objects.bulk_create
+        failures = [OperationalError('database is locked')] * 2
+
+        def flaky_bulk_create(*args, **kwargs):
+            if failures:
+                raise failures.pop()
+            return bulk_create(*args, **kwargs)
+
+        with mock.patch.object(AuditEvent.objects, 'bulk_create', flaky_bulk_create), \
+                mock.patch.object(audit, 'connection'), self.assertLogs('uploads.audit', 'ERROR'):
+            audit.write(batch)
+        self.assertEqual(AuditEvent.objects.filter(action=AuditEvent.Action.DELETE).count(), 1)
+
+    def test_audit_log_filters(self):
+        other = User.objects.create_user('other', 'other@example.com', 'password')
+        other_project = create_project(other, 'Other')
+        AuditEvent.objects.bulk_create([
+            AuditEvent(action=AuditEvent.Action.VIEW, user=self.user, project=self.project),
+            AuditEvent(action=AuditEvent.Action.DOWNLOAD, user=self.user, project=self.project),
+            AuditEvent(action=AuditEvent.Action.DENIED, user=other, project=self.project),
+            AuditEvent(action=AuditEvent.Action.VIEW, user=other, project=other_project),
+        ])
+
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(reverse('audit_log')).status_code, 302)
+
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+
+        def actions(**params):
+            response = self.client.get(reverse('audit_log'), params)
+            self.assertEqual(response.status_code, 200)
+            return sorted(event.action for event in response.context['events'])
+
+        self.assertEqual(actions(user='member'), ['download', 'view'])
+        self.assertEqual(actions(project=self.project.id), ['denied', 'download', 'view'])
+        self.assertEqual(actions(action='view'), ['view', 'view'])
+        self.assertEqual(actions(user='other', project=self.project.id), ['denied'])
+        self.assertEqual(self.client.get(reverse('audit_log'), {'action': 'nope'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('audit_log'), {'project': 'x'}).status_code, 400)
+
+
+@override_settings(**S3_TEST_SETTINGS)
+class S3TestCase(TestCase):
+    """Runs each test against an empty bucket in moto's in-memory S3"""
+
+    def setUp(self):
+        aws = mock_aws()
+        aws.start()
+        self.addCleanup(aws.stop)
+        get_s3_client().create_bucket(Bucket='test-bucket')
+        self.user = User.objects.create_user('member', 'member@example.com', 'password')
+        self.project = create_project(self.user, 'Uploads')
+        self.client.force_login(self.user)
+
+    def post_json(self, url_name, data, project=None):
+        response = self.client.post(reverse(url_name, args=[(project or self.project).id]), data)
+        return response.status_code, json.loads(response.content)
+
+
+class DirectUploadTests(S3TestCase):
+    """Browser uploads straight to S3 through a presigned POST"""
+
+    def presign(self, content=b'hello world', filename='hello.txt'):
+        status, presigned = self.post_json('direct_upload_presign', {
+            'filename': filename, 'size': len(content), 'content_type': 'text/plain',
+        })
+        self.assertEqual(status, 200)
+        return presigned
+
+    def upload(self, presigned, content=b'hello world'):
+        response = requests.post(presigned['url'], data=presigned['fields'], files={'file': content})
+        self.assertLess(response.status_code, 300)
+
+    def test_presign_upload_complete(self):
+        presigned = self.presign()
+        self.upload(presigned)
+
+        status, body = self.post_json('direct_upload_complete', {'token': presigned['token']})
+        self.assertEqual(status, 200)
+        file = UploadedFile.objects.get(id=body['id'])
+        self.assertEqual(file.file.name, presigned['key'])
+        self.assertEqual((file.project, file.user, file.size), (self.project, self.user, 11))
+        self.project.refresh_from_db()
+        self.assertEqual(self.project.used_bytes, 11)
+
+    def test_replayed_token_is_rejected(self):
+        presigned = self.presign()
+        self.upload(presigned)
+        self.assertEqual(self.post_json('direct_upload_complete', {'token': presigned['token']})[0], 200)
+
+        self.assertEqual(self.post_json('direct_upload_complete', {'token': presigned['token']})[0], 409)
+        self.assertEqual(UploadedFile.objects.filter(file=presigned['key']).count(), 1)
+        self.project.refresh_from_db()
+        self.assertEqual(self.project.used_bytes, 11)
+
+    def test_same_filename_from_two_users(self):
+        other = User.objects.create_user('other', 'other@example.com', 'password')
+        ProjectMembership.objects.create(project=self.project, user=other, added_by=self.user)
+        first = self.presign()
+        self.upload(first)
+        self.assertEqual(self.post_json('direct_upload_complete', {'token': first['token']})[0], 200)
+
+        self.client.force_login(other)
+        second = self.presign(b'a different hello', filename='hello.txt')
+        self.assertNotEqual(second['key'], first['key'])
+        self.upload(second, b'a different hello')
+        status, body = self.post_json('direct_upload_complete', {'token': second['token']})
+        self.assertEqual(status, 200)
+
+        files = {file.user: file for file in UploadedFile.objects.all()}
+        self.assertEqual({file.filename for file in files.values()}, {'hello.txt'})
+        self.assertEqual((files[self.user].size, files[other].size), (11, 17))
+        self.assertEqual(get_object(files[self.user].file.name)['Body'].read(), b'hello world')
+        self.assertEqual(get_object(files[other].file.name)['Body'].read(), b'a different hello')
+        self.project.refresh_from_db()
+        self.assertEqual(self.project.used_bytes, 28)
+
+    def test_expired_token_is_rejected(self):
+        presigned = self.presign()
+        self.upload(presigned)
+        later = time.time() + settings.DIRECT_UPLOAD_EXPIRES + 1
+        with mock.patch('django.core.signing.time.time', return_value=later):
+            self.assertEqual(self.post_json('direct_upload_complete', {'token': presigned['token']})[0], 400)
+        self.assertFalse(UploadedFile.objects.exists())
+
+    def test_bad_or_foreign_token_is_rejected(self):
+        presigned = self.presign()
+        self.upload(presigned)
+
+        self.assertEqual(self.post_json('direct_upload_complete', {'token': 'not-a-token'})[0], 400)
+        # Issued for another project...
+        other_project = create_project(self.user, 'Other')
+        self.assertEqual(
+            self.post_json('direct_upload_complete', {'token': presigned['token']}, project=other_project)[0], 400
+        )
+        # ...or another user
+        other = User.objects.create_user('other', 'other@example.com', 'password')
+        ProjectMembership.objects.create(project=self.project, user=other, added_by=self.user)
+        self.client.force_login(other)
+        self.assertEqual(self.post_json('direct_upload_complete', {'token': presigned['token']})[0], 400)
+        self.assertFalse(UploadedFile.objects.exists())
+
+    def test_missing_object_is_rejected(self):
+        presigned = self.presign()
+        self.assertEqual(self.post_json('direct_upload_complete', {'token': presigned['token']})[0], 400)
+        self.assertFalse(UploadedFile.objects.exists())
+
+
+@override_settings(CONTENT_ADDRESSED_STORAGE=True)
+class ContentAddressedUploadTests(S3TestCase):
+    """Shared blobs: only content the caller has proven they hold is deduplicated"""
+
+    content = b'shared content'
+    sha256 = hashlib.sha256(content).hexdigest()
+
+    def setUp(self):
+        super().setUp()
+        self.other = User.objects.create_user('other', 'other@example.com', 'password')
+        self.other_project = create_project(self.other, 'Theirs')
+
+    def add_file(self, user, project):
+        file = UploadedFile(user=user, project=project, size=len(self.content))
+        file.blob = store_file(ContentFile(self.content, name='shared.txt'))
+        file.file.name = file.blob.key
+        file.save()
+        return file
+
+    def presign(self):
+        status, presigned = self.post_json('direct_upload_presign', {
+            'filename': 'shared.txt', 'size': len(self.content), 'sha256': self.sha256,
+        })
+        self.assertEqual(status, 200)
+        return presigned
+
+    def complete(self, presigned):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.post_json('direct_upload_complete', {'token': presigned['token']})
+
+    def test_another_projects_hash_is_not_a_duplicate(self):
+        self.add_file(self.other, self.other_project)
+
+        presigned = self.presign()
+        self.assertFalse(presigned['duplicate'])
+        self.assertNotEqual(presigned['key'], get_blob_key(self.sha256))
+        # Knowing the hash isn't enough: nothing was uploaded
+        self.assertEqual(self.complete(presigned)[0], 400)
+
+        requests.post(presigned['url'], data=presigned['fields'], files={'file': self.content})
+        status, body = self.complete(presigned)
+        self.assertEqual(status, 200)
+        file = UploadedFile.objects.get(id=body['id'])
+        self.assertEqual((file.file.name, file.blob.ref_count), (get_blob_key(self.sha256), 2))
+        # The staged upload is gone once it's been referenced
+        self.assertIsNone(head_object(presigned['key']))
+
+    def test_upload_not_matching_its_hash_is_rejected(self):
+        self.add_file(self.other, self.other_project)
+        presigned = self.presign()
+        get_s3_client().put_object(Bucket='test-bucket', Key=presigned['key'], Body=b'something else')
+
+        self.assertEqual(self.complete(presigned)[0], 400)
+        self.assertEqual(Blob.objects.get(sha256=self.sha256).ref_count, 1)
+        self.assertIsNotNone(head_object(get_blob_key(self.sha256)))
+
+    def test_own_content_skips_the_transfer(self):
+        self.add_file(self.user, create_project(self.user, 'Mine'))
+
+        presigned = self.presign()
+        self.assertTrue(presigned['duplicate'])
+        status, body = self.complete(presigned)
+        self.assertEqual(status, 200)
+        self.assertEqual(UploadedFile.objects.get(id=body['id']).blob.ref_count, 2)
+
+    def test_duplicate_token_needs_the_reference_at_completion(self):
+        own = self.add_file(self.user, create_project(self.user, 'Mine'))
+        presigned = self.presign()
+        with self.captureOnCommitCallbacks(execute=True):
+            delete_uploaded_file(own)
+
+        self.assertEqual(self.complete(presigned)[0], 409)
+        self.project.refresh_from_db()
+        self.assertEqual(self.project.used_bytes, 0)
+
+    def test_blob_is_purged_after_its_last_reference_commits(self):
+        first = self.add_file(self.user, self.project)
+        second = self.add_file(self.other, self.other_project)
+        self.assertEqual(Blob.objects.get().ref_count, 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            delete_uploaded_file(first)
+        self.assertIsNotNone(head_object(get_blob_key(self.sha256)))
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            delete_uploaded_file(second)
+            # Nothing is deleted from S3 before the release commits
+            self.assertIsNotNone(head_object(get_blob_key(self.sha256)))
+        for callback in callbacks:
+            callback()
+        self.assertIsNone(head_object(get_blob_key(self.sha256)))
+        self.assertFalse(Blob.objects.exists())
+
+    def test_unreferenced_blob_is_stored_again(self):
+        # e.g. released, and its object purged, but the row kept after a failed purge
+        Blob.objects.create(sha256=self.sha256, size=len(self.content), ref_count=0)
+        self.add_file(self.user, self.project)
+        self.assertEqual(get_object(get_blob_key(self.sha256))['Body'].read(), self.content)
+        self.assertEqual(Blob.objects.get().ref_count, 1)
+
+
+    def test_content_is_transferred_before_the_row_is_locked(self):
+        depth = len(connection.savepoint_ids)
+        depths = []
+        save = default_storage.save
+
+        def timed_save(*args, **kwargs):
+            depths.append(len(connection.savepoint_ids))
+            return save(*args, **kwargs)
+
+        with mock.patch.object(default_storage, 'save', side_effect=timed_save):
+            self.add_file(self.user, self.project)
+        self.assertEqual(depths, [depth])
+
+    def test_purge_racing_the_transfer_stores_again(self):
+        save = default_storage.save
+
+        def purged_save(name, content, **kwargs):
+            name = save(name, content, **kwargs)
+            if len(calls) == 1:
+                # A purge of the unreferenced blob deletes the object just stored
+                default_storage.delete(name)
+            return name
+
+        with mock.patch.object(default_storage, 'save', side_effect=purged_save) as calls:
+            calls = calls.call_args_list
+            self.add_file(self.user, self.project)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(get_object(get_blob_key(self.sha256))['Body'].read(), self.content)
+        self.assertEqual(Blob.objects.get().ref_count, 1)
+
+    def test_form_upload_is_hashed_as_it_arrives(self):
+        # Kept in memory, then spooled to a temporary file
+        for max_memory_size in (settings.FILE_UPLOAD_MAX_MEMORY_SIZE, 0):
+            upload = SimpleUploadedFile('shared.txt', self.content, content_type='text/plain')
+            with self.subTest(max_memory_size=max_memory_size), \
+                    override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=max_memory_size), \
+                    mock.patch('uploads.blobs.hash_file') as hash_file:
+                response = self.client.post(reverse('upload_to_project', args=[self.project.id]), {'file': upload})
+                self.assertEqual(response.status_code, 302)
+                hash_file.assert_not_called()
+                file = UploadedFile.objects.latest('id')
+                self.assertEqual((file.checksum, file.blob.sha256, file.filename), (self.sha256, self.sha256, 'shared.txt'))
+        self.assertEqual(Blob.objects.get().ref_count, 2)
+
+class MergeJoinTests(TestCase):
+    def test_pairs_objects_with_rows_by_key(self):
+        objects = [{'Key': 'a'}, {'Key': 'b'}, {'Key': 'd'}]
+        rows = [('b', 1), ('b', 2), ('c', 3), ('d', 4), ('e', 5)]
+        joined = [(key, obj is not None, [row[1] for row in matched]) for key, obj, matched in merge_join(objects, rows)]
+        self.assertEqual(joined, [
+            ('a', True, []), ('b', True, [1, 2]), ('c', False, [3]), ('d', True, [4]), ('e', False, [5]),
+        ])
+
+    def test_either_side_empty(self):
+        self.assertEqual([key for key, _, _ in merge_join([{'Key': 'a'}], [])], ['a'])
+        self.assertEqual([key for key, _, _ in merge_join([], [('a', 1)])], ['a'])
+
+
+class ReconcileTests(S3TestCase):
+    """reconcile_prefix() under --repair only deletes what's old enough and still missing"""
+
+    prefix = PROJECTS_PREFIX
+
+    def put(self, key):
+        get_s3_client().put_object(Bucket='test-bucket', Key=key, Body=b'x')
+
+    def add_row(self, key, age=timedelta(days=2)):
+        file = UploadedFile(user=self.user, project=self.project)
+        file.file.name = key
+        file.save()
+        UploadedFile.objects.filter(id=file.id).update(uploaded_at=timezone.now() - age)
+        return file
+
+    def reconcile(self, cutoff=None, **kwargs):
+        return reconcile_prefix(self.prefix, cutoff or timezone.now() - timedelta(days=1), repair=True, **kwargs)
+
+    def test_repairs_old_orphans_and_missing_rows(self):
+        folder = self.project.get_s3_folder_name()
+        self.put(f'{folder}kept.txt')
+        self.add_row(f'{folder}kept.txt')
+        self.put(f'{folder}orphan.txt')
+        missing = self.add_row(f'{folder}missing.txt')
+
+        # Objects count as old once they're older than the cutoff
+        stats = self.reconcile(cutoff=timezone.now() + timedelta(minutes=1))
+        self.assertEqual((stats['checked'], stats['orphaned_objects'], stats['missing_objects']), (3, 1, 1))
+        self.assertIsNone(head_object(f'{folder}orphan.txt'))
+        self.assertIsNotNone(head_object(f'{folder}kept.txt'))
+        self.assertFalse(UploadedFile.objects.filter(id=missing.id).exists())
+        self.assertEqual(UploadedFile.objects.count(), 1)
+
+    def test_recent_objects_and_rows_are_skipped(self):
+        folder = self.project.get_s3_folder_name()
+        self.put(f'{folder}uploading.txt')
+        self.add_row(f'{folder}completing.txt', age=timedelta(minutes=5))
+
+        stats = self.reconcile()
+        self.assertEqual((stats['recent'], stats['orphaned_objects'], stats['missing_objects']), (2, 0, 0))
+        self.assertIsNotNone(head_object(f'{folder}uploading.txt'))
+        self.assertTrue(UploadedFile.objects.exists())
+
+    def test_object_arriving_after_the_listing_keeps_its_row(self):
+        key = f'{self.project.get_s3_folder_name()}late.txt'
+        self.add_row(key)
+        self.put(key)
+
+        with mock.patch('uploads.reconcile.iter_objects', return_value=iter([])):
+            stats = self.reconcile()
+        self.assertEqual(stats['missing_objects'], 1)
+        self.assertTrue(UploadedFile.objects.exists())
+
+    def test_missing_blob_takes_its_files(self):
+        blob = Blob.objects.create(sha256='0' * 64, size=1, ref_count=1)
+        Blob.objects.filter(id=blob.id).update(created_at=timezone.now() - timedelta(days=2))
+        file = self.add_row(blob.key)
+        UploadedFile.objects.filter(id=file.id).update(blob=blob)
+
+        self.prefix = BLOBS_PREFIX
+        self.assertEqual(self.reconcile()['missing_objects'], 1)
+        self.assertFalse(Blob.objects.exists())
+        self.assertFalse(UploadedFile.objects.exists())
+
+
+@override_settings(MULTIPART_UPLOAD_PART_SIZE=5 * 1024 ** 2)
+class MultipartUploadTests(S3TestCase):
+    """Completion checks S3's parts against the size declared when the upload started"""
+
+    part_size = 5 * 1024 ** 2
+    size = part_size + 10
+
+    def initiate(self, size=None):
+        status, upload = self.post_json('multipart_upload_initiate', {
+            'filename': 'big.bin', 'size': size or self.size, 'content_type': 'application/octet-stream',
+        })
+        self.assertEqual(status, 200)
+        return upload
+
+    def put_part(self, upload, n, size):
+        status, body = self.post_json('multipart_upload_part_urls', {'token': upload['token'], 'part_numbers': n})
+        self.assertEqual(status, 200)
+        response = requests.put(body['urls'][str(n)], data=b'x' * size)
+        self.assertLess(response.status_code, 300)
+
+    def complete(self, upload):
+        return self.post_json('multipart_upload_complete', {'token': upload['token']})
+
+    def assertNothingReserved(self):
+        self.project.refresh_from_db()
+        self.assertEqual(self.project.used_bytes, 0)
+        self.assertFalse(UploadedFile.objects.exists())
+
+    def test_upload_all_parts_and_complete(self):
+        upload = self.initiate()
+        self.put_part(upload, 1, self.part_size)
+        self.put_part(upload, 2, 10)
+
+        status, body = self.complete(upload)
+        self.assertEqual(status, 200)
+        self.assertEqual(UploadedFile.objects.get(id=body['id']).size, self.size)
+        self.project.refresh_from_db()
+        self.assertEqual(self.project.used_bytes, self.size)
+
+    def test_missing_part_is_rejected(self):
+        upload = self.initiate()
+        self.put_part(upload, 2, 10)
+        self.assertEqual(self.complete(upload)[0], 400)
+        self.assertNothingReserved()
+
+    def test_size_must_match_the_declared_size(self):
+        upload = self.initiate()
+        self.put_part(upload, 1, self.part_size)
+        self.put_part(upload, 2, 1000)
+        self.assertEqual(self.complete(upload)[0], 400)
+        self.assertNothingReserved()
+
+    def test_part_numbers_beyond_the_file_are_refused(self):
+        upload = self.initiate()
+        status, _ = self.post_json('multipart_upload_part_urls', {'token': upload['token'], 'part_numbers': 3})
+        self.assertEqual(status, 400)
+
+    def test_aborted_upload_is_a_409(self):
+        upload = self.initiate()
+        self.put_part(upload, 1, self.part_size)
+        self.assertEqual(self.post_json('multipart_upload_abort', {'token': upload['token']})[0], 200)
+
+        self.assertEqual(self.post_json('multipart_upload_parts', {'token': upload['token']})[0], 409)
+        self.assertEqual(self.complete(upload)[0], 409)
+        # Aborting again is harmless
+        self.assertEqual(self.post_json('multipart_upload_abort', {'token': upload['token']})[0], 200)
+        self.assertNothingReserved()
+
+    @override_settings(MULTIPART_UPLOAD_PART_SIZE=1024)
+    def test_parts_s3_refuses_release_the_reservation(self):
+        upload = self.initiate(size=1034)
+        self.put_part(upload, 1, 1024)
+        self.put_part(upload, 2, 10)
+
+        status, body = self.complete(upload)
+        self.assertEqual(status, 400)
+        self.assertIn('invalid', body['error'])
+        self.assertNothingReserved()
+
+
+@override_settings(STREAMING_UPLOAD_PART_SIZE=5 * 1024 ** 2)
+class StreamingUploadTests(S3TestCase):
+    """Form uploads streamed into S3 while the request body is parsed"""
+
+    part_size = 5 * 1024 ** 2
+
+    def setUp(self):
+        super().setUp()
+        self.client = Client(enforce_csrf_checks=True)
+        self.client.force_login(self.user)
+        self.url = reverse('upload_to_project', args=[self.project.id])
+
+    def stored_keys(self):
+        return [obj['Key'] for obj in get_s3_client().list_objects_v2(Bucket='test-bucket').get('Contents', [])]
+
+    def csrf_token(self):
+        self.client.get(self.url)
+        return self.client.cookies['csrftoken'].value
+
+    def test_full_parts_are_sent_as_they_fill(self):
+        upload = S3StreamingUpload('streamed.bin', 'application/octet-stream', self.part_size)
+        content = b'a' * (2 * 1024 ** 2)
+        upload.write(content)
+        upload.write(content)
+        self.assertIsNone(upload.upload_id)
+        upload.write(content)  # past a part's worth: the first part goes
+        self.assertIsNotNone(upload.upload_id)
+        self.assertEqual(len(upload.buffer), 0)
+        upload.write(content)  # the last, smaller part is sent on completion
+
+        self.assertEqual(upload.complete(), hashlib.sha256(content * 4).hexdigest())
+        self.assertEqual(len(upload.parts), 2)
+        self.assertEqual(get_object('streamed.bin')['Body'].read(), content * 4)
+
+    def test_small_file_is_a_single_put(self):
+        upload = S3StreamingUpload('small.txt', 'text/plain', self.part_size)
+        upload.write(b'hello')
+        upload.complete()
+        self.assertIsNone(upload.upload_id)
+        self.assertEqual(get_object('small.txt')['Body'].read(), b'hello')
+
+    def test_failed_part_aborts_the_upload(self):
+        upload = S3StreamingUpload('failed.bin', 'application/octet-stream', self.part_size)
+        with mock.patch.object(upload, 'send_part', side_effect=OSError('connection reset')):
+            upload.write(b'a' * self.part_size)
+            with self.assertRaises(OSError):
+                upload.complete()
+        self.assertFalse(get_s3_client().list_multipart_uploads(Bucket='test-bucket').get('Uploads'))
+        self.assertEqual(self.stored_keys(), [])
+
+    def test_upload_with_token(self):
+        response = self.client.post(self.url, {
+            'csrfmiddlewaretoken': self.csrf_token(), 'file': ContentFile(b'hello', name='hello.txt'),
+        })
+        self.assertEqual(response.status_code, 302)
+        file = UploadedFile.objects.get()
+        self.assertEqual(self.stored_keys(), [file.file.name])
+
+    def test_forged_upload_sends_nothing(self):
+        self.csrf_token()
+        with mock.patch.object(S3StreamingUpload, 'write') as write:
+            response = self.client.post(self.url, {
+                'csrfmiddlewaretoken': 'forged', 'file': ContentFile(b'hello', name='hello.txt'),
+            })
+        self.assertEqual(response.status_code, 403)
+        write.assert_not_called()
+        self.assertEqual(self.stored_keys(), [])
+
+    def test_token_in_header(self):
+        response = self.client.post(
+            self.url, {'file': ContentFile(b'hello', name='hello.txt')}, headers={'X-CSRFToken': self.csrf_token()},
+        )
+        self.assertEqual(response.status_code, 302)
+
+    def test_second_file_is_refused(self):
+        response = self.client.post(self.url, {
+            'csrfmiddlewaretoken': self.csrf_token(),
+            'file': [ContentFile(b'one', name='one.txt'), ContentFile(b'two', name='two.txt')],
+        })
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.stored_keys(), [])
+        self.assertFalse(UploadedFile.objects.exists())
+
+    def test_rejected_upload_is_discarded(self):
+        with mock.patch('uploads.views.reserve', side_effect=QuotaExceeded('Project is full.')):
+            response = self.client.post(self.url, {
+                'csrfmiddlewaretoken': self.csrf_token(), 'file': ContentFile(b'hello', name='hello.txt'),
+            })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.stored_keys(), [])
+
+
+class FileMetadataTests(S3TestCase):
+    """Size, content type and checksum, recorded on upload or backfilled from S3"""
+
+    content = b'hello world'
+
+    def upload(self, client=None):
+        return (client or self.client).post(reverse('upload_to_project', args=[self.project.id]), {
+            'file': SimpleUploadedFile('notes.txt', self.content, content_type='text/plain'),
+        })
+
+    def assertMetadata(self, file):
+        self.assertEqual(
+            (file.size, file.content_type, file.checksum),
+            (len(self.content), 'text/plain', hashlib.sha256(self.content).hexdigest()),
+        )
+
+    def test_form_upload_records_metadata(self):
+        self.assertEqual(self.upload().status_code, 302)
+        file = UploadedFile.objects.get()
+        self.assertMetadata(file)
+        self.assertEqual(head_object(file.file.name)['ContentType'], 'text/plain')
+
+    async def test_form_upload_under_asgi_records_metadata(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.upload(self.async_client)
+        self.assertEqual(response.status_code, 302)
+        self.assertMetadata(await UploadedFile.objects.aget())
+
+    @override_settings(CONTENT_ADDRESSED_STORAGE=True)
+    def test_content_addressed_upload_records_metadata(self):
+        self.assertEqual(self.upload().status_code, 302)
+        file = UploadedFile.objects.get()
+        self.assertMetadata(file)
+        self.assertEqual(file.checksum, file.blob.sha256)
+
+    def add_file(self, key, content=None, **params):
+        if content is not None:
+            get_s3_client().put_object(Bucket='test-bucket', Key=key, Body=content, **params)
+        file = UploadedFile(user=self.user, project=self.project)
+        file.file.name = key
+        file.save()
+        return file
+
+    def test_backfill(self):
+        folder = self.project.get_s3_folder_name()
+        plain = self.add_file(f'{folder}notes.txt', self.content, ContentType='text/plain', ChecksumAlgorithm='SHA256')
+        unknown = self.add_file(f'{folder}data.bin', b'\x00' * 3)
+        missing = self.add_file(f'{folder}gone.txt')
+        shared = UploadedFile(user=self.user, project=self.project, original_filename='shared.txt')
+        shared.blob = store_file(ContentFile(b'shared', name='shared.txt'))
+        shared.file.name = shared.blob.key
+        shared.save()
+        # Rows with metadata already are left alone
+        recorded = self.add_file(f'{folder}recorded.txt', b'abc')
+        UploadedFile.objects.filter(id=recorded.id).update(size=99, content_type='text/csv')
+
+        out, err = io.StringIO(), io.StringIO()
+        call_command('backfill_file_metadata', '--batch-size', '2', stdout=out, stderr=err)
+
+        for file in (plain, unknown, missing, shared, recorded):
+            file.refresh_from_db()
+        self.assertMetadata(plain)
+        self.assertEqual((unknown.size, unknown.checksum), (3, ''))
+        self.assertEqual((shared.size, shared.checksum), (6, hashlib.sha256(b'shared').hexdigest()))
+        self.assertIsNone(missing.size)
+        self.assertEqual((recorded.size, recorded.content_type), (99, 'text/csv'))
+        self.assertIn(f"Missing object for file {missing.id}", err.getvalue())
+        self.assertIn("Backfilled 3 file(s); 1 had no object in storage.", out.getvalue())
+
+        # Only the missing object is looked up again
+        with mock.patch('uploads.management.commands.backfill_file_metadata.head_object', return_value=None) as head:
+            call_command('backfill_file_metadata', stdout=out, stderr=err)
+        self.assertEqual([call.args[0] for call in head.call_args_list], [missing.file.name])
+
+
+@override_settings(STORAGES=TEST_STORAGES, AUDIT_LOG_BACKGROUND=False)
+class MemberImportTests(TestCase):
+    """Adding members in bulk from pasted text or a CSV"""
+
+    def setUp(self):
+        cache.clear()
+        self.creator = User.objects.create_user('creator', 'creator@example.com', 'password')
+        self.project = create_project(self.creator, 'Team')
+        self.alice = User.objects.create_user('alice', 'Alice@Example.com', 'password')
+        self.root = User.objects.create_user('root', 'root@example.com', 'password')
+        User.objects.create_user('admin', 'admin@example.com', 'password')
+        User.objects.create_user('user', 'user@example.com', 'password')
+
+    def member_names(self):
+        return list(ProjectMembership.objects.filter(project=self.project).values_list('user__username', flat=True))
+
+    def test_pasted_entries_are_never_split_on_spaces(self):
+        self.assertEqual(
+            parse_identifiers('Admin User, root;Jane Doe <Jane@Example.com>\nalice\r\n\n'),
+            ['admin user', 'root', 'jane@example.com', 'alice'],
+        )
+
+    def test_csv_reads_only_the_identifier_column(self):
+        self.assertEqual(parse_csv('Name,Username\nAdmin User,root\nNo Login,\n'), ['root'])
+        # With both columns, each row gives its email
+        self.assertEqual(parse_csv('username,email\nalice,ALICE@example.com\nroot,\n'), ['alice@example.com', 'root'])
+
+    def test_csv_without_an_identifier_column_is_refused(self):
+        with self.assertRaises(ValueError):
+            parse_csv('Admin User,root\n')
+
+    def test_resolve_users(self):
+        User.objects.create_user('gone', 'gone@example.com', 'password', is_active=False)
+        users, unmatched = resolve_users(['alice@example.com', 'root', 'admin user', 'gone', 'root'])
+        self.assertEqual({user.username for user in users}, {'alice', 'root'})
+        self.assertEqual(unmatched, ['admin user', 'gone'])
+
+    def test_name_cells_grant_nothing(self):
+        admin = User.objects.create_superuser('superuser', 'superuser@example.com', 'password')
+        self.client.force_login(admin)
+        csv_file = ContentFile(b'Admin User,root\n', name='members.csv')
+        response = self.client.post(reverse('manage_project_members', args=[self.project.id]), {'csv_file': csv_file})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.member_names(), ['creator'])
+
+    def test_add_members_invalidates_cached_memberships(self):
+        self.assertFalse(is_project_member(User.objects.get(id=self.alice.id), self.project))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(add_members(self.project, [self.alice.id, self.creator.id], self.creator), 1)
+        self.assertTrue(is_project_member(User.objects.get(id=self.alice.id), self.project))
+
+    def test_creator_cannot_be_removed(self):
+        add_members(self.project, [self.alice.id], self.creator)
+        self.assertEqual(remove_members(self.project, [self.alice.id, self.creator.id]), 1)
+        self.assertEqual(self.member_names(), ['creator'])
+
+
+@override_settings(STORAGES=TEST_STORAGES, SHARED_CACHE=True)
+class FragmentCacheTests(TestCase):
+    """Cached project cards are re-rendered once a change is committed"""
+
+    template = 'uploads/fragments/project_card.html'
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('member', 'member@example.com', 'password')
+        self.project = create_project(self.user, 'Cards', files=2)
+
+    def card(self):
+        return str(project_cards([self.project.id], self.template)[0])
+
+    def test_unchanged_project_is_served_from_the_cache(self):
+        self.card()
+        with self.assertNumQueries(0):
+            self.card()
+
+    def test_save_rerenders(self):
+        self.card()
+        self.project.name = 'Renamed'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.project.save()
+        self.assertIn('Renamed', self.card())
+
+    def test_file_delete_rerenders(self):
+        self.assertIn('2 files', self.card())
+        with self.captureOnCommitCallbacks(execute=True):
+            UploadedFile.objects.filter(project=self.project).first().delete()
+        self.assertIn('1 file ', self.card())
+
+    def test_membership_change_rerenders(self):
+        self.assertIn('1 member<', self.card())
+        other = User.objects.create_user('other', 'other@example.com', 'password')
+        with self.captureOnCommitCallbacks(execute=True):
+            membership = ProjectMembership.objects.create(project=self.project, user=other, added_by=self.user)
+        self.assertIn('2 members', self.card())
+        with self.captureOnCommitCallbacks(execute=True):
+            membership.delete()
+        self.assertIn('1 member<', self.card())
+
+    @override_settings(SHARED_CACHE=False)
+    def test_nothing_is_cached_without_a_shared_cache(self):
+        self.card()
+        # A change another process made, which this one would hear nothing about
+        Project.objects.filter(id=self.project.id).update(name='Elsewhere')
+        self.assertIn('Elsewhere', self.card())
+
+
+class ProjectZipTests(S3TestCase):
+    """A project's files streamed as one ZIP, read from the rows as it's written"""
+
+    def setUp(self):
+        super().setUp()
+        folder = self.project.get_s3_folder_name()
+        for name, content in (('a.txt', b'first'), ('b.txt', b'second')):
+            get_s3_client().put_object(Bucket='test-bucket', Key=f'{folder}{name}', Body=content)
+            file = UploadedFile(user=self.user, project=self.project)
+            file.file.name = f'{folder}{name}'
+            file.save()
+        # A second row for the same object and name is only added once
+        duplicate = UploadedFile(user=self.user, project=self.project)
+        duplicate.file.name = f'{folder}a.txt'
+        duplicate.save()
+        # Different files with the same name are numbered
+        for key, content in ((f'{folder}x/a.txt', b'third'), (f'{folder}y/a.txt', b'fourth')):
+            get_s3_client().put_object(Bucket='test-bucket', Key=key, Body=content)
+            file = UploadedFile(user=self.user, project=self.project)
+            file.file.name = key
+            file.save()
+        self.url = reverse('download_project_zip', args=[self.project.id])
+
+    def assertArchive(self, content):
+        archive = zipfile.ZipFile(io.BytesIO(content))
+        self.assertEqual(archive.namelist(), ['a.txt', 'b.txt', 'a (2).txt', 'a (3).txt'])
+        self.assertEqual(archive.read('b.txt'), b'second')
+        self.assertEqual(archive.read('a (3).txt'), b'fourth')
+
+    def test_unique_arcnames(self):
+        taken = {}
+        names = ['report.pdf', 'report.pdf', 'report (2).pdf', 'report.pdf', 'README', 'README']
+        self.assertEqual([unique_arcname(name, taken) for name in names], [
+            'report.pdf', 'report (2).pdf', 'report (2) (2).pdf', 'report (3).pdf', 'README', 'README (2)',
+        ])
+
+    def test_zip_under_wsgi(self):
+        response = self.client.get(self.url)
+        self.assertArchive(b''.join(response.streaming_content))
+
+    async def test_zip_under_asgi(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(self.url)
+        self.assertArchive(b''.join([chunk async for chunk in response.streaming_content]))
+
+
+class SearchTests(S3TestCase):
+    """Search covers only the user's own projects, through indexes the triggers keep in sync"""
+
+    def setUp(self):
+        super().setUp()
+        self.other = User.objects.create_user('other', 'other@example.com', 'password')
+        self.secret = create_project(self.other, 'Secret plans')
+        self.add_file(self.project, 'annual-report.pdf')
+        self.add_file(self.secret, 'secret-report.pdf', user=self.other)
+
+    def add_file(self, project, name, user=None):
+        file = UploadedFile(user=user or self.user, project=project)
+        file.file.name = f'{project.get_s3_folder_name()}{name}'
+        file.save()
+        return file
+
+    def search(self, **params):
+        response = self.client.get(reverse('search'), {'format': 'json', **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def names(self, query):
+        return sorted(file.filename for file in search_files(query))
+
+    def test_only_members_projects_are_searched(self):
+        results = self.search(q='report')
+        self.assertEqual([file['filename'] for file in results['files']], ['annual-report.pdf'])
+        self.assertEqual(self.search(q='secret'), {'query': 'secret', 'projects': [], 'files': [], 'next_cursor': None})
+
+        ProjectMembership.objects.create(project=self.secret, user=self.user, added_by=self.other)
+        cache.clear()
+        results = self.search(q='secret')
+        self.assertEqual([project['name'] for project in results['projects']], ['Secret plans'])
+        self.assertEqual([file['filename'] for file in results['files']], ['secret-report.pdf'])
+
+    def test_superusers_search_everything(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        results = self.search(q='report')
+        self.assertEqual(sorted(file['filename'] for file in results['files']), ['annual-report.pdf', 'secret-report.pdf'])
+
+    def test_index_follows_inserts_renames_and_deletes(self):
+        self.assertEqual(self.names('quarterly'), [])
+        file = self.add_file(self.project, 'quarterly.csv')
+        self.assertEqual(self.names('quarterly'), ['quarterly.csv'])
+        # Short queries fall back to a LIKE over the same index
+        self.assertEqual(self.names('qu'), ['quarterly.csv'])
+
+        file.original_filename = 'yearly.csv'
+        file.save()
+        self.assertEqual(self.names('quarterly'), [])
+        self.assertEqual(self.names('yearly'), ['yearly.csv'])
+
+        file.delete()
+        self.assertEqual(self.names('yearly'), [])
+
+        self.project.name = 'Renamed project'
+        self.project.save()
+        self.assertEqual([project.name for project in search_projects('renamed')], ['Renamed project'])
+        self.assertEqual(list(search_projects('uploads')), [])
+
+    def test_file_results_are_paged(self):
+        for i in range(5):
+            self.add_file(self.project, f'log-{i}.txt')
+
+        names, cursor = [], None
+        while True:
+            params = {'q': 'log-', 'page_size': 2}
+            if cursor:
+                params['cursor'] = cursor
+            results = self.search(**params)
+            self.assertLessEqual(len(results['files']), 2)
+            if cursor:
+                self.assertEqual(results['projects'], [])
+            names += [file['filename'] for file in results['files']]
+            cursor = results['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(names, [f'log-{i}.txt' for i in reversed(range(5))])
+        self.assertContains(self.client.get(reverse('search'), {'q': 'log-', 'page_size': 2}), 'Older files')
+
+    def test_bad_page_size_or_cursor(self):
+        for params in ({'page_size': 'lots'}, {'page_size': 0}, {'cursor': 'not-a-cursor'}):
+            with self.subTest(**params):
+                response = self.client.get(reverse('search'), {'q': 'report', **params})
+                self.assertEqual(response.status_code, 400)
+
+
+class AsyncS3ClientTests(S3TestCase):
+    async def test_lifespan_loop_shares_one_client(self):
+        received, started = asyncio.Queue(), asyncio.Event()
+        sent = []
+
+        async def send(message):
+            sent.append(message['type'])
+            started.set()
+
+        task = asyncio.create_task(aio.lifespan(None)({'type': 'lifespan'}, received.get, send))
+        await received.put({'type': 'lifespan.startup'})
+        await started.wait()
+
+        async with aio.client() as first:
+            pass
+        async with aio.client() as second:
+            self.assertIs(second, first)
+
+        await received.put({'type': 'lifespan.shutdown'})
+        await task
+        self.assertEqual(sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+        self.assertNotIn(asyncio.get_running_loop(), aio.loop_clients)
+        # Without a lifespan, each call has a client of its own
+        async with aio.client() as third:
+            self.assertIsNot(third, first)
+
+    async def test_per_call_client_without_lifespan(self):
+        async with aio.client() as first:
+            pass
+        async with aio.client() as second:
+            self.assertIsNot(second, first)
+
+
+@override_settings(STORAGES={
+    "default": {"BACKEND": "uploads.storage.CachingS3Storage", "OPTIONS": {"cache_max_size": 1000}},
+    "staticfiles": TEST_STORAGES["staticfiles"],
+})
+class CachedProxyTests(S3TestCase):
+    """proxy_file serving from the local read cache"""
+
+    def setUp(self):
+        super().setUp()
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        default_storage.cache_dir = Path(cache_dir.name)
+        key = f'{self.project.get_s3_folder_name()}cached.txt'
+        get_s3_client().put_object(Bucket='test-bucket', Key=key, Body=b'cached content')
+        self.file = UploadedFile(user=self.user, project=self.project, content_type='text/plain')
+        self.file.file.name = key
+        self.file.save()
+        self.url = reverse('proxy_file', args=[self.file.id])
+
+    async def test_streams_asynchronously_under_asgi(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(self.url)
+        self.assertTrue(response.is_async)
+        self.assertEqual(response['Content-Length'], '14')
+        self.assertEqual(response['Content-Type'], 'text/plain')
+        self.assertEqual(b''.join([chunk async for chunk in response.streaming_content]), b'cached content')
+
+    def test_file_response_under_wsgi(self):
+        response = self.client.get(self.url)
+        self.assertFalse(response.is_async)
+        self.assertEqual(b''.join(response.streaming_content), b'cached content')
+
+
+class CachingS3StorageTests(S3TestCase):
+    """The read cache: ETag revalidation, size limits, LRU eviction and stats"""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.addCleanup(cache.clear)
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.storage = CachingS3Storage(cache_dir=cache_dir.name, cache_max_size=1000, cache_max_object_size=400)
+        self.s3 = get_s3_client()
+
+    def put(self, name, body):
+        self.s3.put_object(Bucket='test-bucket', Key=name, Body=body)
+
+    def test_hits_are_revalidated_without_a_transfer(self):
+        self.put('a.txt', b'a' * 100)
+        with mock.patch.object(self.storage.client, 'get_object', wraps=self.storage.client.get_object) as get:
+            path = self.storage.cached_path('a.txt')
+            self.assertEqual(self.storage.cached_path('a.txt'), path)
+        self.assertEqual(path.read_bytes(), b'a' * 100)
+        self.assertEqual(get.call_count, 1)
+
+        # A changed object is fetched again, replacing the copy's bytes in the total
+        self.put('a.txt', b'b' * 150)
+        self.assertEqual(self.storage.cached_path('a.txt').read_bytes(), b'b' * 150)
+        self.assertEqual(self.storage.stats(), {
+            'hits': 1, 'misses': 2, 'evictions': 0, 'hit_rate': 1 / 3, 'cached_bytes': 150,
+        })
+
+    def test_objects_too_big_to_cache_are_not_downloaded(self):
+        self.put('big.bin', b'x' * 401)
+        with mock.patch.object(self.storage.client, 'get_object') as get:
+            self.assertIsNone(self.storage.cached_path('big.bin'))
+        get.assert_not_called()
+        self.assertEqual(self.storage.scan(), [])
+        # Read straight from S3 instead
+        with self.storage.open('big.bin') as f:
+            self.assertEqual(f.read(), b'x' * 401)
+
+    def test_least_recently_used_objects_are_evicted(self):
+        for name in ('a.txt', 'b.txt'):
+            self.put(name, name[0].encode() * 400)
+            self.storage.cached_path(name)
+        os.utime(self.storage.entry_path('a.txt'), (100, 100))
+        os.utime(self.storage.entry_path('b.txt'), (200, 200))
+        # A hit makes a.txt the most recently used
+        self.storage.cached_path('a.txt')
+
+        self.put('c.txt', b'c' * 400)
+        self.storage.cached_path('c.txt')
+
+        self.assertFalse(self.storage.entry_path('b.txt').exists())
+        self.assertFalse(self.storage.entry_path('b.txt').with_suffix('.etag').exists())
+        self.assertTrue(self.storage.entry_path('a.txt').exists())
+        stats = self.storage.stats()
+        self.assertEqual((stats['evictions'], stats['cached_bytes']), (1, 800))
+
+    def test_copy_without_its_etag_is_not_counted_twice(self):
+        self.put('a.txt', b'a' * 300)
+        path = self.storage.cached_path('a.txt')
+        path.with_suffix('.etag').unlink()
+
+        self.assertEqual(self.storage.cached_path('a.txt'), path)
+        self.assertTrue(path.with_suffix('.etag').exists())
+        self.assertEqual(self.storage.stats()['cached_bytes'], 300)
+
+    def test_object_replaced_between_head_and_get(self):
+        self.put('a.txt', b'old')
+        head_object = self.storage.client.head_object
+
+        def replace_after_head(**params):
+            response = head_object(**params)
+            if not self.replaced:
+                self.replaced = True
+                self.put('a.txt', b'new!')
+            return response
+
+        self.replaced = False
+        with mock.patch.object(self.storage.client, 'head_object', side_effect=replace_after_head):
+            self.assertEqual(self.storage.cached_path('a.txt').read_bytes(), b'new!')
+        self.assertEqual(self.storage.stats()['cached_bytes'], 4)
+
+
+@override_settings(PROFILING_ENABLED=True, PROFILING_SAMPLE_RATE=1.0)
+class ProfilingMiddlewareTests(S3TestCase):
+    """Sampled requests are timed, S3 calls included, whether the stack is sync or async"""
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(profiling, 'records', deque())
+        self.records = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.request = RequestFactory().get('/')
+
+    def view(self, request):
+        list(Project.objects.all())
+        default_storage.exists('missing.txt')
+        return HttpResponse(b'hello')
+
+    def assertProfiled(self, response, queries):
+        record = self.records[-1]
+        self.assertEqual((record['view'], record['status'], record['size']), ('unresolved', 200, 5))
+        self.assertEqual((record['queries'], record['s3_calls']), (queries, 1))
+        self.assertIn('s3;dur=', response['Server-Timing'])
+        self.assertIn('desc="1 calls"', response['Server-Timing'])
+
+    def test_sync_requests(self):
+        middleware = ProfilingMiddleware(self.view)
+        with connection.execute_wrapper(profiling.record_query):
+            response = middleware(self.request)
+        self.assertProfiled(response, queries=1)
+
+    async def test_async_requests(self):
+        middleware = ProfilingMiddleware(sync_to_async(self.view))
+        self.assertTrue(middleware.async_mode)
+        # As under ASGI, the request's sync code gets a thread of its own, whose
+        # storage connection nothing else has instrumented
+        async with ThreadSensitiveContext():
+            response = await middleware(self.request)
+        self.assertProfiled(response, queries=0)
+
+    def test_unsampled_requests_are_not_recorded(self):
+        with override_settings(PROFILING_SAMPLE_RATE=0.0):
+            response = ProfilingMiddleware(self.view)(self.request)
+        self.assertFalse(self.records)
+        self.assertFalse(response.has_header('Server-Timing'))
+
+
+class TunedS3StorageTests(S3TestCase):
+    def test_client_is_shared_and_resources_are_per_thread(self):
+        seen = {}
+
+        def use_storage():
+            seen.update(client=default_storage.client, connection=default_storage.connection)
+
+        thread = threading.Thread(target=use_storage)
+        thread.start()
+        thread.join()
+        # boto3 clients are thread-safe; resources aren't
+        self.assertIs(seen['client'], default_storage.client)
+        self.assertIsNot(seen['connection'], default_storage.connection)
+        self.assertEqual(get_s3_client().list_buckets()['Buckets'][0]['Name'], 'test-bucket')
+
+
+@override_settings(STORAGES=TEST_STORAGES, AUDIT_LOG_BACKGROUND=False)
+class InvitationTests(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.client.force_login(self.admin)
+
+    def invite(self, email, expires_in=timedelta(days=7), accepted=False):
+        return Invitation.objects.create(
+            email=email, invited_by=self.admin, expires_at=timezone.now() + expires_in, is_accepted=accepted
+        )
+
+    def test_status(self):
+        self.invite('pending@example.com')
+        self.invite('expired@example.com', expires_in=timedelta(days=-1))
+        # An accepted invitation stays accepted after it expires
+        self.invite('accepted@example.com', expires_in=timedelta(days=-1), accepted=True)
+
+        statuses = dict(Invitation.objects.with_status().values_list('email', 'status'))
+        self.assertEqual(statuses, {
+            'pending@example.com': Invitation.Status.PENDING,
+            'expired@example.com': Invitation.Status.EXPIRED,
+            'accepted@example.com': Invitation.Status.ACCEPTED,
+        })
+        for status in Invitation.Status.values:
+            emails = Invitation.objects.with_status_of(status).values_list('email', flat=True)
+            self.assertEqual(list(emails), [f'{status}@example.com'])
+
+    def test_purge_expired_in_batches(self):
+        for i in range(5):
+            self.invite(f'old{i}@example.com', expires_in=timedelta(days=-40))
+        self.invite('recent@example.com', expires_in=timedelta(days=-1))
+        self.invite('accepted@example.com', expires_in=timedelta(days=-40), accepted=True)
+        self.invite('pending@example.com')
+
+        progress = []
+        self.assertEqual(purge_expired(retention_days=30, batch_size=2, on_progress=progress.append), 5)
+        self.assertEqual(progress, [2, 4, 5])
+        self.assertEqual(
+            set(Invitation.objects.values_list('email', flat=True)),
+            {'recent@example.com', 'accepted@example.com', 'pending@example.com'},
+        )
+
+    @override_settings(INVITATION_LIST_PAGE_SIZE=2)
+    def test_list_pages(self):
+        for i in range(5):
+            self.invite(f'user{i}@example.com')
+
+        emails, cursor = [], None
+        while True:
+            response = self.client.get(reverse('invitation_list'), {'cursor': cursor} if cursor else {})
+            self.assertEqual(response.status_code, 200)
+            page = response.context['invitations']
+            self.assertLessEqual(len(page), 2)
+            emails += [invitation.email for invitation in page]
+            cursor = response.context['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(emails, [f'user{i}@example.com' for i in reversed(range(5))])
+
+    def test_list_filters_by_status(self):
+        self.invite('pending@example.com')
+        self.invite('expired@example.com', expires_in=timedelta(days=-1))
+
+        response = self.client.get(reverse('invitation_list'), {'status': 'expired'})
+        self.assertEqual([i.email for i in response.context['invitations']], ['expired@example.com'])
+        self.assertEqual(response.context['invitations'][0].status, Invitation.Status.EXPIRED)
+
+    def test_list_rejects_bad_status_or_cursor(self):
+        self.assertEqual(self.client.get(reverse('invitation_list'), {'status': 'bogus'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('invitation_list'), {'cursor': 'not-a-cursor'}).status_code, 400)
+
+    def test_create_replaces_expired_invitation(self):
+        expired = self.invite('someone@example.com', expires_in=timedelta(days=-1))
+
+        response = self.client.post(reverse('create_invitation'), {'email': 'someone@example.com'})
+        self.assertEqual(response.status_code, 200)
+        invitation = Invitation.objects.get(email='someone@example.com')
+        self.assertNotEqual(invitation.id, expired.id)
+        self.assertEqual(invitation.invited_by, self.admin)
+
+    def test_invalid_form_keeps_expired_invitation(self):
+        expired = self.invite('admin@example.com', expires_in=timedelta(days=-1))
+
+        # The address belongs to a user, so the form fails and nothing is replaced
+        response = self.client.post(reverse('create_invitation'), {'email': 'admin@example.com'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['form'].errors)
+        self.assertTrue(Invitation.objects.filter(id=expired.id).exists())
+
+    def test_pending_invitation_blocks_another(self):
+        self.invite('someone@example.com')
+
+        response = self.client.post(reverse('create_invitation'), {'email': 'someone@example.com'})
+        self.assertIn('email', response.context['form'].errors)
+        self.assertEqual(Invitation.objects.filter(email='someone@example.com').count(), 1)
+
+
+@override_settings(STORAGES=TEST_STORAGES, PROJECT_MAX_BYTES=100, PROJECT_MAX_FILES=3, USER_MAX_BYTES=150, USER_MAX_FILES=None)
+class QuotaTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('member', 'member@example.com', 'password')
+        self.project = create_project(self.user, 'Limited')
+
+    def usage(self):
+        self.project.refresh_from_db()
+        quota = UserQuota.objects.get(user=self.user)
+        return (self.project.used_bytes, self.project.used_files), (quota.used_bytes, quota.used_files)
+
+    def test_reserve_and_release(self):
+        reserve(self.project, self.user, 60)
+        reserve(self.project, self.user, 40)
+        self.assertEqual(self.usage(), ((100, 2), (100, 2)))
+
+        release(self.project.id, self.user.id, 60)
+        self.assertEqual(self.usage(), ((40, 1), (40, 1)))
+
+    def test_exact_fit(self):
+        check_quota(self.project, self.user, 100)
+        reserve(self.project, self.user, 100)
+        with self.assertRaises(QuotaExceeded):
+            check_quota(self.project, self.user, 1)
+        with self.assertRaises(QuotaExceeded):
+            reserve(self.project, self.user, 1)
+        self.assertEqual(self.usage(), ((100, 1), (100, 1)))
+
+    def test_file_limit(self):
+        reserve(self.project, self.user, 1, files=3)
+        with self.assertRaises(QuotaExceeded):
+            reserve(self.project, self.user, 0)
+        # An empty upload with no file counted still fits
+        reserve(self.project, self.user, 0, files=0)
+
+    def test_failed_reservation_changes_nothing(self):
+        # The project has room; the user's quota, checked second, doesn't
+        other = create_project(self.user, 'Other')
+        reserve(other, self.user, 100)
+        with self.assertRaises(QuotaExceeded) as raised:
+            reserve(self.project, self.user, 60)
+        self.assertIn('your', str(raised.exception))
+        self.assertEqual(self.usage(), ((0, 0), (100, 1)))
+
+    def test_own_limits_override_the_defaults(self):
+        Project.objects.filter(id=self.project.id).update(max_bytes=10)
+        with self.assertRaises(QuotaExceeded):
+            reserve(self.project, self.user, 11)
+        UserQuota.objects.update_or_create(user=self.user, defaults={'max_bytes': 1000})
+        Project.objects.filter(id=self.project.id).update(max_bytes=500)
+        reserve(self.project, self.user, 400)
+        self.assertEqual(self.usage(), ((400, 1), (400, 1)))
+
+    def test_checks_do_not_create_the_users_row(self):
+        with self.assertNumQueries(2):
+            check_quota(self.project, self.user, 100)
+        with self.assertNumQueries(2):
+            self.assertEqual(remaining_bytes(self.project, self.user), 100)
+        with self.assertRaises(QuotaExceeded) as raised, override_settings(PROJECT_MAX_BYTES=None):
+            check_quota(self.project, self.user, 151)
+        self.assertIn('your', str(raised.exception))
+        self.assertFalse(UserQuota.objects.filter(user=self.user).exists())
+
+        reserve(self.project, self.user, 10)
+        self.assertEqual(self.usage(), ((10, 1), (10, 1)))
+
+    def test_remaining_bytes(self):
+        self.assertEqual(remaining_bytes(self.project, self.user), 100)
+        other = create_project(self.user, 'Other')
+        Project.objects.filter(id=other.id).update(max_bytes=1000)
+        reserve(other, self.user, 120)
+        # Limited by the user's quota now
+        self.assertEqual(remaining_bytes(self.project, self.user), 30)
+        with override_settings(PROJECT_MAX_BYTES=None, USER_MAX_BYTES=None):
+            self.assertIsNone(remaining_bytes(self.project, self.user))
+
+
+class JobQueueTests(TestCase):
+    def setUp(self):
+        self.calls = []
+        self.registry = mock.patch.dict(jobs.registry, {
+            'succeed': lambda job, **payload: self.calls.append(payload),
+            'fail': self.fail_job,
+        })
+        self.registry.start()
+        self.addCleanup(self.registry.stop)
+        # Failures are expected here; keep their tracebacks out of the test output
+        logger = mock.patch.object(jobs.logger, 'exception')
+        self.log = logger.start()
+        self.addCleanup(logger.stop)
+
+    def fail_job(self, job, **payload):
+        self.calls.append(payload)
+        raise RuntimeError("boom")
+
+    def test_run_marks_the_job_done(self):
+        instance = jobs.enqueue('succeed', value=1)
+        claimed = jobs.claim('worker')
+        self.assertEqual(claimed.id, instance.id)
+        self.assertEqual(claimed.status, Job.Status.RUNNING)
+        self.assertEqual(claimed.locked_by, 'worker')
+
+        jobs.run(claimed)
+        instance.refresh_from_db()
+        self.assertEqual(self.calls, [{'value': 1}])
+        self.assertEqual((instance.status, instance.attempts, instance.locked_by), (Job.Status.DONE, 1, ''))
+        self.assertIsNone(jobs.claim('worker'))
+
+    @override_settings(JOBS_RETRY_BACKOFF=30)
+    def test_retry_backoff_doubles(self):
+        instance = jobs.enqueue('fail', max_attempts=5)
+        delays = []
+        for attempt in range(3):
+            claimed = jobs.claim('worker')
+            self.assertEqual(claimed.id, instance.id)
+            before = timezone.now()
+            jobs.run(claimed)
+            instance.refresh_from_db()
+            self.assertEqual(instance.status, Job.Status.QUEUED)
+            self.assertIn('boom', instance.error)
+            delays.append(round((instance.run_after - before).total_seconds()))
+            # Not runnable until the backoff has passed
+            self.assertIsNone(jobs.claim('worker'))
+            Job.objects.filter(id=instance.id).update(run_after=timezone.now())
+        self.assertEqual(delays, [30, 60, 120])
+
+    def test_max_attempts(self):
+        instance = jobs.enqueue('fail', max_attempts=2)
+        for attempt in range(2):
+            jobs.run(jobs.claim('worker'))
+            Job.objects.filter(id=instance.id, status=Job.Status.QUEUED).update(run_after=timezone.now())
+
+        instance.refresh_from_db()
+        self.assertEqual((instance.status, instance.attempts), (Job.Status.FAILED, 2))
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(self.log.call_count, 2)
+        self.assertIsNone(jobs.claim('worker'))
+
+    def test_claim_takes_jobs_in_order(self):
+        later = jobs.enqueue('succeed')
+        first = jobs.enqueue('succeed')
+        Job.objects.filter(id=first.id).update(run_after=timezone.now() - timedelta(minutes=1))
+
+        self.assertEqual(jobs.claim('a').id, first.id)
+        self.assertEqual(jobs.claim('b').id, later.id)
+        self.assertIsNone(jobs.claim('c'))
+        # A specific job can't be claimed twice either
+        self.assertIsNone(jobs.claim('d', job_id=first.id))
+
+    def test_claim_with_skip_locked(self):
+        instance = jobs.enqueue('succeed')
+        with mock.patch.object(connection.features, 'has_select_for_update_skip_locked', True):
+            claimed = jobs.claim('worker')
+            self.assertEqual((claimed.id, claimed.locked_by), (instance.id, 'worker'))
+            self.assertIsNone(jobs.claim('other'))
+
+    def test_claim_without_skip_locked_loses_races(self):
+        first = jobs.enqueue('succeed')
+        second = jobs.enqueue('succeed')
+        raced = []
+
+        # Another worker takes the first job between the SELECT and our UPDATE
+        def other_worker(execute, sql, params, many, context):
+            if not raced and sql.startswith('UPDATE "uploads_job"'):
+                raced.append(sql)
+                execute(
+                    'UPDATE "uploads_job" SET "status" = %s, "locked_by" = %s WHERE "id" = %s',
+                    [Job.Status.RUNNING, 'other', first.id], False, context,
+                )
+            return execute(sql, params, many, context)
+
+        with mock.patch.object(connection.features, 'has_select_for_update_skip_locked', False):
+            with connection.execute_wrapper(other_worker):
+                claimed = jobs.claim('worker')
+
+        self.assertTrue(raced)
+        self.assertEqual(claimed.id, second.id)
+        first.refresh_from_db()
+        self.assertEqual(first.locked_by, 'other')
+
+    @override_settings(JOBS_STALE_AFTER=300)
+    def test_requeue_stale(self):
+        stale = jobs.claim('dead', job_id=jobs.enqueue('succeed').id)
+        alive = jobs.claim('alive', job_id=jobs.enqueue('succeed').id)
+        Job.objects.filter(id=stale.id).update(heartbeat_at=timezone.now() - timedelta(seconds=301))
+
+        self.assertEqual(jobs.heartbeat('alive'), 1)
+        self.assertEqual(jobs.requeue_stale(), 1)
+        stale.refresh_from_db()
+        alive.refresh_from_db()
+        self.assertEqual((stale.status, stale.locked_by), (Job.Status.QUEUED, ''))
+        self.assertEqual(alive.status, Job.Status.RUNNING)
+
+        # The requeued job runs again on the next claim
+        self.assertEqual(jobs.claim('worker').id, stale.id)
+
+
+class InlineThread:
+    """Stands in for threading.Thread, running the target when it's started"""
+    def __init__(self, target, args=(), daemon=None):
+        self.target, self.args = target, args
+
+    def start(self):
+        self.target(*self.args)
+
+    def is_alive(self):
+        return False
+
+
+class RunWorkerTests(TestCase):
+    def test_burst_runs_the_queue(self):
+        calls = []
+        registry = {
+            'succeed': lambda job, **payload: calls.append(payload['value']),
+            'fail': lambda job, **payload: 1 / 0,
+        }
+        # The worker threads would each need their own connection to the test database
+        patches = [
+            mock.patch.dict(jobs.registry, registry),
+            mock.patch('signal.signal'),
+            mock.patch('uploads.management.commands.runworker.threading.Thread', InlineThread),
+            mock.patch('uploads.management.commands.runworker.connection.close'),
+            mock.patch.object(jobs.logger, 'exception'),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        for value in range(3):
+            jobs.enqueue('succeed', value=value)
+        failing = jobs.enqueue('fail', max_attempts=1)
+        out = io.StringIO()
+        call_command('runworker', '--burst', '--concurrency', '2', stdout=out)
+
+        self.assertEqual(calls, [0, 1, 2])
+        self.assertEqual(Job.objects.filter(status=Job.Status.DONE).count(), 3)
+        failing.refresh_from_db()
+        self.assertEqual(failing.status, Job.Status.FAILED)
+        self.assertIn(f"Job {failing.id} failed", out.getvalue())
+        self.assertIn('Worker stopped.', out.getvalue())
+
+
+@override_settings(S3_DELETE_RETRIES=2)
+class DeleteProjectTests(S3TestCase):
+    def setUp(self):
+        super().setUp()
+        sleep = mock.patch('uploads.tasks.time.sleep')
+        self.sleep = sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def put_objects(self, prefix, count):
+        s3 = get_s3_client()
+        keys = [f"{prefix}file{i:04}.txt" for i in range(count)]
+        for key in keys:
+            s3.put_object(Bucket='test-bucket', Key=key, Body=b'x')
+        return keys
+
+    def remaining_keys(self, prefix):
+        return [key for keys in iter_object_keys(prefix) for key in keys]
+
+    def test_deletes_in_batches_of_1000(self):
+        prefix = self.project.get_s3_folder_name()
+        self.put_objects(prefix, 2001)
+        self.put_objects('projects/other/', 1)
+        progress = []
+
+        with mock.patch('uploads.tasks.delete_objects', wraps=delete_objects) as wrapped:
+            self.assertEqual(delete_prefix(prefix, on_progress=progress.append), 2001)
+
+        self.assertEqual(sorted(len(call.args[0]) for call in wrapped.call_args_list), [1, 1000, 1000])
+        self.assertEqual(progress[-1], 2001)
+        self.assertEqual(self.remaining_keys(prefix), [])
+        self.assertEqual(self.remaining_keys('projects/other/'), ['projects/other/file0000.txt'])
+
+    def test_only_failed_keys_are_retried(self):
+        prefix = self.project.get_s3_folder_name()
+        keys = self.put_objects(prefix, 5)
+        failing = {keys[1], keys[3]}
+        calls = []
+
+        def flaky_delete(batch):
+            calls.append(list(batch))
+            # S3 reports per-key errors for part of the batch the first time round
+            failed = [key for key in batch if key in failing and len(calls) == 1]
+            delete_objects([key for key in batch if key not in failed])
+            return failed
+
+        with mock.patch('uploads.tasks.delete_objects', side_effect=flaky_delete):
+            self.assertEqual(delete_prefix(prefix), 5)
+
+        self.assertEqual(calls, [keys, sorted(failing)])
+        self.assertEqual(self.remaining_keys(prefix), [])
+
+    def test_gives_up_after_the_retries(self):
+        keys = self.put_objects(self.project.get_s3_folder_name(), 2)
+        with mock.patch('uploads.tasks.delete_objects', side_effect=lambda batch: batch) as failing:
+            with self.assertRaises(RuntimeError):
+                delete_prefix(self.project.get_s3_folder_name())
+        self.assertEqual(failing.call_count, 3)
+        self.assertEqual(self.remaining_keys(self.project.get_s3_folder_name()), keys)
+
+    def run_job(self):
+        job = Job.objects.create(name='delete_project', payload={'project_id': self.project.id})
+        with self.captureOnCommitCallbacks(execute=True):
+            tasks.delete_project(job, self.project.id)
+        job.refresh_from_db()
+        return job
+
+    def add_files(self):
+        stored = []
+        for i in range(3):
+            file = UploadedFile(user=self.user, project=self.project, size=1)
+            file.file.save(f"file{i}.txt", ContentFile(b'x'), save=False)
+            file.save()
+            stored.append(file.file.name)
+        shared = UploadedFile(user=self.user, project=self.project, size=6)
+        shared.blob = store_file(ContentFile(b'shared', name='shared.txt'))
+        shared.file.name = shared.blob.key
+        shared.save()
+        return stored, shared.blob
+
+    def test_job_deletes_rows_after_the_objects(self):
+        stored, blob = self.add_files()
+        recorded = []
+        set_progress = Job.set_progress
+
+        def record(job, progress, total=None):
+            rows = UploadedFile.objects.filter(project_id=self.project.id).count()
+            recorded.append((progress, total, rows))
+            set_progress(job, progress, total)
+
+        with mock.patch.object(Job, 'set_progress', autospec=True, side_effect=record):
+            job = self.run_job()
+
+        # Blob objects aren't under the project folder, so the total only counts the others,
+        # and the rows were all there until S3 was cleared
+        self.assertEqual(recorded, [(0, 3, 4), (3, None, 4), (3, 3, 0)])
+        self.assertEqual((job.progress, job.total), (3, 3))
+        self.assertFalse(Project.objects.filter(id=self.project.id).exists())
+        self.assertEqual(self.remaining_keys(self.project.get_s3_folder_name()), [])
+        self.assertFalse(Blob.objects.filter(id=blob.id).exists())
+        self.assertIsNone(head_object(blob.key))
+
+    def test_failed_job_keeps_the_rows(self):
+        stored, blob = self.add_files()
+        with mock.patch('uploads.tasks.delete_objects', side_effect=lambda batch: batch):
+            with self.assertRaises(RuntimeError):
+                self.run_job()
+
+        self.assertTrue(Project.objects.filter(id=self.project.id).exists())
+        self.assertEqual(UploadedFile.objects.filter(project=self.project).count(), 4)
+        self.assertEqual(self.remaining_keys(self.project.get_s3_folder_name()), sorted(stored))
+        blob.refresh_from_db()
+        self.assertEqual(blob.ref_count, 1)
+
+
+class DownloadTests(S3TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.file = UploadedFile(user=self.user, project=self.project, size=5)
+        self.file.file.save('report.pdf', ContentFile(b'%PDF-'), save=False)
+        self.file.save()
+
+    def test_redirects_to_a_signed_url(self):
+        response = self.client.get(reverse('download_file', args=[self.file.id]))
+
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['Location'].startswith(f"https://test-bucket.s3.amazonaws.com/{self.file.file.name}?"))
+        self.assertIn('Signature=', response['Location'])
+        self.assertTrue(requests.get(response['Location']).ok)
+        event = AuditEvent.objects.get()
+        self.assertEqual((event.action, event.user, event.file_id), (AuditEvent.Action.DOWNLOAD, self.user, self.file.id))
+
+    def test_non_members_are_refused_and_audited(self):
+        User.objects.create_user('outsider', 'outsider@example.com', 'password')
+        self.client.login(username='outsider', password='password')
+
+        with mock.patch('uploads.downloads.sign_download_url') as sign:
+            response = self.client.get(reverse('download_file', args=[self.file.id]))
+
+        self.assertEqual(response.status_code, 403)
+        sign.assert_not_called()
+        event = AuditEvent.objects.get()
+        self.assertEqual(
+            (event.action, event.user.username, event.project_id, event.file_id),
+            (AuditEvent.Action.DENIED, 'outsider', self.project.id, self.file.id),
+        )
+
+    def test_content_addressed_files_keep_their_name(self):
+        shared = UploadedFile(user=self.user, project=self.project, original_filename='notes.txt', size=6)
+        shared.blob = store_file(ContentFile(b'shared', name='notes.txt'))
+        shared.file.name = shared.blob.key
+        shared.save()
+
+        response = self.client.get(reverse('download_file', args=[shared.id]))
+        self.assertIn(shared.blob.key, response['Location'])
+        self.assertEqual(requests.get(response['Location']).headers['Content-Disposition'], 'attachment; filename="notes.txt"')
+
+    @override_settings(DOWNLOAD_URL_EXPIRES=3600, DOWNLOAD_URL_CACHE_MARGIN=300)
+    def test_urls_are_reused_until_shortly_before_they_expire(self):
+        now = time.time()
+        with mock.patch('uploads.downloads.sign_download_url', wraps=sign_download_url) as sign, \
+                mock.patch('django.core.cache.backends.locmem.time.time') as clock:
+            clock.return_value = now
+            first = self.client.get(reverse('download_file', args=[self.file.id]))['Location']
+            clock.return_value = now + 3299
+            self.assertEqual(self.client.get(reverse('download_file', args=[self.file.id]))['Location'], first)
+            self.assertEqual(sign.call_count, 1)
+
+            # Within the margin of the URL's expiry, a fresh one is signed
+            clock.return_value = now + 3301
+            self.client.get(reverse('download_file', args=[self.file.id]))
+            self.assertEqual(sign.call_count, 2)
+
+    def test_urls_are_signed_per_object_and_name(self):
+        other = UploadedFile(user=self.user, project=self.project, size=5)
+        other.file.save('report.pdf', ContentFile(b'%PDF-'), save=False)
+        other.save()
+
+        urls = get_download_urls([self.file, other])
+        self.assertNotEqual(urls[self.file.id], urls[other.id])
+        with mock.patch('uploads.downloads.sign_download_url') as sign:
+            self.assertEqual(get_download_urls([other, self.file]), urls)
+        sign.assert_not_called()
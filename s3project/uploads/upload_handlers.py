@@ -0,0 +1,233 @@
+"""
+An upload handler that streams form uploads straight into S3.
+
+Django's default handlers write anything over FILE_UPLOAD_MAX_MEMORY_SIZE to a
+temporary file, which the form then reads back to hash and upload. This handler
+instead forwards the file to S3 while the request body is being parsed: the
+bytes received are collected into STREAMING_UPLOAD_PART_SIZE parts, and each full
+part is sent as a part of a multipart upload while the next one fills, so at most
+two parts are held in memory and nothing is written to disk. Files smaller than
+one part are sent with a single PUT when they end.
+
+The form gets back an S3StreamedFile, which is already stored and knows its key,
+size and SHA-256. Parsing the body makes S3 requests, so it must happen on a
+thread, and the handler has to be installed before anything reads request.POST.
+The CSRF check runs as the file part starts, on the form fields before it (the
+token comes first in the form) or the X-CSRFToken header, so nothing is sent to
+S3 for a forged request; see parse().
+
+Only one file is accepted per request; every file the handler stored is
+deleted by discard() if the upload is then rejected.
+
+Under ASGI (the Procfile's uvicorn workers) the body isn't streamed from the
+client: Django's ASGIHandler reads the whole request into a SpooledTemporaryFile,
+on disk past FILE_UPLOAD_MAX_MEMORY_SIZE, before the view runs, and the handler
+parses that copy. Parts are still sent to S3 two at a time, but only once the
+client has finished sending, and the dyno needs disk space for the whole upload.
+Only WSGI servers stream it straight through. With DIRECT_UPLOADS_ENABLED the
+browser sends files to S3 itself, so this only applies to the plain form.
+
+Uploads that do go through Django's own handlers (content-addressed ones, whose
+key depends on the content) use the Hashing* versions of them, set in
+FILE_UPLOAD_HANDLERS: they hash each chunk as it arrives, so the stored file has
+its `sha256` without being read back.
+"""
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.exceptions import TooManyFilesSent
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import (
+    FileUploadHandler, MemoryFileUploadHandler, StopFutureHandlers, StopUpload, TemporaryFileUploadHandler,
+)
+from django.http import HttpResponseBadRequest
+from django.http.multipartparser import MultiPartParser, MultiPartParserError
+
+from .s3 import (
+    abort_multipart_upload, complete_multipart_upload, create_multipart_upload, delete_objects,
+    generate_upload_key, get_bucket_name, get_s3_client,
+)
+
+
+class S3StreamedFile(UploadedFile):
+    """An uploaded file the handler has already stored in S3 under `key`"""
+
+    def __init__(self, key, name, content_type, size, charset, sha256, content_type_extra=None):
+        super().__init__(None, name, content_type, size, charset, content_type_extra)
+        self.key = key
+        self.sha256 = sha256
+
+
+class HashingMixin:
+    """Hashes a file's chunks as they're received, and sets `sha256` on the file the handler returns"""
+
+    def new_file(self, *args, **kwargs):
+        # First, as MemoryFileUploadHandler raises StopFutureHandlers from here when it takes the file
+        self.digest = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        self.digest.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None:
+            file.sha256 = self.digest.hexdigest()
+        return file
+
+
+class HashingMemoryFileUploadHandler(HashingMixin, MemoryFileUploadHandler):
+    pass
+
+
+class HashingTemporaryFileUploadHandler(HashingMixin, TemporaryFileUploadHandler):
+    pass
+
+
+class S3StreamingUpload:
+    """One file being streamed to a key: buffers a part at a time and sends full parts in the background"""
+
+    def __init__(self, key, content_type, part_size):
+        self.key = key
+        self.content_type = content_type
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.digest = hashlib.sha256()
+        self.upload_id = None
+        self.parts = []
+        self.sending = None
+        # A single sender thread, so one part is in flight while the next is received
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='s3-upload')
+
+    def write(self, data):
+        self.digest.update(data)
+        self.buffer += data
+        if len(self.buffer) >= self.part_size:
+            self.flush()
+
+    def flush(self):
+        if self.upload_id is None:
+            self.upload_id = create_multipart_upload(self.key, self.content_type)
+        # Wait for the previous part before letting go of another buffer's worth
+        self.wait()
+        body, self.buffer = self.buffer, bytearray()
+        self.sending = self.executor.submit(self.send_part, len(self.parts) + 1, body)
+
+    def send_part(self, number, body):
+        response = get_s3_client().upload_part(
+            Bucket=get_bucket_name(), Key=self.key, UploadId=self.upload_id, PartNumber=number, Body=body,
+        )
+        return {'PartNumber': number, 'ETag': response['ETag']}
+
+    def wait(self):
+        if self.sending is not None:
+            self.parts.append(self.sending.result())
+            self.sending = None
+
+    def complete(self):
+        try:
+            if self.upload_id is None:
+                params = {'ContentType': self.content_type} if self.content_type else {}
+                get_s3_client().put_object(
+                    Bucket=get_bucket_name(), Key=self.key, Body=self.buffer, **params
+                )
+            else:
+                if self.buffer:
+                    self.flush()
+                self.wait()
+                complete_multipart_upload(self.key, self.upload_id, self.parts)
+        except BaseException:
+            self.abort()
+            raise
+        finally:
+            self.executor.shutdown()
+        return self.digest.hexdigest()
+
+    def abort(self):
+        self.executor.shutdown(cancel_futures=True)
+        if self.upload_id is not None:
+            abort_multipart_upload(self.key, self.upload_id)
+            self.upload_id = None
+        self.buffer = bytearray()
+
+
+class S3MultipartUploadHandler(FileUploadHandler):
+    """
+    Streams the uploaded file to S3 under the key FileField would give it in the
+    project, and hands the form an S3StreamedFile.
+
+    check_csrf(fields) is called with the form fields parsed so far before the
+    file is sent anywhere, and returns a rejection response or None.
+    """
+
+    def __init__(self, request, project, check_csrf):
+        super().__init__(request)
+        self.project = project
+        self.check_csrf = check_csrf
+        self.part_size = settings.STREAMING_UPLOAD_PART_SIZE
+        self.parser = None
+        self.upload = None
+        self.files = []
+        self.rejected = None
+
+    def parse(self):
+        """
+        Parse the request's multipart body, as reading request.POST would, but
+        with the fields available to the CSRF check in new_file()
+        """
+        self.parser = MultiPartParser(self.request.META, self.request, [self], self.request.encoding)
+        try:
+            self.request._post, self.request._files = self.parser.parse()
+        except (MultiPartParserError, TooManyFilesSent):
+            # As HttpRequest does, so nothing tries to read the body again
+            self.request._mark_post_parse_error()
+            raise
+
+    def new_file(self, field_name, file_name, content_type, content_length, charset=None, content_type_extra=None):
+        super().new_file(field_name, file_name, content_type, content_length, charset, content_type_extra)
+        if self.files:
+            # The form takes one file; another would be stored and never recorded
+            self.rejected = HttpResponseBadRequest("Only one file can be uploaded at a time.")
+        elif self.check_csrf is not None:
+            # The parser's fields so far, which are in the request's POST once parsing ends
+            self.rejected = self.check_csrf(self.parser._post)
+            self.check_csrf = None
+        if self.rejected is not None:
+            raise StopUpload(connection_reset=False)
+        key = generate_upload_key(self.project, file_name)
+        self.upload = S3StreamingUpload(key, content_type, self.part_size)
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.upload.write(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        upload, self.upload = self.upload, None
+        sha256 = upload.complete()
+        self.files.append(S3StreamedFile(
+            upload.key, self.file_name, self.content_type, file_size, self.charset, sha256,
+            self.content_type_extra,
+        ))
+        return self.files[-1]
+
+    def upload_interrupted(self):
+        self.abort()
+
+    def upload_complete(self):
+        # A file that never reached file_complete(), e.g. the body ended early
+        self.abort()
+
+    def abort(self):
+        if self.upload is not None:
+            self.upload.abort()
+            self.upload = None
+
+    def discard(self):
+        """Delete every file already stored, for an upload that ends up rejected"""
+        self.abort()
+        if self.files:
+            delete_objects([file.key for file in self.files])
+            self.files = []
@@ -8,17 +8,42 @@ urlpatterns = [
     path('projects/', views.project_list, name='project_list'),
     path('projects/create/', views.create_project, name='create_project'),
     path('projects/<int:project_id>/', views.project_detail, name='project_detail'),
+    path('projects/<int:project_id>/download/', views.download_project_zip, name='download_project_zip'),
     path('projects/<int:project_id>/edit/', views.edit_project, name='edit_project'),
     path('projects/<int:project_id>/delete/', views.delete_project, name='delete_project'),
     path('projects/<int:project_id>/members/', views.manage_project_members, name='manage_project_members'),
+    path('projects/<int:project_id>/members/suggest/', views.project_member_suggestions, name='project_member_suggestions'),
+    path('projects/<int:project_id>/members/remove/', views.remove_project_members, name='remove_project_members'),
     path('projects/<int:project_id>/members/remove/<int:user_id>/', views.remove_project_member, name='remove_project_member'),
     path('projects/<int:project_id>/upload/', views.upload_to_project, name='upload_to_project'),
+    path('projects/<int:project_id>/upload/direct/', views.direct_upload_presign, name='direct_upload_presign'),
+    path('projects/<int:project_id>/upload/direct/complete/', views.direct_upload_complete, name='direct_upload_complete'),
+    path('projects/<int:project_id>/upload/multipart/', views.multipart_upload_initiate, name='multipart_upload_initiate'),
+    path('projects/<int:project_id>/upload/multipart/urls/', views.multipart_upload_part_urls, name='multipart_upload_part_urls'),
+    path('projects/<int:project_id>/upload/multipart/parts/', views.multipart_upload_parts, name='multipart_upload_parts'),
+    path('projects/<int:project_id>/upload/multipart/complete/', views.multipart_upload_complete, name='multipart_upload_complete'),
+    path('projects/<int:project_id>/upload/multipart/abort/', views.multipart_upload_abort, name='multipart_upload_abort'),
     path('my-projects/', views.user_projects, name='user_projects'),
 
     # Files
     # path('upload/', views.upload_file, name='upload_file'),
+    path('files/<int:file_id>/download/', views.download_file, name='download_file'),
+    path('files/<int:file_id>/proxy/', views.proxy_file, name='proxy_file'),
     path('delete/<int:file_id>/', views.delete_file, name='delete_file'),
 
+    # Search
+    path('search/', views.search, name='search'),
+
+    # Statistics and audit log
+    path('profiling/', views.profiling_stats, name='profiling_stats'),
+    path('storage/cache/', views.storage_cache_stats, name='storage_cache_stats'),
+    path('cache/fragments/', views.fragment_cache_stats, name='fragment_cache_stats'),
+    path('audit/', views.audit_log, name='audit_log'),
+
+    # Background jobs
+    path('jobs/', views.job_list, name='job_list'),
+    path('jobs/<int:job_id>/', views.job_detail, name='job_detail'),
+
     # Invitation management
     path('invitations/', views.invitation_list, name='invitation_list'),
     path('invitations/create/', views.create_invitation, name='create_invitation'),
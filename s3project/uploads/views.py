@@ -1,15 +1,54 @@
-from django.shortcuts import render, redirect, get_object_or_404
+import asyncio
+import copy
+import os
+import uuid
+from functools import partial
+
+from asgiref.sync import sync_to_async
+from botocore.exceptions import ClientError
+from django.core.handlers.asgi import ASGIRequest
+from django.shortcuts import render, redirect, get_object_or_404, aget_object_or_404
+from django.template.loader import render_to_string
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib.auth.models import User
 from django.contrib import messages
 from django.utils import timezone
 from django.urls import reverse
-from django.http import HttpResponseForbidden
+from django.http import FileResponse, Http404, HttpResponseForbidden, HttpResponseRedirect, StreamingHttpResponse, HttpResponseBadRequest, JsonResponse
+from django.db import IntegrityError, transaction
 from django.db.models import Q
-from .models import UploadedFile, Invitation, Project, ProjectMembership
+from django.conf import settings
+from django.core import signing
+from django.core.files.storage import default_storage
+from django.utils.datastructures import MultiValueDict
+from django.utils.http import content_disposition_header, urlencode
+from django.middleware.csrf import CsrfViewMiddleware
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from .models import UploadedFile, Invitation, Project, ProjectMembership, Job, AuditEvent, get_blob_key
 from .forms import (
     FileUploadForm, InvitationForm, AcceptInvitationForm, ProjectForm, ProjectMembershipForm
 )
+from . import aio, audit, profiling
+from .jobs import enqueue
+from .downloads import attach_download_urls, get_download_url
+from .fragments import fragment_key, get_fragment, get_versions, project_cards, url_timeout, stats as fragment_stats
+from .members import add_members, remove_members, search_users
+from .permissions import get_member_project_ids
+from .search import search_files, search_projects
+from .upload_handlers import S3MultipartUploadHandler
+from .zipstream import stream_zip
+from .pagination import paginate_audit_events, paginate_files, paginate_invitations, InvalidCursor
+from .blobs import add_reference, delete_uploaded_file, is_referenced_by, is_sha256, store_object
+from .quotas import FORM_OVERHEAD, QuotaExceeded, check_quota, release, remaining_bytes, reserve
+from .s3 import (
+    delete_objects, get_object, get_object_metadata, get_object_sha256, generate_upload_key, create_presigned_post, head_object, create_multipart_upload,
+    presign_upload_part, list_uploaded_parts, complete_multipart_upload, abort_multipart_upload
+)
+
+DIRECT_UPLOAD_SALT = 'uploads.direct_upload'
+# Multipart uploads can take a while; abort_stale_uploads discards them after this long anyway
+MULTIPART_TOKEN_MAX_AGE = settings.MULTIPART_UPLOAD_STALE_HOURS * 3600
 
 # Helper function to check if a user is a superuser
 def is_superuser(user):
@@ -19,29 +58,42 @@ def is_superuser(user):
 def is_project_member(user, project):
     if user.is_superuser:
         return True
-    return ProjectMembership.objects.filter(user=user, project=project).exists()
+    return project.id in get_member_project_ids(user)
+
+# Helper function to read back a signed direct upload token for this project and user,
+# if it was issued at most max_age seconds ago
+def load_upload_token(request, project, max_age):
+    try:
+        data = signing.loads(request.POST.get('token', ''), salt=DIRECT_UPLOAD_SALT, max_age=max_age)
+    except signing.BadSignature:
+        return None
+    if data['project'] != project.id or data['user'] != request.user.id:
+        return None
+    return data
 
 # Dashboard view - the main landing page
 @login_required
 def dashboard(request):
     """Dashboard view showing user's projects and recent files"""
-    if request.user.is_superuser:
-        # Superusers see all projects
-        projects = Project.objects.all().order_by('-created_at')
-    else:
-        # Regular users see only projects they're members of
-        projects = Project.objects.filter(
-            projectmembership__user=request.user
-        ).order_by('-created_at')
-    
-    # Get recent files from user's projects
-    recent_files = UploadedFile.objects.filter(
-        Q(project__in=projects) & (Q(user=request.user) | Q(project__created_by=request.user))
-    ).order_by('-uploaded_at')[:5]
+    # Superusers see all projects, regular users only projects they're members of
+    project_ids = list(Project.objects.for_user(request.user).order_by('-created_at').values_list('id', flat=True))
+    versions = get_versions(project_ids)
+
+    # Get recent files from user's projects, rendered again only when one of the projects changes
+    def render_recent_files():
+        recent_files = attach_download_urls(list(UploadedFile.objects.filter(
+            Q(project__in=Project.objects.for_user(request.user)) &
+            (Q(user=request.user) | Q(project__created_by=request.user))
+        ).select_related('project', 'user').order_by('-uploaded_at')[:5]))
+        return render_to_string('uploads/fragments/recent_files.html', {'recent_files': recent_files})
 
     context = {
-        'projects': projects,
-        'recent_files': recent_files,
+        'project_cards': project_cards(project_ids, 'uploads/fragments/dashboard_project_card.html'),
+        'recent_files': get_fragment(
+            fragment_key('recent-files', request.user.id, sorted(versions.items())),
+            render_recent_files,
+            timeout=url_timeout(),
+        ),
     }
     return render(request, 'uploads/dashboard.html', context)
 
@@ -51,7 +103,7 @@ def dashboard(request):
 @user_passes_test(is_superuser)
 def project_list(request):
     """List all projects (superuser only)"""
-    projects = Project.objects.all().order_by('-created_at')
+    projects = Project.objects.with_counts().order_by('-created_at')
     return render(request, 'uploads/project_list.html', {'projects': projects})
 
 @login_required
@@ -86,22 +138,218 @@ def project_detail(request, project_id):
 
     # Check if user has access to this project
     if not is_project_member(request.user, project):
+        audit.record(AuditEvent.Action.DENIED, request.user, project, request=request)
         return HttpResponseForbidden("You don't have access to this project. All activites are logged and monitored.")
+    audit.record(AuditEvent.Action.VIEW, request.user, project, request=request)
     
-    # Get project files
-    files = UploadedFile.objects.filter(project=project).order_by('-uploaded_at')
+    # Get one page of project files
+    try:
+        page_size = min(int(request.GET.get('page_size', settings.FILE_LIST_PAGE_SIZE)), settings.FILE_LIST_MAX_PAGE_SIZE)
+    except ValueError:
+        return HttpResponseBadRequest("page_size must be a number.")
+    if page_size < 1:
+        return HttpResponseBadRequest("page_size must be positive.")
+
+    cursor = request.GET.get('cursor')
+
+    def load_files():
+        files, next_cursor = paginate_files(
+            UploadedFile.objects.filter(project=project).select_related('user'),
+            cursor=cursor,
+            page_size=page_size,
+        )
+        # Sign the whole page's download URLs in one batch
+        attach_download_urls(files)
+        return files, next_cursor
+
+    # Scripts can walk a project's files with ?format=json
+    if request.GET.get('format') == 'json':
+        try:
+            files, next_cursor = load_files()
+        except InvalidCursor:
+            return HttpResponseBadRequest("Invalid cursor.")
+        return JsonResponse({
+            'project': {'id': project.id, 'name': project.name},
+            'files': [
+                {
+                    'id': file.id,
+                    'filename': file.filename,
+                    'url': file.download_url,
+                    'uploaded_at': file.uploaded_at.isoformat(),
+                    'size': file.size,
+                    'content_type': file.content_type,
+                    'checksum': file.checksum,
+                    'uploaded_by': file.user.username,
+                }
+                for file in files
+            ],
+            'next_cursor': next_cursor,
+        })
+
+    def render_files():
+        files, next_cursor = load_files()
+        return render_to_string('uploads/fragments/file_list.html', {
+            'project': project,
+            'files': files,
+            'next_cursor': next_cursor,
+            'is_first_page': not cursor,
+            'page_size': page_size,
+            'user': request.user,
+        })
 
-    # Get project members
-    members = ProjectMembership.objects.filter(project=project).select_related('user')
+    # The page's file list and details are rendered again only when the project changes.
+    # Which files have a Delete link depends on who's looking.
+    version = get_versions([project.id])[project.id]
+    viewer = 'superuser' if request.user.is_superuser else request.user.id
+    try:
+        file_list = get_fragment(
+            fragment_key('file-list', project.id, version, viewer, cursor, page_size),
+            render_files,
+            timeout=url_timeout(),
+        )
+    except InvalidCursor:
+        return HttpResponseBadRequest("Invalid cursor.")
+    project_info = get_fragment(
+        fragment_key('project-info', project.id, version),
+        lambda: render_to_string('uploads/fragments/project_info.html', {'project': project}),
+    )
 
     context = {
         'project': project,
-        'files': files,
-        'members': members,
+        'project_info': project_info,
+        'file_list': file_list,
         'is_superuser': request.user.is_superuser,
     }
     return render(request, 'uploads/project_detail.html', context)
 
+@login_required
+def search(request):
+    """
+    Search file names and project names/descriptions across the user's projects.
+    Files come in pages of ?page_size=, newest first; ?cursor= continues after a page.
+    """
+    query = request.GET.get('q', '').strip()
+    projects, files, next_cursor = [], [], None
+
+    try:
+        page_size = min(int(request.GET.get('page_size', settings.SEARCH_RESULTS_LIMIT)), settings.SEARCH_MAX_PAGE_SIZE)
+    except ValueError:
+        return HttpResponseBadRequest("page_size must be a number.")
+    if page_size < 1:
+        return HttpResponseBadRequest("page_size must be positive.")
+    # The cursor is the id of the last file on the previous page
+    cursor = request.GET.get('cursor')
+    try:
+        before = int(cursor) if cursor else None
+    except ValueError:
+        return HttpResponseBadRequest("Invalid cursor.")
+
+    if query:
+        # Superusers search everything
+        project_ids = None if request.user.is_superuser else get_member_project_ids(request.user)
+        if before is None:
+            projects = list(
+                search_projects(query, project_ids).select_related('created_by').order_by('name')[:settings.SEARCH_RESULTS_LIMIT]
+            )
+        # One extra to find out whether there's another page
+        files = search_files(query, project_ids, limit=page_size + 1, before=before)
+        if len(files) > page_size:
+            files = files[:page_size]
+            next_cursor = str(files[-1].id)
+        attach_download_urls(files)
+
+    if request.GET.get('format') == 'json':
+        return JsonResponse({
+            'query': query,
+            'projects': [{'id': project.id, 'name': project.name} for project in projects],
+            'files': [
+                {
+                    'id': file.id,
+                    'filename': file.filename,
+                    'url': file.download_url,
+                    'project': {'id': file.project.id, 'name': file.project.name},
+                    'uploaded_at': file.uploaded_at.isoformat(),
+                    'size': file.size,
+                }
+                for file in files
+            ],
+            'next_cursor': next_cursor,
+        })
+
+    return render(request, 'uploads/search.html', {
+        'query': query,
+        'projects': projects,
+        'files': files,
+        'next_cursor': next_cursor,
+        'is_first_page': before is None,
+        'page_size': page_size,
+    })
+
+# Helper function to give a ZIP entry a name no earlier entry has, numbering repeats like
+# "report (2).pdf". `taken` maps each name used so far to the next number to try for it.
+def unique_arcname(name, taken):
+    if name in taken:
+        root, ext = os.path.splitext(name)
+        number = taken[name]
+        while f"{root} ({number}){ext}" in taken:
+            number += 1
+        taken[name] = number
+        name = f"{root} ({number}){ext}"
+    taken[name] = 2
+    return name
+
+# Helper functions for the (arcname, key, date_time) entries of a project ZIP, skipping
+# adjacent duplicates and renaming different files that share a name
+def zip_entries(files):
+    previous = None
+    taken = {}
+    for file in files.iterator(chunk_size=500):
+        if (file.file.name, file.filename) != previous:
+            yield unique_arcname(file.filename, taken), file.file.name, file.uploaded_at.timetuple()[:6]
+        previous = (file.file.name, file.filename)
+
+async def azip_entries(files):
+    previous = None
+    taken = {}
+    async for file in files.aiterator(chunk_size=500):
+        if (file.file.name, file.filename) != previous:
+            yield unique_arcname(file.filename, taken), file.file.name, file.uploaded_at.timetuple()[:6]
+        previous = (file.file.name, file.filename)
+
+@login_required
+async def download_project_zip(request, project_id):
+    """Stream every file in a project as a single ZIP archive"""
+    project = await aget_object_or_404(Project, id=project_id)
+    user = await request.auser()
+
+    if not await sync_to_async(is_project_member)(user, project):
+        await audit.arecord(AuditEvent.Action.DENIED, user, project, request=request)
+        return HttpResponseForbidden("You don't have access to this project.")
+    await audit.arecord(AuditEvent.Action.DOWNLOAD, user, project, request=request)
+
+    # Ordered so duplicate rows (same object and name) are adjacent and only added once.
+    # Rows are read as the archive is written, so only the ZIP's central directory grows.
+    files = UploadedFile.objects.filter(project=project).order_by('file', 'original_filename').only(
+        'file', 'original_filename', 'uploaded_at'
+    )
+    options = {
+        'chunk_size': settings.ZIP_CHUNK_SIZE,
+        'workers': settings.ZIP_WORKERS,
+        'read_ahead': settings.ZIP_READ_AHEAD,
+    }
+    if isinstance(request, ASGIRequest):
+        # The archive is written on a worker thread, which awaits each row on this event loop
+        entries = aio.iterate_on_loop(azip_entries(files), asyncio.get_running_loop())
+        archive = aio.iterate_in_thread(stream_zip(entries, **options))
+    else:
+        # Under WSGI (e.g. runserver) the event loop ends with the view, and a sync iterator
+        # is needed to stream without buffering
+        archive = stream_zip(zip_entries(files), **options)
+
+    response = StreamingHttpResponse(archive, content_type='application/zip')
+    response['Content-Disposition'] = f'attachment; filename="project-{project.id}.zip"'
+    return response
+
 @login_required
 @user_passes_test(is_superuser)
 def edit_project(request, project_id):
@@ -130,18 +378,19 @@ def delete_project(request, project_id):
     project = get_object_or_404(Project, id=project_id)
     
     if request.method == 'POST':
-        # Get all files in this project to delete from S3
-        files = UploadedFile.objects.filter(project=project)
-        for file in files:
-            # Delete the actual file from S3
-            file.file.delete(save=False)
-        
-        # Now delete the project (cascade will handle related records)
-        project_name = project.name
-        project.delete()
-        
-        messages.success(request, f"Project '{project_name}' and all its files have been deleted.")
-        return redirect('project_list')
+        # Deleting the files from S3 can take a long time, so it runs as a background job.
+        # The job deletes the project itself once storage is clean.
+        job = Job.objects.filter(
+            name='delete_project',
+            payload__project_id=project.id,
+            status__in=[Job.Status.QUEUED, Job.Status.RUNNING],
+        ).first()
+        if job is None:
+            job = enqueue('delete_project', user=request.user, project_id=project.id)
+            audit.record(AuditEvent.Action.DELETE, request.user, project, request=request)
+
+        messages.success(request, f"Project '{project.name}' and all its files are being deleted.")
+        return redirect('job_detail', job_id=job.id)
     
     return render(request, 'uploads/confirm_delete_project.html', {'project': project})
 
@@ -150,25 +399,21 @@ def delete_project(request, project_id):
 def manage_project_members(request, project_id):
     """Add/remove members from a project (superuser only)"""
     project = get_object_or_404(Project, id=project_id)
-    current_members = ProjectMembership.objects.filter(project=project).select_related('user')
+    current_members = ProjectMembership.objects.filter(project=project).select_related('user', 'added_by').order_by('user__username')
     
     if request.method == 'POST':
-        form = ProjectMembershipForm(request.POST, project=project)
+        form = ProjectMembershipForm(request.POST, request.FILES)
         if form.is_valid():
-            users_to_add = form.cleaned_data['users']
-            
-            # Add new members
-            for user in users_to_add:
-                ProjectMembership.objects.create(
-                    project=project,
-                    user=user,
-                    added_by=request.user
-                )
-            
-            messages.success(request, f"{len(users_to_add)} users added to the project.")
-            return redirect('project_detail', project_id=project.id)
+            # One INSERT for all of them, skipping users who are members already
+            added = add_members(project, form.cleaned_data['user_ids'], request.user)
+            messages.success(request, f"{added} users added to the project.")
+            if form.unmatched:
+                shown = ', '.join(form.unmatched[:20])
+                more = f" and {len(form.unmatched) - 20} more" if len(form.unmatched) > 20 else ""
+                messages.warning(request, f"No active user found for {shown}{more}.")
+            return redirect('manage_project_members', project_id=project.id)
     else:
-        form = ProjectMembershipForm(project=project)
+        form = ProjectMembershipForm()
     
     context = {
         'project': project,
@@ -177,6 +422,31 @@ def manage_project_members(request, project_id):
     }
     return render(request, 'uploads/manage_project_members.html', context)
 
+@login_required
+@user_passes_test(is_superuser)
+def project_member_suggestions(request, project_id):
+    """Users matching a username or email prefix who aren't members yet, for the member picker"""
+    project = get_object_or_404(Project, id=project_id)
+    query = request.GET.get('q', '').strip()
+    users = search_users(query, exclude_project=project) if query else []
+    return JsonResponse({
+        'users': [
+            {'id': user.id, 'username': user.username, 'email': user.email, 'name': user.get_full_name()}
+            for user in users
+        ],
+    })
+
+@login_required
+@user_passes_test(is_superuser)
+@require_POST
+def remove_project_members(request, project_id):
+    """Remove the selected members from a project at once (superuser only)"""
+    project = get_object_or_404(Project, id=project_id)
+    user_ids = [user_id for user_id in request.POST.getlist('user_ids') if user_id.isdigit()]
+    removed = remove_members(project, user_ids)
+    messages.success(request, f"{removed} members removed from the project.")
+    return redirect('manage_project_members', project_id=project.id)
+
 @login_required
 @user_passes_test(is_superuser)
 def remove_project_member(request, project_id, user_id):
@@ -202,45 +472,477 @@ def remove_project_member(request, project_id, user_id):
     }
     return render(request, 'uploads/confirm_remove_member.html', context)
 
+# Helper function for the CSRF check csrf_exempt skipped, reading the token from `fields`
+# or else the X-CSRFToken header. Returns the rejection response if the check fails.
+def csrf_rejection(request, fields):
+    probe = copy.copy(request)
+    probe._post, probe._files = fields, MultiValueDict()
+    return CsrfViewMiddleware(lambda request: None).process_view(probe, None, (), {})
+
+# Helper function to parse an upload form post and run the CSRF check. With the streaming
+# handler, the check runs before the file part is sent to S3 (see upload_handlers).
+# Returns the rejection response if the post is rejected, after discarding what was stored.
+def parse_upload(request, handler=None):
+    try:
+        if handler is not None and request.content_type == 'multipart/form-data':
+            handler.parse()
+        else:
+            request.FILES  # parse here on the thread, even if the CSRF token came in a header
+        rejected = getattr(handler, 'rejected', None) or csrf_rejection(request, request.POST)
+    except BaseException:
+        if handler is not None:
+            handler.discard()
+        raise
+    if rejected is not None and handler is not None:
+        handler.discard()
+    return rejected
+
+@csrf_exempt  # checked by parse_upload(), once the upload handler is in place
 @login_required
-def upload_to_project(request, project_id):
+async def upload_to_project(request, project_id):
     """Upload a file to a specific project"""
-    project = get_object_or_404(Project, id=project_id)
+    project = await aget_object_or_404(Project, id=project_id)
+    user = await request.auser()
     
     # Check if user has access to this project
-    if not is_project_member(request.user, project):
+    if not await sync_to_async(is_project_member)(user, project):
+        await audit.arecord(AuditEvent.Action.DENIED, user, project, request=request)
         return HttpResponseForbidden("You don't have access to this project.")
     
     if request.method == 'POST':
-        form = FileUploadForm(request.POST, request.FILES, user=request.user, project=project)
-        if form.is_valid():
-            file = form.save()
-            messages.success(request, "File uploaded successfully!")
-            return redirect('project_detail', project_id=project.id)
+        # Turn away uploads that can't fit before reading the form, going by Content-Length
+        try:
+            size = max(0, int(request.META.get('CONTENT_LENGTH') or 0) - FORM_OVERHEAD)
+            await sync_to_async(check_quota)(project, user, size)
+        except QuotaExceeded as e:
+            messages.error(request, str(e))
+            return redirect('upload_to_project', project_id=project.id)
+
+        handler = None
+        if not settings.CONTENT_ADDRESSED_STORAGE:
+            # Stream the file into S3 while the body is parsed, rather than spooling it to a
+            # temporary file and uploading that. Content-addressed keys depend on the whole
+            # content, so those still go through the form.
+            handler = S3MultipartUploadHandler(request, project, partial(csrf_rejection, request))
+            request.upload_handlers = [handler]
+        # Parsing sends the file to S3, so it runs on a thread of its own
+        rejected = await sync_to_async(parse_upload, thread_sensitive=False)(request, handler)
+        if rejected is not None:
+            return rejected
+
+        form = FileUploadForm(request.POST, request.FILES, user=user, project=project)
+        if await sync_to_async(form.is_valid)():
+            upload = form.cleaned_data['file']
+            try:
+                await sync_to_async(reserve)(project, user, upload.size)
+            except QuotaExceeded as e:
+                form.add_error('file', str(e))
+                if handler is not None:
+                    await sync_to_async(handler.discard, thread_sensitive=False)()
+            else:
+                try:
+                    await form.asave()
+                except BaseException:
+                    await sync_to_async(release)(project.id, user.id, upload.size)
+                    raise
+                await audit.arecord(AuditEvent.Action.UPLOAD, user, project, form.instance, request)
+                messages.success(request, "File uploaded successfully!")
+                return redirect('project_detail', project_id=project.id)
+        elif handler is not None:
+            await sync_to_async(handler.discard, thread_sensitive=False)()
     else:
-        form = FileUploadForm(user=request.user, project=project)
+        form = FileUploadForm(user=user, project=project)
     
     context = {
         'form': form,
         'project': project,
+        'direct_upload': settings.DIRECT_UPLOADS_ENABLED,
+        'multipart_threshold': settings.MULTIPART_UPLOAD_THRESHOLD,
+        'multipart_concurrency': settings.MULTIPART_UPLOAD_CONCURRENCY,
+        'content_addressed': settings.CONTENT_ADDRESSED_STORAGE,
     }
-    return render(request, 'uploads/upload_to_project.html', context)
+    return await sync_to_async(render)(request, 'uploads/upload_to_project.html', context)
+
+@login_required
+@require_POST
+def direct_upload_presign(request, project_id):
+    """Issue a presigned POST so the browser can upload a file straight to S3"""
+    project = get_object_or_404(Project, id=project_id)
+
+    if not is_project_member(request.user, project):
+        return HttpResponseForbidden("You don't have access to this project.")
+
+    filename = request.POST.get('filename', '').strip()
+    if not filename:
+        return JsonResponse({'error': 'A filename is required.'}, status=400)
+
+    sha256 = request.POST.get('sha256', '').lower()
+    content_type = request.POST.get('content_type') or None
+
+    try:
+        check_quota(project, request.user, int(request.POST.get('size') or 0))
+    except ValueError:
+        return JsonResponse({'error': 'Invalid size.'}, status=400)
+    except QuotaExceeded as e:
+        return JsonResponse({'error': str(e)}, status=413)
+    # S3 itself refuses a POST larger than what's left of the quota
+    max_size = remaining_bytes(project, request.user)
+    if max_size is not None:
+        max_size = min(max_size, settings.DIRECT_UPLOAD_MAX_SIZE)
+
+    if settings.CONTENT_ADDRESSED_STORAGE and is_sha256(sha256) and is_referenced_by(request.user, sha256):
+        # The caller already has this content in one of their projects, so the browser can skip the transfer.
+        # Anyone else must upload it, or knowing a hash would be enough to get another project's content.
+        token = signing.dumps(
+            {'key': get_blob_key(sha256), 'project': project.id, 'user': request.user.id,
+             'sha256': sha256, 'filename': os.path.basename(filename), 'duplicate': True,
+             'nonce': uuid.uuid4().hex},
+            salt=DIRECT_UPLOAD_SALT,
+        )
+        return JsonResponse({'duplicate': True, 'key': get_blob_key(sha256), 'token': token})
+
+    key = generate_upload_key(project, filename)
+    # The token ties the completion call to this key, project and user, and its nonce
+    # to the one file it can record
+    data = {'key': key, 'project': project.id, 'user': request.user.id, 'nonce': uuid.uuid4().hex}
+    if settings.CONTENT_ADDRESSED_STORAGE and is_sha256(sha256):
+        # Uploaded to its own key and moved into the blob once the server has checked it
+        presigned = create_presigned_post(key, content_type=content_type, max_size=max_size, sha256=sha256)
+        data.update(sha256=sha256, filename=os.path.basename(filename))
+    else:
+        presigned = create_presigned_post(key, content_type=content_type, max_size=max_size)
+    token = signing.dumps(data, salt=DIRECT_UPLOAD_SALT)
+
+    return JsonResponse({
+        'duplicate': False,
+        'url': presigned['url'],
+        'fields': presigned['fields'],
+        'key': presigned['fields']['key'],
+        'token': token,
+    })
+
+@login_required
+@require_POST
+def direct_upload_complete(request, project_id):
+    """Record a file the browser has uploaded directly to S3"""
+    project = get_object_or_404(Project, id=project_id)
+
+    if not is_project_member(request.user, project):
+        return HttpResponseForbidden("You don't have access to this project.")
+
+    data = load_upload_token(request, project, max_age=settings.DIRECT_UPLOAD_EXPIRES)
+    if data is None or 'nonce' not in data:
+        return JsonResponse({'error': 'Invalid upload token.'}, status=400)
+
+    # A token is good for one file; a replay must not record the object (and reserve its size) again
+    if UploadedFile.objects.filter(upload_nonce=data['nonce']).exists():
+        return JsonResponse({'error': 'This upload has already been completed.'}, status=409)
+
+    duplicate = data.get('duplicate', False)
+    if duplicate and not is_referenced_by(request.user, data['sha256']):
+        # The caller's own copy was deleted since the presign, so they have to upload the content
+        return JsonResponse({'error': 'The file must be uploaded again.'}, status=409)
+
+    # Make sure the object actually made it to the bucket
+    head = head_object(data['key'], checksum=True)
+    if head is None:
+        return JsonResponse({'error': 'The uploaded file was not found in storage.'}, status=400)
+
+    file = UploadedFile(user=request.user, project=project, **get_object_metadata(head))
+    if 'sha256' in data and not duplicate:
+        # Never trust the client's hash: a blob is shared with every project that has the same content
+        if get_object_sha256(data['key']) != data['sha256']:
+            delete_objects([data['key']])
+            return JsonResponse({'error': 'The uploaded file does not match its checksum.'}, status=400)
+
+    file.file.name = data['key']
+    file.upload_nonce = data['nonce']
+    try:
+        # A concurrent replay of the token fails on the unique nonce, undoing its reservation
+        with transaction.atomic():
+            try:
+                reserve(project, request.user, file.size)
+            except QuotaExceeded as e:
+                if not duplicate:
+                    delete_objects([data['key']])
+                return JsonResponse({'error': str(e)}, status=413)
+
+            if 'sha256' in data:
+                if duplicate:
+                    file.blob = add_reference(data['sha256'])
+                else:
+                    file.blob = store_object(data['key'], data['sha256'], head['ContentLength'])
+                if file.blob is None:
+                    transaction.set_rollback(True)
+                    return JsonResponse({'error': 'The file must be uploaded again.'}, status=409)
+                file.file.name = file.blob.key
+                file.original_filename = data['filename']
+                file.checksum = data['sha256']
+            file.save()
+    except IntegrityError:
+        return JsonResponse({'error': 'This upload has already been completed.'}, status=409)
+    audit.record(AuditEvent.Action.UPLOAD, request.user, project, file, request)
+
+    messages.success(request, "File uploaded successfully!")
+    return JsonResponse({
+        'id': file.id,
+        'filename': file.filename,
+        'redirect': reverse('project_detail', args=[project.id]),
+    })
+
+# Multipart upload views - the browser uploads parts of a large file to S3 in parallel
+# and can resume an interrupted upload by asking which parts already arrived
+def multipart_error_response(error):
+    """The JSON error for S3 refusing a multipart upload, e.g. one that's been aborted"""
+    code = error.response.get('Error', {}).get('Code')
+    if code == 'NoSuchUpload':
+        return JsonResponse({'error': 'This upload no longer exists; start it again.'}, status=409)
+    if code in ('EntityTooSmall', 'InvalidPart', 'InvalidPartOrder'):
+        return JsonResponse({'error': 'Some parts of the upload are invalid; upload them again.'}, status=400)
+    raise error
+
+def abort_upload(key, upload_id):
+    """Abort a multipart upload, if it still exists"""
+    try:
+        abort_multipart_upload(key, upload_id)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') != 'NoSuchUpload':
+            raise
+
+@login_required
+@require_POST
+def multipart_upload_initiate(request, project_id):
+    """Start an S3 multipart upload for a large file"""
+    project = get_object_or_404(Project, id=project_id)
+
+    if not is_project_member(request.user, project):
+        return HttpResponseForbidden("You don't have access to this project.")
+
+    filename = request.POST.get('filename', '').strip()
+    if not filename:
+        return JsonResponse({'error': 'A filename is required.'}, status=400)
+
+    try:
+        size = int(request.POST.get('size', ''))
+        check_quota(project, request.user, size)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid size.'}, status=400)
+    except QuotaExceeded as e:
+        return JsonResponse({'error': str(e)}, status=413)
+
+    # The browser splits the file into parts of exactly this size, the last one smaller
+    part_count = -(-size // settings.MULTIPART_UPLOAD_PART_SIZE)
+    if not 1 <= part_count <= 10000:
+        return JsonResponse({'error': 'Invalid size.'}, status=400)
+
+    key = generate_upload_key(project, filename)
+    content_type = request.POST.get('content_type', '')
+    upload_id = create_multipart_upload(key, content_type=content_type or None)
+
+    # Completion checks the parts S3 received against the size declared here
+    token = signing.dumps(
+        {'key': key, 'project': project.id, 'user': request.user.id, 'upload_id': upload_id,
+         'content_type': content_type, 'size': size, 'parts': part_count},
+        salt=DIRECT_UPLOAD_SALT,
+    )
+
+    return JsonResponse({
+        'key': key,
+        'token': token,
+        'part_size': settings.MULTIPART_UPLOAD_PART_SIZE,
+    })
+
+@login_required
+@require_POST
+def multipart_upload_part_urls(request, project_id):
+    """Presign upload URLs for the requested part numbers"""
+    project = get_object_or_404(Project, id=project_id)
+
+    if not is_project_member(request.user, project):
+        return HttpResponseForbidden("You don't have access to this project.")
+
+    data = load_upload_token(request, project, max_age=MULTIPART_TOKEN_MAX_AGE)
+    if data is None or 'parts' not in data:
+        return JsonResponse({'error': 'Invalid upload token.'}, status=400)
+
+    try:
+        part_numbers = [int(n) for n in request.POST.get('part_numbers', '').split(',')]
+    except ValueError:
+        return JsonResponse({'error': 'Part numbers must be integers.'}, status=400)
+
+    if not all(1 <= n <= data['parts'] for n in part_numbers):
+        return JsonResponse({'error': f"Part numbers must be between 1 and {data['parts']}."}, status=400)
+
+    urls = {
+        n: presign_upload_part(data['key'], data['upload_id'], n)
+        for n in part_numbers
+    }
+    return JsonResponse({'urls': urls})
+
+@login_required
+@require_POST
+def multipart_upload_parts(request, project_id):
+    """List the parts S3 already has, so an interrupted upload can resume"""
+    project = get_object_or_404(Project, id=project_id)
+
+    if not is_project_member(request.user, project):
+        return HttpResponseForbidden("You don't have access to this project.")
+
+    data = load_upload_token(request, project, max_age=MULTIPART_TOKEN_MAX_AGE)
+    if data is None or 'upload_id' not in data:
+        return JsonResponse({'error': 'Invalid upload token.'}, status=400)
+
+    try:
+        parts = list_uploaded_parts(data['key'], data['upload_id'])
+    except ClientError as e:
+        return multipart_error_response(e)
+    return JsonResponse({'parts': parts})
+
+@login_required
+@require_POST
+def multipart_upload_complete(request, project_id):
+    """Assemble the uploaded parts and record the file"""
+    project = get_object_or_404(Project, id=project_id)
+
+    if not is_project_member(request.user, project):
+        return HttpResponseForbidden("You don't have access to this project.")
+
+    data = load_upload_token(request, project, max_age=MULTIPART_TOKEN_MAX_AGE)
+    if data is None or 'parts' not in data:
+        return JsonResponse({'error': 'Invalid upload token.'}, status=400)
+
+    # Use S3's own record of the parts rather than trusting the client's ETags
+    try:
+        parts = list_uploaded_parts(data['key'], data['upload_id'])
+    except ClientError as e:
+        return multipart_error_response(e)
+    if [part['PartNumber'] for part in parts] != list(range(1, data['parts'] + 1)):
+        return JsonResponse({'error': f"Parts 1 to {data['parts']} must all be uploaded."}, status=400)
+    size = sum(part['Size'] for part in parts)
+    if size != data['size']:
+        return JsonResponse({'error': "The uploaded parts don't add up to the file's size."}, status=400)
+
+    try:
+        reserve(project, request.user, size)
+    except QuotaExceeded as e:
+        abort_upload(data['key'], data['upload_id'])
+        return JsonResponse({'error': str(e)}, status=413)
+    try:
+        complete_multipart_upload(data['key'], data['upload_id'], parts)
+    except ClientError as e:
+        release(project.id, request.user.id, size)
+        return multipart_error_response(e)
+
+    file = UploadedFile(
+        user=request.user,
+        project=project,
+        size=size,
+        content_type=data.get('content_type', ''),
+    )
+    file.file.name = data['key']
+    file.save()
+    audit.record(AuditEvent.Action.UPLOAD, request.user, project, file, request)
+
+    messages.success(request, "File uploaded successfully!")
+    return JsonResponse({
+        'id': file.id,
+        'filename': file.filename,
+        'redirect': reverse('project_detail', args=[project.id]),
+    })
+
+@login_required
+@require_POST
+def multipart_upload_abort(request, project_id):
+    """Abort a multipart upload and discard its parts"""
+    project = get_object_or_404(Project, id=project_id)
+
+    if not is_project_member(request.user, project):
+        return HttpResponseForbidden("You don't have access to this project.")
+
+    data = load_upload_token(request, project, max_age=MULTIPART_TOKEN_MAX_AGE)
+    if data is None or 'upload_id' not in data:
+        return JsonResponse({'error': 'Invalid upload token.'}, status=400)
+
+    abort_upload(data['key'], data['upload_id'])
+    return JsonResponse({'aborted': True})
 
 @login_required
 def user_projects(request):
     """View all projects the user is a member of"""
-    if request.user.is_superuser:
-        # Superusers see all projects
-        projects = Project.objects.all().order_by('-created_at')
-    else:
-        # Regular users see only projects they're members of
-        projects = Project.objects.filter(
-            projectmembership__user=request.user
-        ).order_by('-created_at')
+    # Superusers see all projects, regular users only projects they're members of
+    project_ids = list(Project.objects.for_user(request.user).order_by('-created_at').values_list('id', flat=True))
     
-    return render(request, 'uploads/user_projects.html', {'projects': projects})
+    return render(request, 'uploads/user_projects.html', {
+        'project_cards': project_cards(project_ids, 'uploads/fragments/project_card.html'),
+    })
 
 #File Management Views
+@login_required
+async def download_file(request, file_id):
+    """Redirect to a short-lived signed S3 URL for a file"""
+    file = await aget_object_or_404(UploadedFile.objects.select_related('project'), id=file_id)
+    user = await request.auser()
+
+    if not await sync_to_async(is_project_member)(user, file.project):
+        await audit.arecord(AuditEvent.Action.DENIED, user, file.project, file, request)
+        return HttpResponseForbidden("You don't have access to this file.")
+
+    if getattr(default_storage, 'is_caching', False):
+        # Recorded by proxy_file
+        return HttpResponseRedirect(reverse('proxy_file', args=[file.id]))
+    await audit.arecord(AuditEvent.Action.DOWNLOAD, user, file.project, file, request)
+    return HttpResponseRedirect(await sync_to_async(get_download_url)(file))
+
+@login_required
+async def proxy_file(request, file_id):
+    """Stream a file's content through the app, for clients that can't follow S3 redirects"""
+    file = await aget_object_or_404(UploadedFile.objects.select_related('project'), id=file_id)
+    user = await request.auser()
+
+    if not await sync_to_async(is_project_member)(user, file.project):
+        await audit.arecord(AuditEvent.Action.DENIED, user, file.project, file, request)
+        return HttpResponseForbidden("You don't have access to this file.")
+    await audit.arecord(AuditEvent.Action.DOWNLOAD, user, file.project, file, request)
+
+    # Hot files are served from the local read cache, if the storage keeps one
+    if getattr(default_storage, 'is_caching', False):
+        try:
+            path = await sync_to_async(default_storage.cached_path)(file.file.name)
+            if path is not None:
+                handle = await asyncio.to_thread(open, path, 'rb')
+                if not isinstance(request, ASGIRequest):
+                    return FileResponse(handle, as_attachment=True, filename=file.filename)
+                # FileResponse's iterator is synchronous, which ASGI would run chunk by chunk through sync_to_async
+                response = StreamingHttpResponse(
+                    aio.iter_file(handle, settings.ZIP_CHUNK_SIZE),
+                    content_type=file.content_type or 'application/octet-stream',
+                )
+                response['Content-Length'] = os.fstat(handle.fileno()).st_size
+                response['Content-Disposition'] = content_disposition_header(True, file.filename)
+                return response
+        except ClientError:
+            raise Http404("File not found in storage.")
+        except FileNotFoundError:
+            pass  # evicted by another process in the meantime; stream from S3 below
+
+    # Under WSGI (e.g. runserver) the event loop ends with the view, so read with boto3 instead
+    try:
+        if isinstance(request, ASGIRequest):
+            s3_response, content = await aio.get_object(file.file.name, chunk_size=settings.ZIP_CHUNK_SIZE)
+        else:
+            s3_response = await sync_to_async(get_object)(file.file.name)
+            content = s3_response['Body'].iter_chunks(settings.ZIP_CHUNK_SIZE)
+    except ClientError:
+        raise Http404("File not found in storage.")
+
+    response = StreamingHttpResponse(
+        content,
+        content_type=s3_response.get('ContentType') or 'application/octet-stream',
+    )
+    response['Content-Length'] = s3_response['ContentLength']
+    response['Content-Disposition'] = content_disposition_header(True, file.filename)
+    return response
+
 @login_required
 def delete_file(request, file_id):
     file = get_object_or_404(UploadedFile, id=file_id)
@@ -248,11 +950,16 @@ def delete_file(request, file_id):
     
     # Ensure users can only delete their own files
     if file.user != request.user and not request.user.is_superuser:
+        audit.record(AuditEvent.Action.DENIED, request.user, project, file, request)
         return HttpResponseForbidden("You don't have permission to delete this file.")
     
     if request.method == 'POST':
-        file.file.delete(save=False)  # Delete the file from S3
-        file.delete()  # Delete the database entry
+        # Taken before the delete clears the file's ID
+        deleted = audit.event(AuditEvent.Action.DELETE, request.user, project, file, request)
+        # Delete the database entry and the file from S3, unless its content is shared
+        delete_uploaded_file(file)
+        release(project.id, file.user_id, file.size or 0)
+        audit.put(deleted)
         messages.success(request, "File deleted successfully.")
         return redirect('project_detail', project_id=project.id)  # Also fix this redirect
     
@@ -262,12 +969,127 @@ def delete_file(request, file_id):
     })
 
 
+# Storage read cache statistics
+@login_required
+@user_passes_test(is_superuser)
+def storage_cache_stats(request):
+    """Hit, miss and eviction counts of the local S3 read cache (superuser only)"""
+    if not getattr(default_storage, 'is_caching', False):
+        raise Http404("The storage backend has no read cache.")
+    return JsonResponse(default_storage.stats())
+
+# Fragment cache statistics
+@login_required
+@user_passes_test(is_superuser)
+def fragment_cache_stats(request):
+    """Hit and miss counts of the cached page fragments (superuser only)"""
+    return JsonResponse(fragment_stats())
+
+# Request profiling
+@login_required
+@user_passes_test(is_superuser)
+def profiling_stats(request):
+    """Per-view latency percentiles, queries and S3 calls of recent requests (superuser only)"""
+    if not settings.PROFILING_ENABLED:
+        raise Http404("Profiling is not enabled.")
+    return render(request, 'uploads/profiling.html', {
+        'rows': profiling.summarize(),
+        'buffered': len(profiling.records),
+        'buffer_size': settings.PROFILING_BUFFER_SIZE,
+        'sample_rate': settings.PROFILING_SAMPLE_RATE,
+    })
+
+# Audit log
+@login_required
+@user_passes_test(is_superuser)
+def audit_log(request):
+    """
+    Recorded events, most recent first, optionally filtered by ?user= (username),
+    ?project= (ID) and ?action= (superuser only)
+    """
+    filters = {
+        'user': request.GET.get('user', '').strip(),
+        'project': request.GET.get('project', '').strip(),
+        'action': request.GET.get('action', ''),
+    }
+    events = AuditEvent.objects.select_related('user', 'project')
+    if filters['user']:
+        events = events.filter(user__username=filters['user'])
+    if filters['project']:
+        if not filters['project'].isdigit():
+            return HttpResponseBadRequest("project must be a project ID.")
+        events = events.filter(project_id=int(filters['project']))
+    if filters['action']:
+        if filters['action'] not in AuditEvent.Action.values:
+            return HttpResponseBadRequest("Unknown action.")
+        events = events.filter(action=filters['action'])
+
+    cursor = request.GET.get('cursor')
+    try:
+        events, next_cursor = paginate_audit_events(events, cursor=cursor, page_size=settings.AUDIT_LOG_PAGE_SIZE)
+    except InvalidCursor:
+        return HttpResponseBadRequest("Invalid cursor.")
+
+    return render(request, 'uploads/audit_log.html', {
+        'events': events,
+        'filters': filters,
+        # For the page links, which keep the filters
+        'query': urlencode({name: value for name, value in filters.items() if value}),
+        'actions': AuditEvent.Action.choices,
+        'next_cursor': next_cursor,
+        'is_first_page': not cursor,
+    })
+
+# Background Job Views
+@login_required
+@user_passes_test(is_superuser)
+def job_list(request):
+    """List recent background jobs, optionally filtered by status (superuser only)"""
+    jobs = Job.objects.select_related('created_by')
+    status = request.GET.get('status')
+    if status:
+        jobs = jobs.filter(status=status)
+
+    return render(request, 'uploads/job_list.html', {
+        'jobs': jobs[:100],
+        'statuses': Job.Status.choices,
+    })
+
+@login_required
+@user_passes_test(is_superuser)
+def job_detail(request, job_id):
+    """Show the status and progress of a background job (superuser only)"""
+    job = get_object_or_404(Job, id=job_id)
+    return render(request, 'uploads/job_detail.html', {'job': job})
+
+
 # Invitation Management Views
 @login_required
 @user_passes_test(is_superuser)
 def invitation_list(request):
-    invitations = Invitation.objects.all().order_by('-created_at')
-    return render(request, 'uploads/invitation_list.html', {'invitations': invitations})
+    """One page of invitations, newest first, optionally of one status (?status=)"""
+    status = request.GET.get('status', '')
+    invitations = Invitation.objects.with_status()
+    if status:
+        if status not in Invitation.Status.values:
+            return HttpResponseBadRequest("Unknown status.")
+        invitations = invitations.with_status_of(status)
+
+    cursor = request.GET.get('cursor')
+    try:
+        invitations, next_cursor = paginate_invitations(
+            invitations, cursor=cursor, page_size=settings.INVITATION_LIST_PAGE_SIZE
+        )
+    except InvalidCursor:
+        return HttpResponseBadRequest("Invalid cursor.")
+
+    return render(request, 'uploads/invitation_list.html', {
+        'invitations': invitations,
+        'status': status,
+        'statuses': Invitation.Status.choices,
+        'next_cursor': next_cursor,
+        'is_first_page': not cursor,
+    })
 
 @login_required
 @user_passes_test(is_superuser)
@@ -275,9 +1097,14 @@ def create_invitation(request):
     if request.method == 'POST':
         form = InvitationForm(request.POST)
         if form.is_valid():
-            invitation = form.save(commit=False)
-            invitation.invited_by = request.user
-            invitation.save()
+            with transaction.atomic():
+                # An invitation to the address that expired unaccepted is replaced by this one
+                Invitation.objects.with_status_of(Invitation.Status.EXPIRED).filter(
+                    email=form.cleaned_data['email']
+                ).delete()
+                invitation = form.save(commit=False)
+                invitation.invited_by = request.user
+                invitation.save()
 
             # Generate invitation URL
             invitation_url = request.build_absolute_uri(
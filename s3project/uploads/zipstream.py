@@ -0,0 +1,122 @@
+"""
+Streaming ZIP archives of S3 objects.
+
+Objects are read in chunks by a small thread pool a few files ahead of the writer,
+through bounded queues, and the archive is produced on the fly. Nothing is written
+to disk and at most workers x read_ahead chunks are held in memory at any time.
+"""
+import io
+import queue
+import threading
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .s3 import get_s3_client, get_bucket_name
+
+# Marks the end of an object's chunks in its queue
+END = object()
+
+
+class ChunkBuffer(io.RawIOBase):
+    """
+    A write-only, unseekable stream that ZipFile writes into and we drain.
+    Being unseekable makes ZipFile use data descriptors instead of seeking back.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def read_object(key, chunks, chunk_size, cancelled):
+    """
+    Reader task: put the object's size, then its chunks, then END onto the queue.
+    Blocks while the queue is full, and gives up if the download is cancelled.
+    """
+    def put(item):
+        while not cancelled.is_set():
+            try:
+                chunks.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    try:
+        response = get_s3_client().get_object(Bucket=get_bucket_name(), Key=key)
+        if not put(response['ContentLength']):
+            return
+        body = response['Body']
+        try:
+            for chunk in body.iter_chunks(chunk_size):
+                if not put(chunk):
+                    return
+        finally:
+            body.close()
+        put(END)
+    except Exception as e:
+        put(e)
+
+
+def next_item(chunks):
+    item = chunks.get()
+    if isinstance(item, Exception):
+        raise item
+    return item
+
+
+def stream_zip(entries, chunk_size=1024 * 1024, workers=4, read_ahead=4):
+    """
+    Yields a ZIP archive of (arcname, key, date_time) entries, in order.
+
+    Up to `workers` objects are fetched ahead of the one being written, each
+    buffering at most `read_ahead` chunks. ZIP64 is used for large members.
+    """
+    cancelled = threading.Event()
+    buffer = ChunkBuffer()
+    entries = iter(entries)
+    in_flight = deque()
+
+    def submit(executor):
+        for arcname, key, date_time in entries:
+            chunks = queue.Queue(maxsize=read_ahead)
+            executor.submit(read_object, key, chunks, chunk_size, cancelled)
+            in_flight.append((arcname, date_time, chunks))
+            return
+
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='zipstream')
+    try:
+        for _ in range(workers):
+            submit(executor)
+
+        with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+            while in_flight:
+                arcname, date_time, chunks = in_flight.popleft()
+
+                info = zipfile.ZipInfo(arcname, date_time=date_time)
+                info.file_size = next_item(chunks)  # lets ZipFile decide on ZIP64 up front
+                with archive.open(info, 'w') as member:
+                    while (chunk := next_item(chunks)) is not END:
+                        member.write(chunk)
+                        yield buffer.drain()
+                yield buffer.drain()
+
+                submit(executor)
+
+        yield buffer.drain()
+    finally:
+        # Stops the readers if the client disconnects part way
+        cancelled.set()
+        executor.shutdown(wait=False, cancel_futures=True)